@@ -0,0 +1,79 @@
+"""Compares the per-file cost of turning a DCM that is already read into a record, before and after
+the column spec is compiled into an ExtractionPlan whose values are transformed a batch at a time."""
+import os, sys
+import json
+import time
+import tempfile
+import argparse
+import pydicom as pdm
+projectDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(projectDir, "metadata_to_db"))
+from extractionPlan import ExtractionPlan
+from syntheticCorpus import writeDcm
+
+def createRecordBefore(elementsOriginal, dcm, filePath, parentFolder):
+    """The extraction as dicomToDb did it per file before the ExtractionPlan."""
+    elements = elementsOriginal.copy()
+    for elementName in elements.keys():
+        tag = elements[elementName]['tag']
+        [groupNum, elementNum] = tag.split(',')
+        try:
+            element = dcm[int(groupNum, 16), int(elementNum, 16)]
+            if element.VR == 'DS':
+                if element.VM == 1:
+                    value = int(float(element.value))
+                elif element.VM > 1:
+                    value = int(float(element.value[0]))
+            else:
+                value = element.value
+            elements[elementName]['value'] = value
+        except (KeyError) as tag:
+            elements[elementName]['value'] = None
+            continue
+
+    if ('patient_orientation' in elements) and (elements['patient_orientation']['value'] is not None):
+        elements['patient_orientation']['value'] = '\\'.join(elements['patient_orientation']['value'])
+
+    names = ['file_name', 'file_path']
+    fileRelPath = filePath.replace(parentFolder + os.path.sep, "")
+    values = [filePath.split(os.sep)[-1], fileRelPath]
+    placeholders = ['%s', '%s']
+    for elementName in elements.keys():
+        if not elements[elementName]['calculation_only']:
+            names.append(elementName)
+            values.append(elements[elementName]['value'])
+            placeholders.append('%s')
+    sqlQuery = 'INSERT INTO image_metadata (' + ', '.join(names) + ') VALUES (' + ', '.join(placeholders) + ');'
+    return (sqlQuery, values)
+
+def timePerFile(function, iterations):
+    """Runs function the given number of times and returns the average time in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) * 1e6 / iterations
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument('--iterations', type=int, default=20000)
+    argParser.add_argument('--batch-size', type=int, default=32, help='DCMs per batch, the chunk size of the pipeline')
+    args = argParser.parse_args()
+
+    with open(os.path.join(projectDir, "misc", "columns_info.json")) as fileReader:
+        elements = json.load(fileReader)["elements"]
+    plan = ExtractionPlan(elements)
+
+    with tempfile.TemporaryDirectory() as folder:
+        filePath = os.path.join(folder, 'sub', '1.dcm')
+        os.makedirs(os.path.dirname(filePath))
+        writeDcm(filePath, 64, 64, 1)
+        dcm = pdm.dcmread(filePath, **plan.getReadOptions('1 KB'))
+
+        before = timePerFile(lambda: createRecordBefore(elements, dcm, filePath, folder), args.iterations)
+        after = timePerFile(lambda: plan.createRecords([(filePath, plan.extractValues(dcm), plan.createHeader(dcm))
+                                                         for _ in range(args.batch_size)], folder),
+                            args.iterations // args.batch_size) / args.batch_size
+
+    print('Before: {0:.1f} us/file'.format(before))
+    print('After:  {0:.1f} us/file'.format(after))
+    print('Speedup: {0:.1f}x'.format(before / after))
@@ -0,0 +1,48 @@
+"""Compares the time it takes to read the column spec tags with a full read and a header-only read."""
+import os
+import json
+import time
+import tempfile
+import argparse
+import pydicom as pdm
+from syntheticCorpus import writeDcm
+projectDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def readTags(filePaths, tags, readOptions):
+    """Reads the tags from every file and returns the average time per file in milliseconds."""
+    start = time.perf_counter()
+    for filePath in filePaths:
+        dcm = pdm.dcmread(filePath, **readOptions)
+        for tag in tags:
+            if tag in dcm:
+                dcm[tag].value
+    return (time.perf_counter() - start) * 1000 / len(filePaths)
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument('--files', type=int, default=200)
+    argParser.add_argument('--rows', type=int, default=2048)
+    argParser.add_argument('--columns', type=int, default=2048)
+    argParser.add_argument('--frames', type=int, default=1)
+    args = argParser.parse_args()
+
+    with open(os.path.join(projectDir, "misc", "columns_info.json")) as fileReader:
+        elements = json.load(fileReader)["elements"]
+    tags = []
+    for elementName in elements.keys():
+        [groupNum, elementNum] = elements[elementName]['tag'].split(',')
+        tags.append(pdm.tag.Tag(int(groupNum, 16), int(elementNum, 16)))
+
+    with tempfile.TemporaryDirectory() as folder:
+        filePaths = [os.path.join(folder, str(index) + '.dcm') for index in range(args.files)]
+        for filePath in filePaths:
+            writeDcm(filePath, args.rows, args.columns, args.frames)
+
+        # Read everything once so that both modes are measured with a warm page cache
+        readTags(filePaths, tags, {})
+        fullRead = readTags(filePaths, tags, {})
+        headerRead = readTags(filePaths, tags, {'stop_before_pixels': True, 'specific_tags': tags, 'defer_size': '1 KB'})
+
+    print('Full read:        {0:.3f} ms/file'.format(fullRead))
+    print('Header-only read: {0:.3f} ms/file'.format(headerRead))
+    print('Speedup:          {0:.1f}x'.format(fullRead / headerRead))
@@ -0,0 +1,312 @@
+"""Runs an ingest path end to end over a synthetic corpus and saves the measurements as JSON.
+
+The records go either to a local Postgres (--sink postgres, with the DB settings of --config),
+to an in-process stand-in for the batch writer (--sink memory), which formats every batch
+as it would be sent with COPY and then drops it, or to a file with one of the export sinks
+(--sink parquet, csv or sqlite). Run one scenario per invocation so that the
+peak RSS belongs to that scenario, and pass --compare to see the change against an earlier run.
+
+The latency of a file is measured during the ingest itself, from the walk handing out its path
+until the batch with its record was written, so it includes the wait for the batch to fill.
+"""
+import os, sys
+import io
+import json
+import time
+import atexit
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import sqlite3
+import subprocess
+import numpy as np
+projectDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(projectDir, "metadata_to_db"))
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler, copyFormat
+from dicomToDb import DicomToDatabase
+from niftiToDb import NiftiToDatabase
+from exportSinks import getDefaultExtension
+from syntheticCorpus import createDicomCorpus, createNiftiCorpus
+
+BENCHMARK_TABLE_NAME = "benchmark_metadata"
+
+class MemoryWriter:
+    """Stand-in for BatchWriter that formats the batches for COPY and drops them."""
+    def __init__(self, columnNames, batchSize):
+        self.columnNames = list(columnNames)
+        self.batchSize = batchSize
+        self.buffer = []
+        self.batchCount = 0
+        self.writtenCount = 0
+        self.failedRecords = []
+
+    def addRecord(self, record, filePath=None):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def addFailure(self, filePath):
+        pass
+
+    def flush(self):
+        if not self.buffer:
+            return
+        buffer = io.StringIO()
+        for record in self.buffer:
+            buffer.write('\t'.join(copyFormat(value) for value in record) + '\n')
+        self.batchCount += 1
+        self.writtenCount += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+class LatencyRecorder:
+    """Records the latency of every file, from the walk handing out its path until its record was written."""
+    def __init__(self, parentFolder):
+        self.parentFolder = parentFolder
+        self.foundTimes = {}
+        self.latencies = []
+
+    def timePaths(self, pathlist):
+        for path in pathlist:
+            self.foundTimes[os.path.normpath(str(path))] = time.perf_counter()
+            yield path
+
+    def addWritten(self, filePaths):
+        now = time.perf_counter()
+        for filePath in filePaths:
+            foundTime = self.foundTimes.pop(os.path.normpath(os.path.join(self.parentFolder, filePath)), None)
+            if foundTime is not None:
+                self.latencies.append((now - foundTime) * 1000)
+
+class TimedWriter:
+    """Wraps a batch writer or export sink, the records count as written once the writer's buffer was flushed.
+
+    The path of a record is the one handed to addRecord, or its first value if there is none as
+    for the NIFTIs.
+    """
+    def __init__(self, writer, recorder):
+        self.writer = writer
+        self.recorder = recorder
+        self.pendingPaths = []
+
+    def addRecord(self, record, filePath=None):
+        self.pendingPaths.append(record[0] if filePath is None else filePath)
+        self.writer.addRecord(record, filePath)
+        self.addWritten()
+
+    def flush(self):
+        self.writer.flush()
+        self.addWritten()
+
+    def close(self):
+        self.writer.close()
+        self.addWritten()
+
+    def addWritten(self):
+        if not self.writer.buffer:
+            self.recorder.addWritten(self.pendingPaths)
+            self.pendingPaths = []
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+class BenchmarkDicomToDatabase(DicomToDatabase):
+    def __init__(self, configHandler, dbHandler, recorder):
+        DicomToDatabase.__init__(self, configHandler, dbHandler)
+        self.recorder = recorder
+
+    def findDicomFiles(self):
+        return self.recorder.timePaths(DicomToDatabase.findDicomFiles(self))
+
+    def createBatchWriter(self, metaTableName, columnNames, loadMethod, conflictColumns=None, manifestTableName=None,
+                          statsCollector=None, duplicateFilter=None):
+        self.batchWriter = TimedWriter(DicomToDatabase.createBatchWriter(self, metaTableName, columnNames, loadMethod,
+                                                                         conflictColumns, manifestTableName,
+                                                                         statsCollector, duplicateFilter), self.recorder)
+        return self.batchWriter
+
+    def createSink(self, sinkName, tableName, columnNames, columnTypes, keyColumns=None):
+        return TimedWriter(DicomToDatabase.createSink(self, sinkName, tableName, columnNames, columnTypes, keyColumns),
+                           self.recorder)
+
+class MemoryDicomToDatabase(BenchmarkDicomToDatabase):
+    def createBatchWriter(self, metaTableName, columnNames, loadMethod, conflictColumns=None, manifestTableName=None,
+                          statsCollector=None, duplicateFilter=None):
+        self.batchWriter = TimedWriter(MemoryWriter(columnNames, self.configHandler.getBatchSize()), self.recorder)
+        return self.batchWriter
+
+class BenchmarkNiftiToDatabase(NiftiToDatabase):
+    def __init__(self, configHandler, dbHandler, recorder):
+        NiftiToDatabase.__init__(self, configHandler, dbHandler)
+        self.recorder = recorder
+
+    def findNiftiFiles(self, memberFilter):
+        return self.recorder.timePaths(NiftiToDatabase.findNiftiFiles(self, memberFilter))
+
+    def createBatchWriter(self, metaTableName, columnNames, loadMethod):
+        self.batchWriter = TimedWriter(NiftiToDatabase.createBatchWriter(self, metaTableName, columnNames, loadMethod),
+                                       self.recorder)
+        return self.batchWriter
+
+    def createSink(self, sinkName, tableName, columnNames, columnTypes, keyColumns=None):
+        return TimedWriter(NiftiToDatabase.createSink(self, sinkName, tableName, columnNames, columnTypes, keyColumns),
+                           self.recorder)
+
+class MemoryNiftiToDatabase(BenchmarkNiftiToDatabase):
+    def createBatchWriter(self, metaTableName, columnNames, loadMethod):
+        self.batchWriter = TimedWriter(MemoryWriter(columnNames, self.configHandler.getBatchSize()), self.recorder)
+        return self.batchWriter
+
+def getPeakRss(who):
+    """Get the peak resident set size in MB of this process (RUSAGE_SELF) or of its largest finished child (RUSAGE_CHILDREN)."""
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def getGitRevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=projectDir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def countExported(sinkName, outputPath):
+    """Count the records an export sink wrote to its file."""
+    if sinkName == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_metadata(outputPath).num_rows
+    if sinkName == 'sqlite':
+        connection = sqlite3.connect(outputPath)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM "' + BENCHMARK_TABLE_NAME + '";').fetchone()[0]
+        finally:
+            connection.close()
+    with open(outputPath) as fileReader:
+        return sum(1 for _ in fileReader) - 1
+
+def runBenchmark(args, parentFolder):
+    """Create the corpus in parentFolder, ingest it and return the measurements."""
+    if args.kind == 'dicom':
+        filePaths = createDicomCorpus(parentFolder, args.files, args.rows, args.columns, args.frames, args.missing_rate, args.depth)
+    else:
+        filePaths = createNiftiCorpus(parentFolder, args.files, args.size, not args.uncompressed, args.depth)
+    corpusBytes = sum(os.path.getsize(filePath) for filePath in filePaths)
+
+    configFilePath = os.path.join(parentFolder, 'config.ini')
+    columnsInfoPath = os.path.join(parentFolder, 'columns_info.json')
+    shutil.copyfile(os.path.join(projectDir, 'misc', 'columns_info.json'), columnsInfoPath)
+    if args.sink == 'postgres':
+        shutil.copyfile(args.config, configFilePath)
+    else:
+        open(configFilePath, 'w').close()
+    configHandler = MetaToDbConfigHandler(configFilePath)
+    configHandler.setSetting('ingest', 'parallel', str(args.parallel).lower())
+    configHandler.setSetting('ingest', 'workers', str(args.workers))
+    configHandler.setSetting('ingest', 'batch_size', str(args.batch_size))
+    configHandler.setSetting('ingest', 'full_header', str(args.full_header).lower())
+    exported = args.sink not in ('memory', 'postgres')
+    if exported:
+        configHandler.setSetting('export', 'sink', args.sink)
+        configHandler.setSetting('export', 'path', '')
+        configHandler.setSetting('export', 'batch_size', str(args.batch_size))
+
+    dbHandler = None
+    if args.sink == 'postgres':
+        dbHandler = DatabaseHandler(configHandler)
+        if dbHandler.tableExists(BENCHMARK_TABLE_NAME):
+            dbHandler.dropTable(BENCHMARK_TABLE_NAME)
+        if args.kind == 'dicom':
+            dbHandler.addTableToDb(BENCHMARK_TABLE_NAME, columnsInfoPath, 'nonElementColumns', 'elements', 'indexes')
+        else:
+            dbHandler.addTableToDb(BENCHMARK_TABLE_NAME, columnsInfoPath, 'niftiNonElementColumns', 'nifti_elements', 'nifti_indexes')
+
+    # Time the whole ingest path, from the walk to the last batch
+    recorder = LatencyRecorder(configHandler.getParentFolder())
+    start = time.perf_counter()
+    if args.kind == 'dicom':
+        converterClass = BenchmarkDicomToDatabase if dbHandler or exported else MemoryDicomToDatabase
+        converter = converterClass(configHandler, dbHandler, recorder)
+        converter.dicomToDb(None, BENCHMARK_TABLE_NAME, columnsInfoPath)
+    else:
+        converterClass = BenchmarkNiftiToDatabase if dbHandler or exported else MemoryNiftiToDatabase
+        converter = converterClass(configHandler, dbHandler, recorder)
+        converter.niftiToDb(BENCHMARK_TABLE_NAME, columnsInfoPath)
+    elapsed = time.perf_counter() - start
+    latencies = np.array(recorder.latencies)
+
+    if dbHandler:
+        storedCount = dbHandler.countRecords(BENCHMARK_TABLE_NAME)
+        dbHandler.dropTable(BENCHMARK_TABLE_NAME)
+    elif exported:
+        storedCount = countExported(args.sink, configHandler.getExportPath(BENCHMARK_TABLE_NAME + getDefaultExtension(args.sink)))
+    else:
+        storedCount = converter.batchWriter.writtenCount
+
+    return {
+        'files': len(filePaths),
+        'stored': storedCount,
+        'corpus_mb': corpusBytes / 1e6,
+        'seconds': elapsed,
+        'files_per_second': len(filePaths) / elapsed,
+        'mb_per_second': corpusBytes / 1e6 / elapsed,
+        'latency_p50_ms': float(np.percentile(latencies, 50)) if latencies.size else None,
+        'latency_p99_ms': float(np.percentile(latencies, 99)) if latencies.size else None,
+        'peak_rss_mb': getPeakRss(resource.RUSAGE_SELF),
+        'peak_rss_children_mb': getPeakRss(resource.RUSAGE_CHILDREN),
+    }
+
+def printComparison(results, previousResults):
+    for name in ('files_per_second', 'mb_per_second', 'latency_p50_ms', 'latency_p99_ms', 'peak_rss_mb', 'peak_rss_children_mb'):
+        before = previousResults['results'].get(name)
+        after = results['results'][name]
+        if not before or after is None:
+            continue
+        print('{0:20} {1:12.2f} -> {2:12.2f} ({3:+.1f}%)'.format(name, before, after, (after - before) / before * 100))
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argParser.add_argument('--kind', choices=['dicom', 'nifti'], default='dicom')
+    argParser.add_argument('--sink', choices=['memory', 'postgres', 'parquet', 'csv', 'sqlite'], default='memory')
+    argParser.add_argument('--config', help='Config file with the postgresql section, for --sink postgres')
+    argParser.add_argument('--files', type=int, default=1000)
+    argParser.add_argument('--rows', type=int, default=512)
+    argParser.add_argument('--columns', type=int, default=512)
+    argParser.add_argument('--frames', type=int, default=1)
+    argParser.add_argument('--missing-rate', type=float, default=0.0)
+    argParser.add_argument('--size', type=int, default=64, help='Edge length of the NIfTI volumes')
+    argParser.add_argument('--uncompressed', action='store_true', help='Write .nii instead of .nii.gz')
+    argParser.add_argument('--depth', type=int, default=2)
+    argParser.add_argument('--parallel', action='store_true')
+    argParser.add_argument('--workers', type=int, default=0)
+    argParser.add_argument('--batch-size', type=int, default=1000)
+    argParser.add_argument('--full-header', action='store_true', help='Also store the whole header as JSONB')
+    argParser.add_argument('--output', default='benchmark_results.json')
+    argParser.add_argument('--compare', help='JSON of an earlier run to compare against')
+    args = argParser.parse_args()
+    if args.sink == 'postgres' and args.config is None:
+        argParser.error('--sink postgres needs --config')
+
+    # The config handler writes its file at exit, so the folder is removed after that
+    parentFolder = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, parentFolder, ignore_errors=True)
+    measurements = runBenchmark(args, parentFolder)
+
+    results = {
+        'revision': getGitRevision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'results': measurements,
+    }
+    with open(args.output, 'w') as fileWriter:
+        json.dump(results, fileWriter, indent=4)
+    print(json.dumps(measurements, indent=4))
+
+    if args.compare:
+        with open(args.compare) as fileReader:
+            printComparison(results, json.load(fileReader))
@@ -0,0 +1,44 @@
+"""Compares the per-file cost of reading NIfTI headers with readNiftiHeader and with nibabel,
+using the cost of a stat() per file as the baseline."""
+import os, sys
+import time
+import tempfile
+import argparse
+import numpy as np
+import nibabel as nib
+projectDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(projectDir, "metadata_to_db"))
+from niftiHeader import readNiftiHeader
+
+def timePerFile(function, filePaths):
+    """Calls function on every file and returns the average time per file in microseconds."""
+    start = time.perf_counter()
+    for filePath in filePaths:
+        function(filePath)
+    return (time.perf_counter() - start) * 1e6 / len(filePaths)
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument('--files', type=int, default=200)
+    argParser.add_argument('--size', type=int, default=64, help='Edge length of the cubic volumes')
+    args = argParser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        volume = np.random.rand(args.size, args.size, args.size).astype(np.float32)
+        for suffix in ('.nii', '.nii.gz'):
+            filePaths = []
+            for index in range(args.files):
+                filePath = os.path.join(folder, str(index) + '_injured' + suffix)
+                nib.save(nib.Nifti1Image(volume, np.eye(4)), filePath)
+                filePaths.append(filePath)
+
+            # Read everything once so that all readers are measured with a warm page cache
+            timePerFile(os.stat, filePaths)
+            statTime = timePerFile(os.stat, filePaths)
+            headerTime = timePerFile(readNiftiHeader, filePaths)
+            nibabelTime = timePerFile(lambda filePath: nib.load(filePath).header['dim'], filePaths)
+
+            print(suffix)
+            print('  stat():           {0:.1f} us/file'.format(statTime))
+            print('  readNiftiHeader:  {0:.1f} us/file'.format(headerTime))
+            print('  nibabel:          {0:.1f} us/file'.format(nibabelTime))
@@ -0,0 +1,67 @@
+"""Compares the per-row data adjustments that the values of every DCM went through with the columnar
+transforms of a whole batch, on synthetic values shaped like the columns of the column spec."""
+import os, sys
+import time
+import random
+import argparse
+from datetime import datetime, date, timedelta
+from dateutil.relativedelta import relativedelta
+from pydicom.multival import MultiValue
+from pydicom.valuerep import DSfloat
+projectDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(projectDir, "metadata_to_db"))
+from columnTransforms import transformAge, transformInteger, transformJoin
+
+def createRows(count, distinctDates):
+    """Create rows of (patient_orientation, window_center, patient_age, patient_birth_date, study_date) values."""
+    random.seed(0)
+    dates = [(date(1930, 1, 1) + timedelta(days=random.randrange(25000))).strftime('%Y%m%d') for _ in range(distinctDates)]
+    rows = []
+    for _ in range(count):
+        rows.append((MultiValue(str, ['L', 'F']),
+                     MultiValue(DSfloat, [str(random.uniform(0, 4096)), '2048']),
+                     None,
+                     random.choice(dates),
+                     random.choice(dates)))
+    return rows
+
+def adjustRow(values):
+    """The conversions and data adjustments as they were done per DCM before the columnar transforms."""
+    orientation, windowCenter, patientAge, birthDate, studyDate = values
+    orientation = '\\'.join(orientation)
+    windowCenter = int(float(windowCenter[0]))
+    if patientAge is None:
+        patientAge = relativedelta(datetime.strptime(studyDate, '%Y%m%d'), datetime.strptime(birthDate, '%Y%m%d')).years
+    return (orientation, windowCenter, patientAge)
+
+def transformBatch(rows):
+    """The columnar transforms of the same values, a batch at a time."""
+    columns = list(zip(*rows))
+    stored = [transformJoin(columns[0], []),
+              transformInteger(columns[1], []),
+              transformAge(columns[2], [columns[3], columns[4]])]
+    return list(zip(*stored))
+
+def timePerRow(function, batches):
+    start = time.perf_counter()
+    for batch in batches:
+        function(batch)
+    return (time.perf_counter() - start) * 1e6 / sum(len(batch) for batch in batches)
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument('--rows', type=int, default=100000)
+    argParser.add_argument('--batch-size', type=int, default=32, help='Rows per batch, the chunk size of the pipeline')
+    argParser.add_argument('--distinct-dates', type=int, default=1000)
+    args = argParser.parse_args()
+
+    rows = createRows(args.rows, args.distinct_dates)
+    batches = [rows[index:index + args.batch_size] for index in range(0, len(rows), args.batch_size)]
+    assert [adjustRow(values) for values in rows] == [record for batch in batches for record in transformBatch(batch)]
+
+    before = timePerRow(lambda batch: [adjustRow(values) for values in batch], batches)
+    after = timePerRow(transformBatch, batches)
+
+    print('Per row:  {0:.2f} us/row'.format(before))
+    print('Columnar: {0:.2f} us/row (batches of {1})'.format(after, args.batch_size))
+    print('Speedup: {0:.1f}x'.format(before / after))
@@ -0,0 +1,108 @@
+"""Generates synthetic DICOM and NIfTI corpora for benchmarking the ingest."""
+import os
+import random
+import argparse
+import numpy as np
+import nibabel as nib
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# Folder names under the parent folder that the ingest looks in
+DICOM_FOLDER_NAME = "NLMCXR_subset_dataset"
+NIFTI_FOLDER_NAME = "nifti_dataset"
+
+# Elements of the column spec that can be left out of a synthetic DCM
+OPTIONAL_ELEMENTS = ['PatientOrientation', 'ViewPosition', 'WindowCenter', 'WindowWidth']
+
+def writeDcm(filePath, rows, columns, frames, missingElements=()):
+    """Writes a CR-like DCM with the elements of the column spec and uncompressed pixel data."""
+    fileMeta = Dataset()
+    fileMeta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'
+    fileMeta.MediaStorageSOPInstanceUID = generate_uid()
+    fileMeta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dcm = FileDataset(filePath, {}, file_meta=fileMeta, preamble=b'\0' * 128)
+    dcm.is_little_endian = True
+    dcm.is_implicit_VR = False
+    dcm.SOPClassUID = fileMeta.MediaStorageSOPClassUID
+    dcm.SOPInstanceUID = fileMeta.MediaStorageSOPInstanceUID
+    dcm.Modality = 'CR'
+    dcm.ViewPosition = 'PA'
+    dcm.PatientOrientation = ['L', 'F']
+    dcm.PatientBirthDate = '19600101'
+    dcm.StudyDate = '20200315'
+    dcm.PhotometricInterpretation = 'MONOCHROME2'
+    dcm.WindowCenter = '2047'
+    dcm.WindowWidth = '4095'
+    dcm.SamplesPerPixel = 1
+    dcm.Rows = rows
+    dcm.Columns = columns
+    dcm.NumberOfFrames = str(frames)
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 12
+    dcm.HighBit = 11
+    dcm.PixelRepresentation = 0
+    dcm.PixelData = bytes(rows * columns * frames * 2)
+    for keyword in missingElements:
+        delattr(dcm, keyword)
+    dcm.save_as(filePath)
+
+def writeNifti(filePath, size):
+    """Writes a NIfTI-1 volume of size^3 float32 voxels, gzipped if filePath ends with .gz."""
+    volume = np.random.rand(size, size, size).astype(np.float32)
+    nib.save(nib.Nifti1Image(volume, np.diag([1.5, 1.5, 3.0, 1.0])), filePath)
+
+def getNestedFolder(rootFolder, index, depth, fanOut=10):
+    """Get the folder of the index-th file when files are spread over depth levels of subfolders."""
+    parts = []
+    for _ in range(depth):
+        parts.append('d' + str(index % fanOut))
+        index //= fanOut
+    return os.path.join(rootFolder, *parts)
+
+def createDicomCorpus(parentFolder, files, rows=512, columns=512, frames=1, missingRate=0.0, depth=2, seed=0):
+    """Writes a corpus of DCMs under the DICOM folder of parentFolder, returns their paths.
+
+    Every optional element is left out of a DCM with probability missingRate.
+    """
+    randomGenerator = random.Random(seed)
+    filePaths = []
+    for index in range(files):
+        folder = getNestedFolder(os.path.join(parentFolder, DICOM_FOLDER_NAME), index, depth)
+        os.makedirs(folder, exist_ok=True)
+        missingElements = [keyword for keyword in OPTIONAL_ELEMENTS if randomGenerator.random() < missingRate]
+        filePath = os.path.join(folder, str(index) + '.dcm')
+        writeDcm(filePath, rows, columns, frames, missingElements)
+        filePaths.append(filePath)
+    return filePaths
+
+def createNiftiCorpus(parentFolder, files, size=64, compressed=True, depth=2):
+    """Writes a corpus of NIfTI volumes under the NIfTI folder of parentFolder, returns their paths."""
+    filePaths = []
+    suffix = '_injured.nii.gz' if compressed else '_injured.nii'
+    for index in range(files):
+        folder = getNestedFolder(os.path.join(parentFolder, NIFTI_FOLDER_NAME), index, depth)
+        os.makedirs(folder, exist_ok=True)
+        filePath = os.path.join(folder, str(index) + suffix)
+        writeNifti(filePath, size)
+        filePaths.append(filePath)
+    return filePaths
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument('parentFolder')
+    argParser.add_argument('--kind', choices=['dicom', 'nifti'], default='dicom')
+    argParser.add_argument('--files', type=int, default=1000)
+    argParser.add_argument('--rows', type=int, default=512)
+    argParser.add_argument('--columns', type=int, default=512)
+    argParser.add_argument('--frames', type=int, default=1)
+    argParser.add_argument('--missing-rate', type=float, default=0.0)
+    argParser.add_argument('--size', type=int, default=64, help='Edge length of the NIfTI volumes')
+    argParser.add_argument('--uncompressed', action='store_true', help='Write .nii instead of .nii.gz')
+    argParser.add_argument('--depth', type=int, default=2)
+    args = argParser.parse_args()
+
+    if args.kind == 'dicom':
+        createDicomCorpus(args.parentFolder, args.files, args.rows, args.columns, args.frames, args.missing_rate, args.depth)
+    else:
+        createNiftiCorpus(args.parentFolder, args.files, args.size, not args.uncompressed, args.depth)
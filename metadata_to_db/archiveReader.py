@@ -0,0 +1,156 @@
+"""Module contains functions for reading the image files inside zip and tar archives without unpacking them."""
+import os
+import io
+import logging
+import zipfile
+import tarfile
+from collections import OrderedDict
+from fileDiscovery import DICOM_PREAMBLE_SIZE, DICOM_MAGIC
+
+# A file inside an archive is identified by the path of the archive and the name of the member
+ARCHIVE_SEPARATOR = '!'
+
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz')
+
+# Number of archives a process keeps open for reading members at random
+MAX_OPEN_ARCHIVES = 8
+
+# Archives opened by openMember in this process, least recently used first
+openArchives = OrderedDict()
+
+class MemberFilter:
+    """Decides which members of an archive are read, like findFiles decides which files are found."""
+    def __init__(self, extensions=(), detectDicom=False):
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self.detectDicom = detectDicom
+
+    def matchesName(self, memberName):
+        return memberName.lower().endswith(self.extensions)
+
+    def matches(self, memberName, headBytes):
+        """Check a member by its name and, if that doesn't match, by the DICOM magic in its first bytes."""
+        if self.matchesName(memberName):
+            return True
+        return self.detectDicom and headBytes[DICOM_PREAMBLE_SIZE:DICOM_PREAMBLE_SIZE + len(DICOM_MAGIC)] == DICOM_MAGIC
+
+def isZipArchive(filePath):
+    return filePath.lower().endswith(ZIP_SUFFIXES)
+
+def isTarArchive(filePath):
+    return filePath.lower().endswith(TAR_SUFFIXES)
+
+def isArchive(filePath):
+    return isZipArchive(filePath) or isTarArchive(filePath)
+
+def joinMemberPath(archivePath, memberName):
+    return archivePath + ARCHIVE_SEPARATOR + memberName
+
+def splitMemberPath(filePath):
+    """Split the path of an archive member into the archive path and the member name.
+
+    Returns (filePath, None) if the path isn't one of an archive member.
+    """
+    index = filePath.find(ARCHIVE_SEPARATOR)
+    while index != -1:
+        if isArchive(filePath[:index]):
+            return (filePath[:index], filePath[index + len(ARCHIVE_SEPARATOR):])
+        index = filePath.find(ARCHIVE_SEPARATOR, index + 1)
+    return (filePath, None)
+
+def getSourcePath(filePath):
+    """Get the path of what is read as a unit to get a file, the archive for members of tar archives.
+
+    Tar archives can only be read from start to end, so their members are read in one pass and
+    the archive is what e.g. the manifest keeps track of.
+    """
+    archivePath, memberName = splitMemberPath(filePath)
+    if memberName is not None and isTarArchive(archivePath):
+        return archivePath
+    return filePath
+
+def statFile(filePath):
+    """Get the os.stat of a file, that of the archive for archive members."""
+    return os.stat(splitMemberPath(filePath)[0])
+
+def findArchiveFiles(archivePaths, memberFilter):
+    """Find the files to read in archives, yielding their paths as the archives are listed.
+
+    The members of zip archives are found from the central directory and yielded as
+    archive!member paths. Tar archives are yielded as they are, their members are found
+    while they are read with readTarMembers.
+    """
+    for archivePath in archivePaths:
+        if isZipArchive(archivePath):
+            for memberPath in findZipMembers(archivePath, memberFilter):
+                yield memberPath
+        elif isTarArchive(archivePath):
+            yield archivePath
+        else:
+            logging.warning('Not a zip or tar archive, skipping %s', archivePath)
+
+def findZipMembers(archivePath, memberFilter):
+    """List the members of a zip archive that pass the filter, as archive!member paths."""
+    memberPaths = []
+    try:
+        with zipfile.ZipFile(archivePath) as zipFile:
+            for info in zipFile.infolist():
+                if info.is_dir():
+                    continue
+                if not memberFilter.matchesName(info.filename):
+                    if not memberFilter.detectDicom:
+                        continue
+                    with zipFile.open(info) as fileReader:
+                        headBytes = fileReader.read(DICOM_PREAMBLE_SIZE + len(DICOM_MAGIC))
+                    if not memberFilter.matches(info.filename, headBytes):
+                        continue
+                memberPaths.append(joinMemberPath(archivePath, info.filename))
+    except (OSError, zipfile.BadZipFile) as error:
+        logging.warning('Cannot list archive %s: %s', archivePath, error)
+    return memberPaths
+
+def readTarMembers(archivePath, memberFilter):
+    """Read the members of a tar archive that pass the filter in one pass over the archive.
+
+    The archive is streamed, so compressed archives are decompressed only once and nothing is
+    written to disk. Each member is read into memory before the next one.
+
+    Yields
+    ------
+    (string, io.BytesIO)
+        The archive!member path and the content of every member that passes the filter
+    """
+    with tarfile.open(archivePath, mode='r|*') as tarFile:
+        for info in tarFile:
+            if not info.isfile():
+                continue
+            if not memberFilter.matchesName(info.name) and not memberFilter.detectDicom:
+                continue
+            content = tarFile.extractfile(info).read()
+            if memberFilter.matches(info.name, content):
+                yield (joinMemberPath(archivePath, info.name), io.BytesIO(content))
+
+def openMember(filePath):
+    """Open a member of an archive from its archive!member path for reading, without extracting it.
+
+    Zip members are decompressed as they are read. Tar members are looked up in the archive, which
+    for compressed tar archives means decompressing up to the member, so readTarMembers should be
+    used to read all members of a tar archive. The archive is kept open for the next member.
+    """
+    archivePath, memberName = splitMemberPath(filePath)
+    archive = openArchives.pop(archivePath, None)
+    if archive is None:
+        if isZipArchive(archivePath):
+            archive = zipfile.ZipFile(archivePath)
+        else:
+            archive = tarfile.open(archivePath, mode='r:*')
+        while len(openArchives) >= MAX_OPEN_ARCHIVES:
+            openArchives.popitem(last=False)[1].close()
+    openArchives[archivePath] = archive
+
+    if isinstance(archive, zipfile.ZipFile):
+        return archive.open(memberName)
+    fileReader = archive.extractfile(memberName)
+    if fileReader is None:
+        raise OSError('Archive member {0} is not a file'.format(filePath))
+    return fileReader
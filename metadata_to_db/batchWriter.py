@@ -0,0 +1,199 @@
+"""Module contains class for writing records to a PostgreSQL table in batches."""
+import time
+import logging
+import psycopg2
+import psycopg2.errors
+
+class BatchWriter:
+    """Buffers records and writes them to a table in batches, one transaction per batch.
+
+    If a batch fails as a whole, the batch is retried record by record with a savepoint
+    around each record so that only the offending records are dropped.
+
+    If conflictColumns is given, records replace the rows with the same values in those columns.
+    With the update load method, records instead update the columns of existing rows matched on
+    conflictColumns, e.g. to backfill new columns.
+    If manifestTableName is given, the status of the file behind each record is set in the
+    manifest table in the same transaction as the record itself.
+    If statsCollector is given, the column statistics of the stored records are merged into the
+    stats table in the same transaction too.
+    If duplicateFilter is given, a batch with a record whose dedup key might already be stored is
+    written so that the records with stored keys go to the duplicates table instead.
+    If the connection is lost, the batch stays buffered and the error is raised, so that the
+    caller can reconnect and flush again.
+    """
+    def __init__(self, dbHandler, tableName, columnNames, batchSize=1000, loadMethod='copy',
+                 conflictColumns=None, manifestTableName=None, statsCollector=None, duplicateFilter=None):
+        self.dbHandler = dbHandler
+        self.metrics = dbHandler.metrics
+        self.tableName = tableName
+        self.columnNames = list(columnNames)
+        self.batchSize = batchSize
+        self.loadMethod = loadMethod
+        self.conflictColumns = conflictColumns
+        self.manifestTableName = manifestTableName
+        self.statsCollector = statsCollector
+        self.duplicateFilter = duplicateFilter
+
+        self.connection = self.dbHandler.getPooledConnection()
+        self.buffer = []
+        self.bufferFilePaths = []
+        self.bufferHasKnownKey = False
+        self.failedFilePaths = []
+        self.batchCount = 0
+        self.writtenCount = 0
+        self.duplicateCount = 0
+        self.failedRecords = []
+
+    def addRecord(self, record, filePath=None):
+        self.buffer.append(record)
+        self.bufferFilePaths.append(filePath)
+        if self.duplicateFilter is not None and self.duplicateFilter.mightBeDuplicate(record):
+            self.bufferHasKnownKey = True
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def addFailure(self, filePath):
+        """Marks a file that couldn't be turned into a record as failed in the manifest."""
+        if self.manifestTableName is not None:
+            self.failedFilePaths.append(filePath)
+
+    def flush(self):
+        """Writes the buffered records to the table."""
+        if not self.buffer and not self.failedFilePaths:
+            return
+        records = self.buffer
+        filePaths = self.bufferFilePaths
+        deduplicate = self.bufferHasKnownKey
+        self.buffer = []
+        self.bufferFilePaths = []
+        self.bufferHasKnownKey = False
+        self.batchCount += 1
+
+        start = time.perf_counter()
+        try:
+            try:
+                self.writeBatch(records, filePaths, deduplicate)
+            except (psycopg2.DatabaseError, psycopg2.InterfaceError) as error:
+                self.metrics.countError('write', type(error).__name__)
+                if self.connection.closed:
+                    raise
+                self.connection.rollback()
+                logging.warning('Batch %d failed, retrying record by record: %s', self.batchCount, error)
+                self.writeRecordsIndividually(records, filePaths)
+        except (psycopg2.DatabaseError, psycopg2.InterfaceError):
+            # A write on a lost connection raises OperationalError, one on a closed connection InterfaceError
+            if self.connection.closed:
+                self.buffer = records + self.buffer
+                self.bufferFilePaths = filePaths + self.bufferFilePaths
+                self.bufferHasKnownKey = self.bufferHasKnownKey or deduplicate
+            raise
+        finally:
+            self.metrics.addStageTime('write', time.perf_counter() - start)
+
+    def writeBatch(self, records, filePaths, deduplicate):
+        """Writes a batch of records and the status of their files in one transaction."""
+        try:
+            storedRecords = self.writeRecords(records, deduplicate)
+        except (psycopg2.errors.UniqueViolation):
+            if self.duplicateFilter is None or deduplicate:
+                raise
+            # Another process stored one of the keys since the Bloom filter was loaded
+            self.connection.rollback()
+            storedRecords = self.writeRecords(records, True)
+        self.writeStats(storedRecords)
+        self.writeManifestStatus([(filePath, 'done') for filePath in filePaths])
+        self.connection.commit()
+        self.countStored(len(storedRecords), len(records) - len(storedRecords))
+        logging.debug('Batch %d: stored %d records', self.batchCount, len(storedRecords))
+
+    def close(self):
+        """Writes any buffered records and hands the connection back to the pool."""
+        try:
+            self.flush()
+        finally:
+            self.dbHandler.returnPooledConnection(self.connection, close=bool(self.connection.closed))
+        logging.info('Stored %d records in %d batches, %d records failed',
+                     self.writtenCount, self.batchCount, len(self.failedRecords))
+        if self.duplicateFilter is not None:
+            logging.info('%d records were duplicates, listed in %s', self.duplicateCount, self.duplicateFilter.duplicatesTableName)
+
+    def reconnect(self):
+        """Swap the connection for another one from the pool, the lost one is closed.
+
+        If no connection can be opened, the error is raised and the lost one is kept until
+        reconnect is called again, so that it is handed back to the pool only once.
+        """
+        connection = self.dbHandler.getPooledConnection()
+        self.dbHandler.returnPooledConnection(self.connection, close=True)
+        self.connection = connection
+
+    def countStored(self, storedCount, duplicateCount):
+        self.writtenCount += storedCount
+        self.duplicateCount += duplicateCount
+        self.metrics.countWritten(storedCount)
+
+    def writeRecords(self, records, deduplicate=False):
+        """Writes records to the table, returns the ones that were stored rather than left out as duplicates."""
+        if not records:
+            return records
+        if deduplicate:
+            duplicatePaths = set(self.dbHandler.copyDeduplicatedRecords(self.connection, self.tableName, self.columnNames, records,
+                                                                        self.duplicateFilter.keyColumn,
+                                                                        self.duplicateFilter.duplicatesTableName,
+                                                                        self.conflictColumns))
+            filePathIndex = self.columnNames.index('file_path')
+            return [record for record in records if record[filePathIndex] not in duplicatePaths]
+        if self.loadMethod == 'copy':
+            self.dbHandler.copyRecords(self.connection, self.tableName, self.columnNames, records, self.conflictColumns)
+        elif self.loadMethod == 'values':
+            self.dbHandler.insertRecords(self.connection, self.tableName, self.columnNames, records, self.conflictColumns)
+        elif self.loadMethod == 'update':
+            self.dbHandler.updateRecords(self.connection, self.tableName, self.columnNames, records, self.conflictColumns)
+        else:
+            raise Exception('Unknown load method: {0}'.format(self.loadMethod))
+        return records
+
+    def writeManifestStatus(self, fileStatuses):
+        if self.manifestTableName is None:
+            return
+        # Several records can come from the same file, e.g. a tar archive, which failed if any of them failed
+        statuses = {}
+        for filePath, status in fileStatuses + [(filePath, 'failed') for filePath in self.failedFilePaths]:
+            if statuses.get(filePath) != 'failed':
+                statuses[filePath] = status
+        if statuses:
+            self.dbHandler.setManifestStatus(self.connection, self.manifestTableName, list(statuses.items()))
+        self.failedFilePaths = []
+
+    def writeStats(self, records):
+        if self.statsCollector is not None:
+            self.statsCollector.store(self.dbHandler, self.connection, records)
+
+    def writeRecordsIndividually(self, records, filePaths):
+        cursor = self.connection.cursor()
+        failedCount = 0
+        fileStatuses = []
+        storedRecords = []
+        for record, filePath in zip(records, filePaths):
+            cursor.execute('SAVEPOINT batch_record;')
+            try:
+                if self.loadMethod == 'update' or self.duplicateFilter is not None:
+                    storedRecords.extend(self.writeRecords([record], self.duplicateFilter is not None))
+                else:
+                    self.dbHandler.insertRecords(self.connection, self.tableName, self.columnNames, [record], self.conflictColumns)
+                    storedRecords.append(record)
+                cursor.execute('RELEASE SAVEPOINT batch_record;')
+                fileStatuses.append((filePath, 'done'))
+            except (psycopg2.DatabaseError) as error:
+                cursor.execute('ROLLBACK TO SAVEPOINT batch_record;')
+                logging.warning('Batch %d: record %s not stored: %s', self.batchCount, record[0], error)
+                self.failedRecords.append((record, str(error).strip()))
+                self.metrics.countError('write', type(error).__name__)
+                fileStatuses.append((filePath, 'failed'))
+                failedCount += 1
+        cursor.close()
+        self.writeStats(storedRecords)
+        self.writeManifestStatus(fileStatuses)
+        self.connection.commit()
+        self.countStored(len(storedRecords), len(records) - failedCount - len(storedRecords))
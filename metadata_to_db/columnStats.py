@@ -0,0 +1,166 @@
+"""Module contains classes for keeping statistics of the columns of a table while records are loaded into it.
+
+The statistics of every batch are merged into a stats table next to the data, so that the null
+rate, range, most frequent values and number of distinct values of a column are a lookup rather
+than a scan of the table. Every statistic can be merged, so batches written by different
+processes, nodes or runs add up to the statistics of the whole table.
+"""
+import math
+import json
+import hashlib
+import numbers
+from collections import Counter
+
+# Number of hash bits that pick a HyperLogLog register, 2^12 registers have a standard error of 1.6%
+HLL_PRECISION = 12
+
+class HyperLogLog:
+    """Approximate count of the distinct values added to it, in a fixed 4 KB of registers.
+
+    Merging two of them gives the count of the distinct values added to either one.
+    """
+    def __init__(self, registers=None):
+        if registers is None:
+            registers = bytes(1 << HLL_PRECISION)
+        self.registers = bytearray(registers)
+
+    def add(self, key):
+        hashValue = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = hashValue >> (64 - HLL_PRECISION)
+        # Position of the first 1 bit in the rest of the hash
+        rank = (64 - HLL_PRECISION) - (hashValue & ((1 << (64 - HLL_PRECISION)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        registerCount = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registerCount)
+        estimate = alpha * registerCount * registerCount / sum(2.0 ** -register for register in self.registers)
+        emptyCount = self.registers.count(0)
+        if estimate <= 2.5 * registerCount and emptyCount:
+            # Few values, counting the empty registers is more accurate
+            estimate = registerCount * math.log(registerCount / emptyCount)
+        return int(round(estimate))
+
+class ColumnStats:
+    """Null count, numeric range, most frequent values and distinct count of a column.
+
+    The most frequent values are kept with the Misra-Gries summary of at most topValueCount
+    values: once there are more, the count of the first value that doesn't fit is subtracted
+    from all of them. Every value in more than 1/topValueCount of the rows is kept, the counts
+    are exact for columns with fewer distinct values and lower bounds otherwise.
+    """
+    def __init__(self, topValueCount=100):
+        self.topValueCount = topValueCount
+        self.rowCount = 0
+        self.nullCount = 0
+        self.minValue = None
+        self.maxValue = None
+        self.topValues = {}
+        self.distinct = HyperLogLog()
+
+    def addValues(self, values):
+        self.rowCount += len(values)
+        counts = Counter()
+        for value in values:
+            if value is None:
+                self.nullCount += 1
+                continue
+            if isinstance(value, numbers.Real) and not isinstance(value, bool):
+                self.addNumber(float(value))
+            counts[toKey(value)] += 1
+        for key in counts:
+            self.distinct.add(key)
+        self.addTopValues(counts)
+
+    def addNumber(self, number):
+        if self.minValue is None or number < self.minValue:
+            self.minValue = number
+        if self.maxValue is None or number > self.maxValue:
+            self.maxValue = number
+
+    def addTopValues(self, counts):
+        merged = Counter(self.topValues)
+        merged.update(counts)
+        if len(merged) > self.topValueCount:
+            cut = sorted(merged.values(), reverse=True)[self.topValueCount]
+            merged = {key: count - cut for key, count in merged.items() if count > cut}
+        self.topValues = dict(merged)
+
+    def merge(self, other):
+        self.rowCount += other.rowCount
+        self.nullCount += other.nullCount
+        for number in (other.minValue, other.maxValue):
+            if number is not None:
+                self.addNumber(number)
+        self.distinct.merge(other.distinct)
+        self.addTopValues(other.topValues)
+
+    def getTopValues(self):
+        """Get the most frequent values as [value, count] pairs, the most frequent first."""
+        return [[key, count] for key, count in sorted(self.topValues.items(), key=lambda item: (-item[1], item[0]))]
+
+    def toRow(self):
+        """Get the statistics as the values of a stats table row after its table_name and column_name."""
+        return (self.rowCount, self.nullCount, self.minValue, self.maxValue, self.distinct.count(),
+                json.dumps(self.getTopValues()), bytes(self.distinct.registers))
+
+    @classmethod
+    def fromRow(cls, row, topValueCount=100):
+        """Create the statistics from the values of toRow, e.g. as they were read from the stats table."""
+        stats = cls(topValueCount)
+        stats.rowCount, stats.nullCount, stats.minValue, stats.maxValue, _, topValues, registers = row
+        if isinstance(topValues, str):
+            topValues = json.loads(topValues)
+        stats.topValues = {key: count for key, count in topValues or []}
+        if registers is not None:
+            stats.distinct = HyperLogLog(registers)
+        return stats
+
+class StatsCollector:
+    """Collects the statistics of some columns of the records written to a table and merges them into the stats table.
+
+    recordColumnNames are the columns of the records in order, statsColumnNames the ones that get
+    statistics. The statistics are kept under tableName, which can differ from the table the
+    records are written to, e.g. during a fast load.
+    """
+    def __init__(self, statsTableName, tableName, recordColumnNames, statsColumnNames, topValueCount=100):
+        self.statsTableName = statsTableName
+        self.tableName = tableName
+        self.columnNames = list(statsColumnNames)
+        self.columnIndexes = [list(recordColumnNames).index(columnName) for columnName in self.columnNames]
+        self.topValueCount = topValueCount
+
+    def collect(self, records):
+        """Get the statistics of a batch of records, by column name."""
+        columnStats = {}
+        for columnName, index in zip(self.columnNames, self.columnIndexes):
+            stats = ColumnStats(self.topValueCount)
+            stats.addValues([record[index] for record in records])
+            columnStats[columnName] = stats
+        return columnStats
+
+    def store(self, dbHandler, connection, records):
+        """Merge the statistics of a batch of records into the stats table, in the transaction open on connection.
+
+        The rows of the columns are locked while they are merged, so that writers of the same
+        table in other processes wait for each other instead of losing each other's statistics.
+        """
+        if not records:
+            return
+        columnStats = self.collect(records)
+        storedRows = dbHandler.lockColumnStats(connection, self.statsTableName, self.tableName, self.columnNames)
+        for columnName, row in storedRows.items():
+            if columnName in columnStats:
+                columnStats[columnName].merge(ColumnStats.fromRow(row, self.topValueCount))
+        dbHandler.writeColumnStats(connection, self.statsTableName, self.tableName,
+                                   [(columnName,) + stats.toRow() for columnName, stats in columnStats.items()])
+
+def toKey(value):
+    """Get the text a value is counted by, lists like they are stored in a text column."""
+    if isinstance(value, (list, tuple)):
+        return '\\'.join(str(item) for item in value)
+    return str(value)
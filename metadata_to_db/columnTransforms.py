@@ -0,0 +1,163 @@
+"""Module contains the transforms that turn the columns of a batch of DCMs into the values that are stored.
+
+A transform is declared per element in the column spec, either by name or with the elements
+it is calculated from, e.g. "transform": "integer" or
+"transform": {"name": "age", "from": ["patient_birth_date", "study_date"]}.
+Every transform gets the raw values of one column for a whole batch of DCMs, plus the raw
+columns it is calculated from, and returns the column of values to store.
+"""
+import logging
+import numpy as np
+from pydicom.datadict import dictionary_VR
+from pydicom.multival import MultiValue
+
+# DB datatypes that hold text, multi-valued elements are joined before they're stored in them
+STRING_DATATYPES = ('VARCHAR', 'CHAR', 'TEXT')
+
+def getTransformSpec(elementName, element, elementNames):
+    """Get the transform of an element as {'name': ..., 'from': [...]}.
+
+    Elements without a transform get the one that matches how they used to be stored: DS values
+    as integers, values stored as text joined, patient_age calculated from the birth and study
+    dates, and the value as it is otherwise.
+    """
+    transform = element.get('transform')
+    if transform is None:
+        transform = getDefaultTransform(elementName, element, elementNames)
+    if isinstance(transform, str):
+        transform = {'name': transform}
+    transform = {'name': transform['name'], 'from': list(transform.get('from', []))}
+    if transform['name'] not in TRANSFORMS:
+        raise Exception('Unknown transform {0} of element {1}'.format(transform['name'], elementName))
+    for sourceName in transform['from']:
+        if sourceName not in elementNames:
+            raise Exception('Element {0} is calculated from {1}, which is not in the column spec'.format(elementName, sourceName))
+    return transform
+
+def getDefaultTransform(elementName, element, elementNames):
+    if elementName == 'patient_age' and 'patient_birth_date' in elementNames and 'study_date' in elementNames:
+        return {'name': 'age', 'from': ['patient_birth_date', 'study_date']}
+    [groupNum, elementNum] = element['tag'].split(',')
+    try:
+        vr = dictionary_VR((int(groupNum, 16) << 16) + int(elementNum, 16))
+    except KeyError:
+        return 'raw'
+    if vr == 'DS':
+        return 'integer'
+    if element['db_datatype'].upper().startswith(STRING_DATATYPES):
+        return 'join'
+    return 'raw'
+
+def transformRaw(column, sources):
+    """Store the values as they are, multi-valued elements as lists."""
+    return [list(value) if isinstance(value, MultiValue) else value for value in column]
+
+def transformJoin(column, sources):
+    """Combine multi-valued elements into a string, otherwise they are treated as a list."""
+    return ['\\'.join(str(item) for item in value) if isinstance(value, MultiValue) else value for value in column]
+
+def transformInteger(column, sources):
+    """Store the first value of a DS, IS or numeric string as an integer, truncating it."""
+    numbers = toFloatArray(column)
+    valid = ~np.isnan(numbers)
+    result = np.full(len(column), None, dtype=object)
+    result[valid] = np.trunc(numbers[valid]).astype(np.int64)
+    return result.tolist()
+
+def transformFloat(column, sources):
+    """Store the first value of a DS, IS or numeric string as a float."""
+    numbers = toFloatArray(column)
+    result = numbers.astype(object)
+    result[np.isnan(numbers)] = None
+    return result.tolist()
+
+def transformAge(column, sources):
+    """Keep the age read from the DCM, otherwise calculate the age in years from two DA columns.
+
+    The dates are parsed once per distinct string in the batch and the years between them are
+    counted on whole arrays of datetime64.
+    """
+    result = list(column)
+    missing = [index for index, value in enumerate(result) if value is None or value == '']
+    if not missing or len(sources) != 2:
+        return result
+    logging.debug('Calculating the patient age (0x0010, 0x1010) of {0} DCMs'.format(len(missing)))
+
+    birthDates = toDateArray([sources[0][index] for index in missing])
+    studyDates = toDateArray([sources[1][index] for index in missing])
+    ages = yearsBetween(birthDates, studyDates)
+    known = ~(np.isnat(birthDates) | np.isnat(studyDates))
+    for index, age, isKnown in zip(missing, ages.tolist(), known.tolist()):
+        if isKnown:
+            result[index] = age
+    return result
+
+TRANSFORMS = {
+    'raw': transformRaw,
+    'join': transformJoin,
+    'integer': transformInteger,
+    'float': transformFloat,
+    'age': transformAge,
+}
+
+def toFloatArray(column):
+    """Get the first value of every element as a float64 array, NaN where there is no number."""
+    values = [firstValue(value) for value in column]
+    try:
+        return np.array(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        # Some value isn't a number, only those are left out
+        return np.array([parseFloat(value) for value in values], dtype=np.float64)
+
+def firstValue(value):
+    if isinstance(value, (MultiValue, list)):
+        value = value[0] if len(value) else None
+    if isinstance(value, str):
+        value = value.strip() or None
+    return value
+
+def parseFloat(value):
+    try:
+        return np.nan if value is None else float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+def toDateArray(column):
+    """Parse DA values into a datetime64[D] array, NaT where there is no valid date.
+
+    Every distinct string is parsed once, which is cheap since a batch has few distinct dates.
+    """
+    strings = np.array([str(value).strip().replace('.', '') if value else '' for value in column])
+    uniqueStrings, inverse = np.unique(strings, return_inverse=True)
+    uniqueDates = np.array([parseDate(string) for string in uniqueStrings], dtype='datetime64[D]')
+    return uniqueDates[inverse]
+
+def parseDate(string):
+    if len(string) < 8 or not string[:8].isdigit():
+        return np.datetime64('NaT')
+    try:
+        return np.datetime64(string[:4] + '-' + string[4:6] + '-' + string[6:8], 'D')
+    except ValueError:
+        return np.datetime64('NaT')
+
+def yearsBetween(startDates, endDates):
+    """Count the whole years between two datetime64[D] arrays, like relativedelta(end, start).years."""
+    # relativedelta counts backwards from the later date, so the years are truncated towards zero
+    backwards = endDates < startDates
+    startDates, endDates = np.where(backwards, endDates, startDates), np.where(backwards, startDates, endDates)
+    startYears, startMonths, startDays = splitDates(startDates)
+    endYears, endMonths, endDays = splitDates(endDates)
+    # Counting forwards, a birthday on a day that the end month doesn't have, i.e. Feb 29, is on its last day
+    startDays = np.where(backwards, startDays, np.minimum(startDays, getMonthLengths(endDates)))
+    beforeBirthday = (endMonths < startMonths) | ((endMonths == startMonths) & (endDays < startDays))
+    years = endYears - startYears - beforeBirthday.astype(np.int64)
+    return np.where(backwards, -years, years)
+
+def splitDates(dates):
+    months = dates.astype('datetime64[M]')
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    return (years, months.astype(np.int64) % 12 + 1, (dates - months).astype(np.int64) + 1)
+
+def getMonthLengths(dates):
+    months = dates.astype('datetime64[M]')
+    return ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
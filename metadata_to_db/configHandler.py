@@ -46,7 +46,23 @@ class ConfigHandler:
     def getSetting(self, sectionName, settingName):
         return self.getSection(sectionName)[settingName]
 
+    def getBooleanSetting(self, sectionName, settingName):
+        return self.parser.getboolean(sectionName, settingName)
+
+    def hasSetting(self, sectionName, settingName):
+        return self.parser.has_option(sectionName, settingName)
+
     def setSetting(self, sectionName, settingName, value):
+        """Set a setting and write the config file, unless the setting already has that value."""
+        if self.fillSetting(sectionName, settingName, value):
+            self.writeConfigFile()
+
+    def fillSetting(self, sectionName, settingName, value):
+        """Set a setting without writing the config file, returns whether its value changed."""
+        if not self.parser.has_section(sectionName):
+            self.parser.add_section(sectionName)
+        if self.parser.get(sectionName, settingName, raw=True, fallback=None) == value:
+            return False
         self.parser[sectionName][settingName] = value
-        self.writeConfigFile()
+        return True
 
@@ -1,12 +1,18 @@
 """Module contains class for handling PostgreSQL DB."""
 import os
+import io
 import sys
 import json
 import logging
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 import atexit
+from ingestMetrics import NullMetrics
+
+# Index methods that can be used in the indexes section of the column spec
+INDEX_METHODS = ('btree', 'hash', 'gin')
 
 class DatabaseHandler:
     def __init__(self, configHandler):
@@ -21,28 +27,84 @@ class DatabaseHandler:
 
         # Open cursor to the server specified in the config file
         self.connection = self.openConnection()
+        self.connectionPool = None
+        # Timers and counters of the ingest run that uses this handler, set by the ingest
+        self.metrics = NullMetrics()
         atexit.register(self.closeAllConnections)
 
     def closeAllConnections(self):
         self.closeConnection(self.defaultConnection)
         self.closeConnection(self.connection)
+        if self.connectionPool is not None:
+            logging.info('Closing connection pool')
+            self.connectionPool.closeall()
+            self.connectionPool = None
 
-    def openConnection(self, openDefault=False):
+    def openConnection(self, openDefault=False, autocommit=True):
         """Opens a connection to DB.
         
         Parameters
         ----------
         openDefault : bool
             Open a connection to the DB named postgres, otherwise to the DB specified in config file
+        autocommit : bool
+            Commit every statement as it runs, otherwise the caller manages the transactions
         """
         params = self.dbInfo.copy()
         if openDefault:
             params['database'] = 'postgres'
         logging.info("Opening connection to DB: %s", params['database'])
         connection = psycopg2.connect(**params)
-        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        if autocommit:
+            connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        return connection
+
+    def getPooledConnection(self):
+        """Gets a connection to the DB specified in config file from the pool, in transaction mode.
+
+        The pool is opened on first use and shared for the rest of the run, so that writers don't
+        pay for a new connection each time. Hand the connection back with releasePooledConnection
+        or returnPooledConnection.
+        """
+        if self.connectionPool is None:
+            logging.info("Opening connection pool to DB: %s", self.dbInfo['database'])
+            self.connectionPool = psycopg2.pool.ThreadedConnectionPool(1, self.configHandler.getPoolSize(), **self.dbInfo)
+        connection = self.connectionPool.getconn()
+        connection.autocommit = False
         return connection
 
+    def returnPooledConnection(self, connection, close=False):
+        """Hands a connection back to the pool, closing it if close is set, e.g. because it was lost."""
+        if self.connectionPool is not None:
+            self.connectionPool.putconn(connection, close=close)
+
+    def releasePooledConnection(self, connection, cursor=None):
+        """Closes the cursor, rolls back what is left of the transaction and hands the connection back to the pool.
+
+        A connection that was lost can't be rolled back and is closed instead of handed back, so
+        that it doesn't keep a slot of the pool. The pool opens a new one when it's needed.
+        """
+        lost = bool(connection.closed)
+        try:
+            if cursor is not None and not lost:
+                cursor.close()
+            if not lost:
+                connection.rollback()
+        except (psycopg2.Error) as error:
+            logging.warning('Cannot roll back the transaction, closing the connection: %s', error)
+            lost = True
+        finally:
+            self.returnPooledConnection(connection, close=lost or bool(connection.closed))
+
+    def reconnect(self):
+        """Opens a new connection to the DB specified in config file in place of the one that was lost."""
+        logging.warning('Reconnecting to DB: %s', self.dbInfo['database'])
+        try:
+            self.connection.close()
+        except (psycopg2.Error):
+            pass
+        self.connection = self.openConnection()
+
     def closeConnection(self, connection):
         logging.info('Closing connection')
         if connection is not None:
@@ -100,7 +162,14 @@ class DatabaseHandler:
         self.executeQuery(self.connection, 'DROP TABLE ' + tableName + ';')
         logging.info("Dropped table: %s", tableName)
 
-    def addTableToDb(self, tableName, columnsInfoPath, nonElementSectionName, elementSectionName):
+    def addTableToDb(self, tableName, columnsInfoPath, nonElementSectionName, elementSectionName,
+                     indexSectionName=None, fastLoad=False):
+        """Adds a table with a column per non-element column and stored element of the column spec.
+
+        The indexes in the indexSectionName section of the column spec are created with the table.
+        With fastLoad the table is created UNLOGGED and without its primary key or indexes, so that
+        a bulk load neither writes WAL nor updates an index per row. finishFastLoad builds the rest.
+        """
         logging.info('Attempting to add table')
 
         # Open the json with the list of columns we're interested in
@@ -108,11 +177,15 @@ class DatabaseHandler:
             columnsInfo = json.load(fileReader)
         
         # Make the SQL query
-        sqlQuery = 'CREATE TABLE \"' + tableName + '\" ('
+        sqlQuery = 'CREATE UNLOGGED TABLE \"' if fastLoad else 'CREATE TABLE \"'
+        sqlQuery = sqlQuery + tableName + '\" ('
 
         nonElementsColumns = columnsInfo[nonElementSectionName]
         for columnName in nonElementsColumns:
-            sqlQuery = sqlQuery + "\"" + columnName + '\" ' + nonElementsColumns[columnName]['db_datatype'] + " " + nonElementsColumns[columnName]['constraints'] + ','
+            constraints = nonElementsColumns[columnName]['constraints']
+            if fastLoad:
+                constraints = removePrimaryKey(constraints)
+            sqlQuery = sqlQuery + "\"" + columnName + '\" ' + nonElementsColumns[columnName]['db_datatype'] + " " + constraints + ','
 
         elementColumns = columnsInfo[elementSectionName]
         for columnName in elementColumns:
@@ -121,8 +194,148 @@ class DatabaseHandler:
 
         sqlQuery = sqlQuery[:-1] + ');'
         self.executeQuery(self.connection, sqlQuery)
+        if indexSectionName is not None and not fastLoad:
+            self.addIndexes(tableName, columnsInfo.get(indexSectionName, {}))
         self.tableExists(tableName)
 
+    def startFastLoad(self, tableName, columnsInfoPath, nonElementSectionName, elementSectionName):
+        """Creates the table that a bulk load goes into, returns its name.
+
+        If the table already exists, the load goes into a new table next to it that replaces it
+        in finishFastLoad, so the existing table stays queryable while the load runs.
+        """
+        loadTableName = tableName
+        if self.tableExists(tableName):
+            loadTableName = tableName + '_load'
+            if self.tableExists(loadTableName):
+                # Left over from a load that didn't finish
+                self.dropTable(loadTableName)
+        logging.info('Fast loading into table: %s', loadTableName)
+        self.addTableToDb(loadTableName, columnsInfoPath, nonElementSectionName, elementSectionName, fastLoad=True)
+        return loadTableName
+
+    def finishFastLoad(self, loadTableName, tableName, columnsInfoPath, nonElementSectionName, indexSectionName,
+                       extraIndexes=None):
+        """Builds the primary key and indexes of a fast-loaded table, analyzes it and makes it LOGGED.
+
+        The indexes are taken from the indexSectionName section of the column spec, which maps an
+        index name to its columns and method (btree, hash or gin), and from extraIndexes, which
+        has the same form. If the load went into a table
+        next to an existing one, the loaded table then replaces the existing one in one transaction.
+        If the primary key can't be built, e.g. because of duplicate keys, the error is raised and
+        an existing table is left as it was.
+        """
+        with open(columnsInfoPath) as fileReader:
+            columnsInfo = json.load(fileReader)
+        nonElementColumns = columnsInfo[nonElementSectionName]
+        primaryKeyColumns = [columnName for columnName in nonElementColumns
+                             if 'PRIMARY KEY' in nonElementColumns[columnName]['constraints'].upper()]
+        indexes = dict(columnsInfo.get(indexSectionName, {}), **(extraIndexes or {}))
+
+        connection = self.getPooledConnection()
+        cursor = connection.cursor()
+        try:
+            if primaryKeyColumns:
+                logging.info('Building the primary key of %s', loadTableName)
+                cursor.execute('ALTER TABLE \"' + loadTableName + '\" ADD CONSTRAINT \"' + loadTableName + '_pkey\" '
+                               + 'PRIMARY KEY (' + columnList(primaryKeyColumns) + ');')
+            for indexName, index in indexes.items():
+                logging.info('Building index %s of %s', indexName, loadTableName)
+                cursor.execute(createIndexQuery(loadTableName, indexName, index))
+            cursor.execute('ANALYZE \"' + loadTableName + '\";')
+            cursor.execute('ALTER TABLE \"' + loadTableName + '\" SET LOGGED;')
+            connection.commit()
+
+            if loadTableName != tableName:
+                logging.info('Replacing table %s with %s', tableName, loadTableName)
+                cursor.execute('DROP TABLE \"' + tableName + '\";')
+                cursor.execute('ALTER TABLE \"' + loadTableName + '\" RENAME TO \"' + tableName + '\";')
+                if primaryKeyColumns:
+                    cursor.execute('ALTER TABLE \"' + tableName + '\" RENAME CONSTRAINT \"' + loadTableName + '_pkey\" '
+                                   + 'TO \"' + tableName + '_pkey\";')
+                for indexName in indexes:
+                    cursor.execute('ALTER INDEX \"' + loadTableName + '_' + indexName + '\" '
+                                   + 'RENAME TO \"' + tableName + '_' + indexName + '\";')
+                connection.commit()
+        finally:
+            self.releasePooledConnection(connection, cursor)
+        logging.info('Finished fast load of table: %s', tableName)
+
+    def getTablePrimaryKey(self, tableName):
+        """Gets the name of the primary key constraint of a table and its columns, (None, []) if it has none."""
+        sqlQuery = 'SELECT c.conname, a.attname FROM pg_constraint c ' \
+            + 'JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) ' \
+            + 'WHERE c.conrelid = %s::regclass AND c.contype = \'p\' ORDER BY array_position(c.conkey, a.attnum);'
+        rows = self.executeQuery(self.connection, sqlQuery, ('\"' + tableName + '\"',)).fetchall()
+        if not rows:
+            return None, []
+        return rows[0][0], [row[1] for row in rows]
+
+    def replacePrimaryKey(self, tableName, constraintName, columnNames):
+        """Moves the primary key of a table to other columns in one transaction.
+
+        If the new key can't be built, e.g. because of duplicate values, the error is raised and
+        the table keeps its old key.
+        """
+        connection = self.getPooledConnection()
+        cursor = connection.cursor()
+        try:
+            if constraintName is not None:
+                cursor.execute('ALTER TABLE \"' + tableName + '\" DROP CONSTRAINT \"' + constraintName + '\";')
+            cursor.execute('ALTER TABLE \"' + tableName + '\" ADD CONSTRAINT \"' + tableName + '_pkey\" '
+                           + 'PRIMARY KEY (' + columnList(columnNames) + ');')
+            connection.commit()
+        finally:
+            self.releasePooledConnection(connection, cursor)
+
+    def getTableColumns(self, tableName):
+        """Gets the names of the columns of a table."""
+        sqlQuery = 'SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position;'
+        return [row[0] for row in self.executeQuery(self.connection, sqlQuery, (tableName,)).fetchall()]
+
+    def addColumns(self, tableName, columns):
+        """Adds columns to a table if it doesn't have them yet, given as a list of (column name, DB datatype)."""
+        logging.info('Adding columns to table %s: %s', tableName, ', '.join(name for name, _ in columns))
+        sqlQuery = 'ALTER TABLE \"' + tableName + '\" ' \
+            + ', '.join('ADD COLUMN IF NOT EXISTS \"' + name + '\" ' + datatype for name, datatype in columns) + ';'
+        self.executeQuery(self.connection, sqlQuery)
+
+    def addIndexes(self, tableName, indexes):
+        """Adds the indexes to a table that it doesn't have yet, given in the form of the indexes section of the column spec."""
+        for indexName, index in indexes.items():
+            self.executeQuery(self.connection, createIndexQuery(tableName, indexName, index))
+
+    def buildIndexes(self, tableName, indexes):
+        """Adds the indexes to a table that it doesn't have yet like addIndexes, but raises if one can't be built.
+
+        Used for the indexes the ingest relies on, e.g. a unique index that ON CONFLICT needs.
+        """
+        connection = self.getPooledConnection()
+        cursor = connection.cursor()
+        try:
+            for indexName, index in indexes.items():
+                cursor.execute(createIndexQuery(tableName, indexName, index))
+            connection.commit()
+        finally:
+            self.releasePooledConnection(connection, cursor)
+
+    def getColumnValues(self, tableName, columnName):
+        """Gets the values of one column of a table, e.g. the file paths of its records."""
+        sqlQuery = 'SELECT \"' + columnName + '\" FROM \"' + tableName + '\";'
+        return [row[0] for row in self.executeQuery(self.connection, sqlQuery).fetchall()]
+
+    def streamColumnValues(self, tableName, columnName, batchSize=10000):
+        """Yields the values of one column of a table, fetched in batches through a server-side cursor."""
+        connection = self.getPooledConnection()
+        cursor = connection.cursor(name='stream_' + tableName + '_' + columnName)
+        cursor.itersize = batchSize
+        try:
+            cursor.execute('SELECT "' + columnName + '" FROM "' + tableName + '";')
+            for row in cursor:
+                yield row[0]
+        finally:
+            self.releasePooledConnection(connection, cursor)
+
     def createNewDb(self, dbName):
         logging.info('Attempting to create a new DB')
         self.executeQuery(self.defaultConnection, 'CREATE DATABASE \"' + dbName + '\";')
@@ -143,4 +356,378 @@ class DatabaseHandler:
                 cursor.execute(query, values)
         except (psycopg2.DatabaseError) as error:
             logging.warning(error)
-        return cursor
\ No newline at end of file
+        return cursor
+
+    def copyRecords(self, connection, tableName, columnNames, records, conflictColumns=None):
+        """Streams records into a table using COPY ... FROM STDIN.
+
+        If conflictColumns is given, the records are copied into a temporary staging table and
+        upserted from there, replacing the rows that have the same values in conflictColumns.
+        Errors are raised rather than logged so that the caller can roll back the transaction.
+        """
+        buffer = copyBuffer(records)
+        cursor = connection.cursor()
+        try:
+            if conflictColumns:
+                stagingTableName = 'staged_' + tableName
+                cursor.execute('CREATE TEMP TABLE IF NOT EXISTS \"' + stagingTableName + '\" (LIKE \"' + tableName + '\");')
+                cursor.copy_expert('COPY \"' + stagingTableName + '\" (' + columnList(columnNames) + ') FROM STDIN;', buffer)
+                cursor.execute('INSERT INTO \"' + tableName + '\" (' + columnList(columnNames) + ') SELECT ' + columnList(columnNames)
+                               + ' FROM \"' + stagingTableName + '\" ' + upsertClause(columnNames, conflictColumns) + ';')
+                cursor.execute('TRUNCATE \"' + stagingTableName + '\";')
+            else:
+                cursor.copy_expert('COPY \"' + tableName + '\" (' + columnList(columnNames) + ') FROM STDIN;', buffer)
+        finally:
+            cursor.close()
+
+    def updateRecords(self, connection, tableName, columnNames, records, keyColumns):
+        """Updates the rows of a table that have the keys of the records, in one set-based UPDATE.
+
+        The records are copied into a temporary staging table that has the columns in columnNames,
+        keyColumns among them, and the table is updated from there with UPDATE ... FROM.
+        Errors are raised rather than logged so that the caller can roll back the transaction.
+        """
+        stagingTableName = 'updates_' + tableName
+        updates = ['\"' + name + '\" = s.\"' + name + '\"' for name in columnNames if name not in keyColumns]
+        matches = ['t.\"' + name + '\" = s.\"' + name + '\"' for name in keyColumns]
+        cursor = connection.cursor()
+        try:
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS \"' + stagingTableName + '\" AS SELECT ' + columnList(columnNames)
+                           + ' FROM \"' + tableName + '\" WITH NO DATA;')
+            cursor.copy_expert('COPY \"' + stagingTableName + '\" (' + columnList(columnNames) + ') FROM STDIN;', copyBuffer(records))
+            cursor.execute('UPDATE \"' + tableName + '\" t SET ' + ', '.join(updates) + ' FROM \"' + stagingTableName + '\" s '
+                           + 'WHERE ' + ' AND '.join(matches) + ';')
+            cursor.execute('TRUNCATE \"' + stagingTableName + '\";')
+        finally:
+            cursor.close()
+
+    def copyDeduplicatedRecords(self, connection, tableName, columnNames, records, keyColumn, duplicatesTableName,
+                                conflictColumns=None):
+        """Streams records into a table, leaving out the ones whose key is already stored for another file.
+
+        The records are copied into a temporary staging table and a record is a duplicate if a row
+        of the table or an earlier record of the batch has its key under another file_path. The
+        duplicates are written to the duplicates table with the file_path of the file they duplicate,
+        the rest is inserted like in copyRecords.
+        Errors are raised rather than logged so that the caller can roll back the transaction.
+
+        Returns
+        -------
+        list
+            The file_path of every record that was a duplicate
+        """
+        stagingTableName = 'dedup_' + tableName
+        key = '\"' + keyColumn + '\"'
+        cursor = connection.cursor()
+        try:
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS \"' + stagingTableName + '\" (LIKE \"' + tableName + '\");')
+            cursor.copy_expert('COPY \"' + stagingTableName + '\" (' + columnList(columnNames) + ') FROM STDIN;', copyBuffer(records))
+            cursor.execute('WITH duplicates AS ('
+                           + 'SELECT s.ctid AS row_id, s.' + key + ' AS dedup_key, s.file_path, '
+                           + 'COALESCE(t.file_path, f.file_path) AS original_file_path FROM \"' + stagingTableName + '\" s '
+                           + 'LEFT JOIN \"' + tableName + '\" t ON t.' + key + ' = s.' + key + ' AND t.file_path <> s.file_path '
+                           + 'LEFT JOIN (SELECT DISTINCT ON (' + key + ') ' + key + ', file_path FROM \"' + stagingTableName + '\" '
+                           + 'WHERE ' + key + ' IS NOT NULL ORDER BY ' + key + ', ctid) f '
+                           + 'ON f.' + key + ' = s.' + key + ' AND f.file_path <> s.file_path '
+                           + 'WHERE t.file_path IS NOT NULL OR f.file_path IS NOT NULL), '
+                           + 'recorded AS (INSERT INTO \"' + duplicatesTableName + '\" '
+                           + '(table_name, file_path, dedup_key, original_file_path, found_at) '
+                           + 'SELECT %s, file_path, dedup_key, original_file_path, now() FROM duplicates '
+                           + 'ON CONFLICT (table_name, file_path) DO UPDATE SET dedup_key = EXCLUDED.dedup_key, '
+                           + 'original_file_path = EXCLUDED.original_file_path, found_at = EXCLUDED.found_at) '
+                           + 'DELETE FROM \"' + stagingTableName + '\" s USING duplicates d WHERE s.ctid = d.row_id '
+                           + 'RETURNING s.file_path;', (tableName,))
+            duplicatePaths = [row[0] for row in cursor.fetchall()]
+            sqlQuery = 'INSERT INTO \"' + tableName + '\" (' + columnList(columnNames) + ') SELECT ' + columnList(columnNames) \
+                + ' FROM \"' + stagingTableName + '\"'
+            if conflictColumns:
+                sqlQuery = sqlQuery + ' ' + upsertClause(columnNames, conflictColumns)
+            cursor.execute(sqlQuery + ';')
+            cursor.execute('TRUNCATE \"' + stagingTableName + '\";')
+        finally:
+            cursor.close()
+        return duplicatePaths
+
+    def insertRecords(self, connection, tableName, columnNames, records, conflictColumns=None):
+        """Inserts records into a table using multi-row INSERT statements.
+
+        If conflictColumns is given, the rows that have the same values in conflictColumns are replaced.
+        Errors are raised rather than logged so that the caller can roll back the transaction.
+        """
+        sqlQuery = 'INSERT INTO \"' + tableName + '\" (' + columnList(columnNames) + ') VALUES %s'
+        if conflictColumns:
+            sqlQuery = sqlQuery + ' ' + upsertClause(columnNames, conflictColumns)
+        cursor = connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, sqlQuery + ';', records)
+        finally:
+            cursor.close()
+
+    def addManifestTableToDb(self, tableName):
+        """Adds the table that keeps track of which files have been stored, if it isn't there yet."""
+        logging.info('Attempting to add manifest table')
+        sqlQuery = 'CREATE TABLE IF NOT EXISTS \"' + tableName + '\" (' \
+            + 'file_path TEXT PRIMARY KEY, file_size BIGINT, file_mtime_ns BIGINT, ingested_at TIMESTAMP, status VARCHAR(16));'
+        self.executeQuery(self.connection, sqlQuery)
+
+    def findChangedFiles(self, manifestTableName, fileStats):
+        """Finds the files that still need to be stored and marks them as pending in the manifest.
+
+        A file needs to be stored if it isn't in the manifest, if its size or modification time changed
+        or if a previous run didn't finish storing it. The comparison is done by the DB in one query.
+
+        Parameters
+        ----------
+        manifestTableName : string
+            Name of the manifest table
+        fileStats : list
+            (file_path, file_size, file_mtime_ns) of every file that was found
+
+        Returns
+        -------
+        list
+            The file_path of every file that needs to be stored
+        """
+        columnNames = ['file_path', 'file_size', 'file_mtime_ns']
+        connection = self.getPooledConnection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('CREATE TEMP TABLE found_files (file_path TEXT PRIMARY KEY, file_size BIGINT, file_mtime_ns BIGINT) ON COMMIT DROP;')
+            self.copyRecords(connection, 'found_files', columnNames, fileStats)
+            cursor.execute('INSERT INTO \"' + manifestTableName + '\" (file_path, file_size, file_mtime_ns, status) '
+                           + 'SELECT f.file_path, f.file_size, f.file_mtime_ns, \'pending\' FROM found_files f '
+                           + 'LEFT JOIN \"' + manifestTableName + '\" m ON m.file_path = f.file_path '
+                           + 'WHERE m.file_path IS NULL OR m.status <> \'done\' '
+                           + 'OR m.file_size <> f.file_size OR m.file_mtime_ns <> f.file_mtime_ns '
+                           + upsertClause(columnNames + ['status'], ['file_path']) + ' RETURNING file_path;')
+            changedFiles = [row[0] for row in cursor.fetchall()]
+            connection.commit()
+        finally:
+            self.releasePooledConnection(connection, cursor)
+        return changedFiles
+
+    def setManifestStatus(self, connection, manifestTableName, fileStatuses):
+        """Sets the status of files in the manifest, as part of the transaction open on connection.
+
+        Errors are raised rather than logged so that the caller can roll back the transaction.
+        """
+        sqlQuery = 'UPDATE \"' + manifestTableName + '\" m SET status = v.status, ingested_at = now() ' \
+            + 'FROM (VALUES %s) AS v (file_path, status) WHERE m.file_path = v.file_path;'
+        cursor = connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, sqlQuery, fileStatuses)
+        finally:
+            cursor.close()
+
+    def addWorkQueueTableToDb(self, tableName):
+        """Adds the table that workers on several nodes claim chunks of files from, if it isn't there yet."""
+        logging.info('Attempting to add work queue table')
+        sqlQuery = 'CREATE TABLE IF NOT EXISTS \"' + tableName + '\" (' \
+            + 'chunk_id BIGSERIAL PRIMARY KEY, file_paths TEXT[], status VARCHAR(16) DEFAULT \'pending\', ' \
+            + 'worker_id TEXT, attempts INT DEFAULT 0, claimed_at TIMESTAMP, heartbeat_at TIMESTAMP, finished_at TIMESTAMP);'
+        self.executeQuery(self.connection, sqlQuery)
+
+    def tryLockWorkQueue(self, queueTableName):
+        """Tries to take the lock that the process filling the work queue holds, returns whether it got it.
+
+        The lock belongs to the session of the main connection until unlockWorkQueue is called.
+        """
+        sqlQuery = 'SELECT pg_try_advisory_lock(hashtext(%s));'
+        return self.executeQuery(self.connection, sqlQuery, (queueTableName,)).fetchone()[0]
+
+    def unlockWorkQueue(self, queueTableName):
+        self.executeQuery(self.connection, 'SELECT pg_advisory_unlock(hashtext(%s));', (queueTableName,))
+
+    def isWorkQueueFilling(self, queueTableName):
+        """Checks if another process holds the lock of the work queue, i.e. is still filling it."""
+        if not self.tryLockWorkQueue(queueTableName):
+            return True
+        self.unlockWorkQueue(queueTableName)
+        return False
+
+    def enqueueChunks(self, queueTableName, chunks):
+        """Adds chunks of file paths to the work queue, every chunk is a list of file paths."""
+        cursor = self.connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, 'INSERT INTO \"' + queueTableName + '\" (file_paths) VALUES %s;',
+                                           [(list(chunk),) for chunk in chunks])
+        finally:
+            cursor.close()
+
+    def claimChunk(self, queueTableName, workerId, staleSeconds, maxAttempts):
+        """Claims the next chunk of the work queue that is pending or whose worker stopped sending heartbeats.
+
+        The chunk is picked with FOR UPDATE SKIP LOCKED, so workers claiming at the same time never
+        wait on each other or get the same chunk. Chunks that were claimed maxAttempts times without
+        finishing are marked as failed instead of being claimed again.
+
+        Returns
+        -------
+        (int, list) or None
+            The chunk_id and file paths of the claimed chunk, None if there is no chunk to claim
+        """
+        stale = 'status = \'claimed\' AND heartbeat_at < now() - make_interval(secs => %s)'
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('UPDATE \"' + queueTableName + '\" SET status = \'failed\', finished_at = now() '
+                           + 'WHERE ' + stale + ' AND attempts >= %s;', (staleSeconds, maxAttempts))
+            cursor.execute('UPDATE \"' + queueTableName + '\" SET status = \'claimed\', worker_id = %s, attempts = attempts + 1, '
+                           + 'claimed_at = now(), heartbeat_at = now() WHERE chunk_id = ('
+                           + 'SELECT chunk_id FROM \"' + queueTableName + '\" WHERE status = \'pending\' OR (' + stale + ') '
+                           + 'ORDER BY chunk_id LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING chunk_id, file_paths;',
+                           (workerId, staleSeconds))
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def heartbeatChunks(self, connection, queueTableName, workerId):
+        """Marks the chunks a worker has claimed as still being worked on."""
+        sqlQuery = 'UPDATE \"' + queueTableName + '\" SET heartbeat_at = now() WHERE worker_id = %s AND status = \'claimed\';'
+        self.executeQuery(connection, sqlQuery, (workerId,))
+
+    def finishChunk(self, queueTableName, chunkId, workerId):
+        """Marks a chunk as done, returns False if it was reclaimed by another worker in the meantime."""
+        sqlQuery = 'UPDATE \"' + queueTableName + '\" SET status = \'done\', finished_at = now() ' \
+            + 'WHERE chunk_id = %s AND worker_id = %s AND status = \'claimed\';'
+        return self.executeQuery(self.connection, sqlQuery, (chunkId, workerId)).rowcount == 1
+
+    def countUnfinishedChunks(self, queueTableName):
+        sqlQuery = 'SELECT COUNT(*) FROM \"' + queueTableName + '\" WHERE status IN (\'pending\', \'claimed\');'
+        return self.executeQuery(self.connection, sqlQuery).fetchone()[0]
+
+    def addDuplicatesTableToDb(self, tableName):
+        """Adds the table that the files left out as duplicates are listed in, if it isn't there yet.
+
+        The files with the same dedup_key, together with their original_file_path, form a group of duplicates.
+        """
+        logging.info('Attempting to add duplicates table')
+        sqlQuery = 'CREATE TABLE IF NOT EXISTS \"' + tableName + '\" (' \
+            + 'table_name TEXT, file_path TEXT, dedup_key TEXT, original_file_path TEXT, found_at TIMESTAMP, ' \
+            + 'PRIMARY KEY (table_name, file_path));'
+        self.executeQuery(self.connection, sqlQuery)
+        self.executeQuery(self.connection, 'CREATE INDEX IF NOT EXISTS \"' + tableName + '_dedup_key_idx\" '
+                          + 'ON \"' + tableName + '\" (table_name, dedup_key);')
+
+    def addColumnStatsTableToDb(self, tableName):
+        """Adds the table that keeps the statistics of the columns of the other tables, if it isn't there yet.
+
+        distinct_count is estimated from the HyperLogLog registers in hll_registers and top_values
+        holds the most frequent values as [value, count] pairs, the most frequent first.
+        """
+        logging.info('Attempting to add column stats table')
+        sqlQuery = 'CREATE TABLE IF NOT EXISTS \"' + tableName + '\" (' \
+            + 'table_name TEXT, column_name TEXT, row_count BIGINT DEFAULT 0, null_count BIGINT DEFAULT 0, ' \
+            + 'min_value DOUBLE PRECISION, max_value DOUBLE PRECISION, distinct_count BIGINT DEFAULT 0, ' \
+            + 'top_values JSONB DEFAULT \'[]\', hll_registers BYTEA, updated_at TIMESTAMP, ' \
+            + 'PRIMARY KEY (table_name, column_name));'
+        self.executeQuery(self.connection, sqlQuery)
+
+    def lockColumnStats(self, connection, statsTableName, tableName, columnNames):
+        """Locks the statistics of columns of a table for the transaction open on connection and gets them.
+
+        Rows are added first for columns that don't have statistics yet, so that they can be locked too.
+
+        Returns
+        -------
+        dict
+            (row_count, null_count, min_value, max_value, distinct_count, top_values, hll_registers)
+            by column name
+        """
+        cursor = connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, 'INSERT INTO \"' + statsTableName + '\" (table_name, column_name) VALUES %s '
+                                           + 'ON CONFLICT (table_name, column_name) DO NOTHING;',
+                                           [(tableName, columnName) for columnName in columnNames])
+            cursor.execute('SELECT column_name, row_count, null_count, min_value, max_value, distinct_count, top_values, hll_registers '
+                           + 'FROM \"' + statsTableName + '\" WHERE table_name = %s AND column_name = ANY(%s) FOR UPDATE;',
+                           (tableName, list(columnNames)))
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    def writeColumnStats(self, connection, statsTableName, tableName, rows):
+        """Sets the statistics of columns of a table, as part of the transaction open on connection.
+
+        Every row is (column_name, row_count, null_count, min_value, max_value, distinct_count, top_values, hll_registers).
+        """
+        sqlQuery = 'UPDATE \"' + statsTableName + '\" s SET row_count = v.row_count, null_count = v.null_count, ' \
+            + 'min_value = v.min_value, max_value = v.max_value, distinct_count = v.distinct_count, ' \
+            + 'top_values = v.top_values::JSONB, hll_registers = v.hll_registers, updated_at = now() ' \
+            + 'FROM (VALUES %s) AS v (table_name, column_name, row_count, null_count, min_value, max_value, distinct_count, ' \
+            + 'top_values, hll_registers) WHERE s.table_name = v.table_name AND s.column_name = v.column_name;'
+        cursor = connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, sqlQuery,
+                                           [(tableName,) + tuple(row[:7]) + (psycopg2.Binary(row[7]),) for row in rows],
+                                           template='(%s, %s, %s, %s, %s::DOUBLE PRECISION, %s::DOUBLE PRECISION, %s, %s, %s)')
+        finally:
+            cursor.close()
+
+    def clearColumnStats(self, statsTableName, tableName):
+        """Removes the statistics of a table, e.g. before it is loaded from scratch."""
+        sqlQuery = 'DELETE FROM \"' + statsTableName + '\" WHERE table_name = %s;'
+        self.executeQuery(self.connection, sqlQuery, (tableName,))
+
+    def replaceColumnStats(self, statsTableName, fromTableName, toTableName):
+        """Makes the statistics of one table those of another, e.g. after a fast load replaced the table."""
+        connection = self.getPooledConnection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('DELETE FROM \"' + statsTableName + '\" WHERE table_name = %s;', (toTableName,))
+            cursor.execute('UPDATE \"' + statsTableName + '\" SET table_name = %s WHERE table_name = %s;', (toTableName, fromTableName))
+            connection.commit()
+        finally:
+            self.releasePooledConnection(connection, cursor)
+
+
+def removePrimaryKey(constraints):
+    """Removes PRIMARY KEY from the constraints of a column, keeping the NOT NULL it implies."""
+    index = constraints.upper().find('PRIMARY KEY')
+    if index < 0:
+        return constraints
+    return (constraints[:index] + 'NOT NULL' + constraints[index + len('PRIMARY KEY'):]).strip()
+
+def createIndexQuery(tableName, indexName, index):
+    """Creates the CREATE INDEX query of an index in the indexes section of the column spec."""
+    method = index.get('method', 'btree').lower()
+    if method not in INDEX_METHODS:
+        raise Exception('Unknown index method {0} of index {1}'.format(method, indexName))
+    unique = 'UNIQUE ' if index.get('unique', False) else ''
+    return 'CREATE ' + unique + 'INDEX IF NOT EXISTS \"' + tableName + '_' + indexName + '\" ON \"' + tableName + '\" ' \
+        + 'USING ' + method + ' (' + columnList(index['columns']) + ');'
+
+def copyBuffer(records):
+    """Writes records into a buffer in the text format of COPY."""
+    buffer = io.StringIO()
+    for record in records:
+        buffer.write('\t'.join(copyFormat(value) for value in record) + '\n')
+    buffer.seek(0)
+    return buffer
+
+def columnList(columnNames):
+    return ', '.join('\"' + name + '\"' for name in columnNames)
+
+def upsertClause(columnNames, conflictColumns):
+    """Creates the ON CONFLICT clause that replaces the other columns of a conflicting row."""
+    updates = ['\"' + name + '\" = EXCLUDED.\"' + name + '\"' for name in columnNames if name not in conflictColumns]
+    if not updates:
+        return 'ON CONFLICT (' + columnList(conflictColumns) + ') DO NOTHING'
+    return 'ON CONFLICT (' + columnList(conflictColumns) + ') DO UPDATE SET ' + ', '.join(updates)
+
+def copyFormat(value):
+    """Converts a value into its representation in the text format of COPY."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        return copyFormat('{' + ','.join(arrayFormat(item) for item in value) + '}')
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def arrayFormat(item):
+    """Converts an item of a list into its representation in a Postgres array literal."""
+    if item is None:
+        return 'NULL'
+    if isinstance(item, (list, tuple)):
+        return '{' + ','.join(arrayFormat(subItem) for subItem in item) + '}'
+    return '"' + str(item).replace('\\', '\\\\').replace('"', '\\"') + '"'
@@ -2,91 +2,925 @@
 import os
 import logging
 import json
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from pathlib import Path
+import time
+import socket
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import psycopg2
 import pydicom as pdm
+from batchWriter import BatchWriter
+from fileDiscovery import findFiles
+from archiveReader import MemberFilter, findArchiveFiles, readTarMembers, openMember, isTarArchive, \
+    splitMemberPath, getSourcePath, statFile
+from extractionPlan import ExtractionPlan, getRelativePath, selectElements
+from ingestMetrics import IngestMetrics, NullMetrics
+from columnStats import StatsCollector
+from duplicateFilter import DuplicateFilter
+from folderWatcher import createWatcher, ArrivalTracker
+from exportSinks import createSink, createSchema, toRecordBatch, getDefaultExtension
+
+# Number of files that a worker of the parallel pipeline parses per task
+CHUNK_SIZE = 32
+
+# Number of chunks that are added to the work queue at once while it's being filled
+QUEUE_FILL_CHUNKS = 16
+
+# Longest a watch waits for events before checking whether it was asked to stop
+WATCH_TIMEOUT = 1.0
 
 class DicomToDatabase:
     def __init__(self, configHandler, dbHandler):
         self.configHandler = configHandler
         self.dbHandler = dbHandler
+        self.metrics = NullMetrics()
 
     def dicomToDb(self, dbName, metaTableName, columnsInfoPath):
         logging.info('Attempting to store DICOM metadata from DCMs in a folder to Postgres DB')
         
         with open(columnsInfoPath) as fileReader:
             elementsDict = json.load(fileReader)
-        elementsOriginal = elementsDict["elements"]
+        plan = self.createPlan(elementsDict["elements"], elementsDict.get("derived"))
+        parentFolder = self.configHandler.getParentFolder()
 
-        pathlist = Path(self.configHandler.getUnpackFolderPath()).glob('**/*.dcm')
-        for path in pathlist:
-            elements = elementsOriginal.copy()
+        self.metrics = self.createMetrics()
+        if self.dbHandler is not None:
+            self.dbHandler.metrics = self.metrics
+        pathlist = self.metrics.timeDiscovery(self.findDicomFiles())
 
-            filePath = str(path)
-            logging.debug('Storing: ' + filePath)
+        readOptions = self.getReadOptions(plan)
+        loadMethod = self.configHandler.getLoadMethod()
+        sinkName = self.configHandler.getExportSink()
+        if sinkName != 'postgres':
+            self.exportRecords(pathlist, plan, readOptions, metaTableName, elementsDict["nonElementColumns"], sinkName)
+        elif loadMethod == 'insert':
+            if self.configHandler.getParallel() or self.configHandler.getIncremental() or self.configHandler.getFastLoad() \
+                    or self.configHandler.getColumnStatsTableName() is not None or plan.dedupColumn is not None:
+                logging.warning('The parallel, incremental, fast load, column stats and dedup modes need a batched load method, '
+                                + 'storing every file serially without them')
+            self.addHeaderColumn(metaTableName, plan)
+            self.addDedupColumn(metaTableName, plan)
+            self.addDerivedColumns(metaTableName, plan)
+            sqlQuery = plan.getInsertQuery(metaTableName)
+            for path in pathlist:
+                filePath = str(path)
+                logging.debug('Storing: ' + filePath)
+                if isTarArchive(filePath):
+                    self.insertTarArchive(plan, filePath, readOptions, sqlQuery)
+                    continue
 
-            # Insert the DICOM metadata as a new record in the Postgres DB
-            sqlQuery, values = self.createSqlQuery(metaTableName, elements, filePath)
-            self.dbHandler.executeQuery(self.dbHandler.connection, sqlQuery, values)
-                    
+                # Insert the DICOM metadata as a new record in the Postgres DB
+                stageTimes = createStageTimes() if self.metrics.enabled else None
+                record = readRecord(plan, filePath, parentFolder, readOptions, stageTimes)
+                self.metrics.addStageTimes(stageTimes or {})
+                with self.metrics.timeStage('write'):
+                    self.dbHandler.executeQuery(self.dbHandler.connection, sqlQuery, record)
+                self.metrics.countWritten(1)
+                self.metrics.countFile()
+        else:
+            conflictColumns = None
+            manifestTableName = None
+            fastLoad = self.configHandler.getFastLoad()
+            distributed = self.configHandler.getDistributed()
+            if self.configHandler.getIncremental():
+                # Only store the files that are new, changed or weren't stored by an interrupted run
+                conflictColumns = self.getPrimaryKeyColumns(elementsDict["nonElementColumns"])
+                manifestTableName = self.configHandler.getTableName("manifest")
+                if not distributed:
+                    pathlist = self.findFilesToStore(pathlist, manifestTableName)
+                    self.metrics.setTotalFiles(len(pathlist))
+            if distributed:
+                # Records replace the stored ones, so that a chunk reclaimed from a dead worker can be stored again
+                conflictColumns = self.getPrimaryKeyColumns(elementsDict["nonElementColumns"])
+            if conflictColumns:
+                self.checkPrimaryKey(metaTableName, conflictColumns)
+            if fastLoad and conflictColumns:
+                logging.warning('The incremental and distributed modes update the table in place, not using fast load')
+                fastLoad = False
+
+            loadTableName = metaTableName
+            if fastLoad:
+                # Load into an unlogged table without indexes and build them once it's full
+                loadTableName = self.dbHandler.startFastLoad(metaTableName, columnsInfoPath, "nonElementColumns", "elements")
+            self.addHeaderColumn(loadTableName, plan, withIndex=not fastLoad)
+            self.addDedupColumn(loadTableName, plan)
+            self.addDerivedColumns(loadTableName, plan)
+            duplicateFilter = self.createDuplicateFilter(loadTableName, plan)
+            statsCollector = self.createStatsCollector(loadTableName, plan.columnNames, plan.getElementColumnNames())
+            if statsCollector is not None and fastLoad:
+                # The loaded table starts out empty
+                self.dbHandler.clearColumnStats(statsCollector.statsTableName, loadTableName)
+
+            batchWriter = self.createBatchWriter(loadTableName, plan.columnNames, loadMethod,
+                                                 conflictColumns, manifestTableName, statsCollector, duplicateFilter)
+            if distributed:
+                self.storeDistributed(pathlist, plan, readOptions, batchWriter, manifestTableName)
+            elif self.configHandler.getParallel():
+                self.storeInParallel(pathlist, plan, readOptions, batchWriter)
+            else:
+                self.storeSerially(pathlist, plan, readOptions, batchWriter)
+            batchWriter.close()
+            if fastLoad:
+                with self.metrics.timeStage('write'):
+                    self.dbHandler.finishFastLoad(loadTableName, metaTableName, columnsInfoPath, "nonElementColumns", "indexes",
+                                                  dict(self.getHeaderIndexes(plan), **self.getDedupIndexes(plan)))
+                if statsCollector is not None and loadTableName != metaTableName:
+                    self.dbHandler.replaceColumnStats(statsCollector.statsTableName, loadTableName, metaTableName)
+
+        self.metrics.finish()
         logging.info('Done storing metadata')
 
-    def createSqlQuery(self, metaTableName, elements, filePath):
-        """Create the SQL query for inserting a record."""
-        dcm = pdm.dcmread(filePath)
-        # Go through the list of elements and try to read the value
-        for elementName in elements.keys():
-            tag = elements[elementName]['tag']
-            [groupNum, elementNum] = tag.split(',')
+    def exportRecords(self, pathlist, plan, readOptions, tableName, nonElementColumns, sinkName):
+        """Write the records to the export file of the config instead of the DB, through the same pipeline.
+
+        The modes that keep state in the DB, i.e. incremental, distributed, fast load, column
+        stats and dedup, don't apply to a file.
+        """
+        if self.configHandler.getIncremental() or self.configHandler.getDistributed() or self.configHandler.getFastLoad() \
+                or self.configHandler.getColumnStatsTableName() is not None or plan.dedupColumn is not None:
+            logging.warning('The incremental, distributed, fast load, column stats and dedup modes need the postgres sink, '
+                            + 'writing every file to the %s sink without them', sinkName)
+        sink = self.createSink(sinkName, tableName, plan.columnNames, plan.getColumnTypes(nonElementColumns),
+                               self.getPrimaryKeyColumns(nonElementColumns))
+        if self.configHandler.getParallel():
+            self.storeInParallel(pathlist, plan, readOptions, sink)
+        else:
+            self.storeSerially(pathlist, plan, readOptions, sink)
+        sink.close()
+
+    def createSink(self, sinkName, tableName, columnNames, columnTypes, keyColumns=None):
+        """Create the export sink that the records are written to instead of the DB."""
+        outputPath = self.configHandler.getExportPath(tableName + getDefaultExtension(sinkName))
+        logging.info('Writing the records to %s with the %s sink', outputPath, sinkName)
+        return createSink(sinkName, outputPath, tableName, columnNames, columnTypes, keyColumns,
+                          self.configHandler.getExportBatchSize(), self.metrics)
+
+    def iterRecords(self, columnsInfoPath):
+        """Yield the record of every DCM that is found, in the order of the plan's columnNames, without storing it.
+
+        The DCMs are found and read like dicomToDb does, a chunk at a time, so only one chunk of
+        records is in memory. The DCMs that can't be read are logged and skipped.
+        """
+        with open(columnsInfoPath) as fileReader:
+            elementsDict = json.load(fileReader)
+        plan = self.createPlan(elementsDict["elements"], elementsDict.get("derived"))
+        results = iterResults(plan, self.findDicomFiles(), self.configHandler.getParentFolder(),
+                              self.getReadOptions(plan), memberFilter=self.getMemberFilter())
+        for chunkResults, _ in results:
+            for filePath, record, error in chunkResults:
+                if error is None:
+                    yield record
+                else:
+                    logging.warning('Cannot read %s: %s: %s', filePath, error[1], error[2])
+
+    def iterRecordBatches(self, columnsInfoPath, batchSize=None):
+        """Yield the records of iterRecords as pyarrow record batches of batchSize records.
+
+        The columns have the Arrow types of their DB datatypes, batchSize is the export batch
+        size of the config if it isn't given.
+        """
+        with open(columnsInfoPath) as fileReader:
+            elementsDict = json.load(fileReader)
+        plan = self.createPlan(elementsDict["elements"], elementsDict.get("derived"))
+        schema = createSchema(plan.columnNames, plan.getColumnTypes(elementsDict["nonElementColumns"]))
+        batchSize = batchSize or self.configHandler.getExportBatchSize()
+        records = []
+        for record in self.iterRecords(columnsInfoPath):
+            records.append(record)
+            if len(records) == batchSize:
+                yield toRecordBatch(records, schema)
+                records = []
+        if records:
+            yield toRecordBatch(records, schema)
+
+    def watchFolder(self, metaTableName, columnsInfoPath, stopEvent=None):
+        """Store the DCMs that arrive in the unpack folder as they arrive, until stopEvent is set or the process is interrupted.
+
+        The files that arrived while nothing was watching are stored first, by comparing the folder
+        with the manifest like the incremental mode does. After that the folder is watched with
+        inotify, or by walking it if inotify isn't available, and a file is stored once it stayed
+        unchanged for the settle time. The records are committed once a batch of them is buffered
+        or the first of them has waited max_latency seconds, so a lower latency means smaller
+        batches. If the connection to the DB is lost, the buffered records are kept and written
+        after reconnecting, with a doubling delay between the attempts.
+        """
+        logging.info('Attempting to watch the unpack folder for new DCMs')
+
+        with open(columnsInfoPath) as fileReader:
+            elementsDict = json.load(fileReader)
+        plan = self.createPlan(elementsDict["elements"], elementsDict.get("derived"))
+        readOptions = self.getReadOptions(plan)
+        loadMethod = self.configHandler.getLoadMethod()
+        if loadMethod == 'insert':
+            logging.warning('Watch mode stores the DCMs in batches, using COPY')
+            loadMethod = 'copy'
+        if self.configHandler.getArchivePaths() or self.configHandler.getDistributed() or self.configHandler.getFastLoad():
+            logging.warning('Watch mode only watches the unpack folder, ignoring the archives, distributed and fast load settings')
+
+        self.metrics = self.createMetrics()
+        self.dbHandler.metrics = self.metrics
+        manifestTableName = self.configHandler.getTableName("manifest")
+        self.addHeaderColumn(metaTableName, plan)
+        self.addDedupColumn(metaTableName, plan)
+        self.addDerivedColumns(metaTableName, plan)
+        # A file that is written again replaces its record
+        batchWriter = self.createBatchWriter(metaTableName, plan.columnNames, loadMethod,
+                                             self.getPrimaryKeyColumns(elementsDict["nonElementColumns"]), manifestTableName,
+                                             self.createStatsCollector(metaTableName, plan.columnNames, plan.getElementColumnNames()),
+                                             self.createDuplicateFilter(metaTableName, plan))
+
+        folderPath = self.configHandler.getUnpackFolderPath()
+        extensions = self.configHandler.getDicomExtensions()
+        detectDicom = self.configHandler.getDetectDicomMagic()
+        # Watch before the catch-up walk, so that the files arriving during it aren't missed
+        watcher = createWatcher(folderPath, self.configHandler.getWatchMethod(), self.configHandler.getWatchPollInterval())
+        try:
+            self.storeSerially(self.findFilesToStore(findFiles(folderPath, extensions, detectDicom,
+                                                               self.configHandler.getDiscoveryWalkers()), manifestTableName),
+                               plan, readOptions, batchWriter)
+            batchWriter.flush()
+            logging.info('Caught up with %s, waiting for new DCMs', folderPath)
+            self.storeArrivingFiles(watcher, ArrivalTracker(self.configHandler.getSettleTime(), extensions, detectDicom),
+                                    plan, readOptions, batchWriter, manifestTableName, stopEvent)
+        except KeyboardInterrupt:
+            logging.info('Interrupted')
+        finally:
+            watcher.close()
+        batchWriter.close()
+
+        self.metrics.finish()
+        logging.info('Stopped watching %s', folderPath)
+
+    def storeArrivingFiles(self, watcher, tracker, plan, readOptions, batchWriter, manifestTableName, stopEvent=None):
+        """Hand the files reported by the watcher to the batch writer once they settled and commit them in micro-batches.
+
+        A file goes from the tracker to readyFiles once it settled, to arrivedFiles once the
+        manifest says it is new or changed and to waitingFiles once its record is buffered, so
+        that after a lost connection every file picks up where it was.
+        """
+        batchSize = self.configHandler.getBatchSize()
+        maxLatency = self.configHandler.getMaxLatency()
+        maxReconnectDelay = self.configHandler.getMaxReconnectDelay()
+        readyFiles = []
+        arrivedFiles = []
+        waitingFiles = []
+        waitingSince = None
+        reconnectDelay = None
+        while stopEvent is None or not stopEvent.is_set():
+            timeouts = [WATCH_TIMEOUT, tracker.getWaitTime()]
+            if waitingSince is not None:
+                timeouts.append(max(waitingSince + maxLatency - time.monotonic(), 0))
+            for filePath in watcher.poll(min(timeout for timeout in timeouts if timeout is not None)):
+                tracker.add(filePath)
+            readyFiles.extend(tracker.popReady())
+
             try:
-                element = dcm[int(groupNum, 16), int(elementNum, 16)]
-                if element.VR == 'DS':
-                    if element.VM == 1:
-                        value = int(float(element.value))
-                    elif element.VM > 1:
-                        value = int(float(element.value[0]))
+                if reconnectDelay is not None:
+                    self.dbHandler.reconnect()
+                    batchWriter.reconnect()
+                if readyFiles:
+                    arrivedFiles.extend(self.findArrivedFiles(readyFiles, manifestTableName))
+                    readyFiles = []
+                while arrivedFiles or len(waitingFiles) >= batchSize:
+                    if len(waitingFiles) >= batchSize:
+                        self.commitWaitingFiles(batchWriter, waitingFiles)
+                        waitingSince = None
+                        continue
+                    # Never more files than fit in the batch, so the writer only flushes once they are all buffered
+                    room = batchSize - len(waitingFiles)
+                    files, arrivedFiles = arrivedFiles[:room], arrivedFiles[room:]
+                    if waitingSince is None:
+                        waitingSince = time.monotonic()
+                    waitingFiles.extend(files)
+                    self.storeSerially([filePath for filePath, _ in files], plan, readOptions, batchWriter)
+                if waitingSince is not None and time.monotonic() - waitingSince >= maxLatency:
+                    self.commitWaitingFiles(batchWriter, waitingFiles)
+                    waitingSince = None
+                reconnectDelay = None
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+                reconnectDelay = min(reconnectDelay * 2, maxReconnectDelay) if reconnectDelay else 1.0
+                logging.warning('Lost the connection to the DB, reconnecting in %.0f s: %s', reconnectDelay, error)
+                self.metrics.countError('write', type(error).__name__)
+                if stopEvent is not None:
+                    stopEvent.wait(reconnectDelay)
                 else:
-                    value = element.value
-                elements[elementName]['value'] = value
-            except (KeyError) as tag: # if the value isn't there, then set it as None
-                logging.debug('Cannot read the following DICOM tag: ' + str(tag))
-                elements[elementName]['value'] = None
+                    time.sleep(reconnectDelay)
+
+            self.metrics.setWaitingFiles(len(tracker) + len(readyFiles) + len(arrivedFiles) + len(waitingFiles))
+            self.metrics.reportIfDue()
+
+    def findArrivedFiles(self, readyFiles, manifestTableName):
+        """Get the settled files that are new or changed since they were stored, marking them as pending in the manifest.
+
+        Returns the (path, modification time in seconds) of every file.
+        """
+        parentFolder = self.configHandler.getParentFolder()
+        fileStats = {}
+        for filePath, (fileSize, fileMtimeNs) in readyFiles:
+            fileStats[getRelativePath(filePath, parentFolder)] = (filePath, fileSize, fileMtimeNs)
+        changedFiles = self.dbHandler.findChangedFiles(manifestTableName, [(fileRelPath, fileSize, fileMtimeNs)
+                                                                           for fileRelPath, (_, fileSize, fileMtimeNs) in fileStats.items()])
+        return [(fileStats[fileRelPath][0], fileStats[fileRelPath][2] / 1e9) for fileRelPath in changedFiles]
+
+    def commitWaitingFiles(self, batchWriter, waitingFiles):
+        """Commit the buffered records and count the lag of their files, from their modification until now."""
+        batchWriter.flush()
+        now = time.time()
+        self.metrics.addLags([now - fileMtime for _, fileMtime in waitingFiles])
+        del waitingFiles[:]
+
+    def insertTarArchive(self, plan, archivePath, readOptions, sqlQuery):
+        """Insert the records of the DCMs in a tar archive one by one, the archive is read in one pass.
+
+        A DCM that can't be read is logged and counted as failed, and the rest of the archive is
+        still stored. Returns the number of DCMs that failed.
+        """
+        results, stageTimes = readRecords(plan, [archivePath], self.configHandler.getParentFolder(), readOptions,
+                                          self.metrics.enabled, self.getMemberFilter())
+        self.metrics.addStageTimes(stageTimes, len(results))
+        failedCount = 0
+        for filePath, record, error in results:
+            if error is not None:
+                stage, errorType, message = error
+                logging.warning('Cannot store %s: %s', filePath, errorType + ': ' + message)
+                self.metrics.countError(stage, errorType)
+                self.metrics.countFile(failed=True)
+                failedCount += 1
                 continue
+            with self.metrics.timeStage('write'):
+                self.dbHandler.executeQuery(self.dbHandler.connection, sqlQuery, record)
+            self.metrics.countWritten(1)
+            self.metrics.countFile()
+        if failedCount:
+            logging.info('%d DCMs of %s could not be parsed', failedCount, archivePath)
+        return failedCount
+
+    def migrateTable(self, metaTableName, columnsInfoPath):
+        """Add the columns of the column spec that the table doesn't have yet and backfill them.
+
+        Only the new tags are read from the DCMs of the records in the table, header-only, and
+        the values are written in batches through a temp table and a set-based UPDATE ... FROM.
+        The primary key of the table is first moved to the columns the column spec puts it on,
+        see migratePrimaryKey. The table has to exist, it's created by the ingest.
+
+        Returns
+        -------
+        list
+            The names of the columns that were added
+        """
+        logging.info('Attempting to migrate table %s to the column spec', metaTableName)
+        if not self.dbHandler.tableExists(metaTableName):
+            raise Exception('Table {0} does not exist, run the ingest first'.format(metaTableName))
+
+        with open(columnsInfoPath) as fileReader:
+            elementsDict = json.load(fileReader)
+        elements = elementsDict["elements"]
+        self.migratePrimaryKey(metaTableName, elementsDict["nonElementColumns"])
+        tableColumns = self.dbHandler.getTableColumns(metaTableName)
+        newColumns = [elementName for elementName in elements
+                      if not elements[elementName]['calculation_only'] and elementName not in tableColumns]
+        if not newColumns:
+            logging.info('Table %s already has every column of the column spec', metaTableName)
+            return newColumns
+        self.dbHandler.addColumns(metaTableName, [(elementName, elements[elementName]['db_datatype']) for elementName in newColumns])
+
+        plan = ExtractionPlan(selectElements(elements, newColumns))
+        readOptions = plan.getReadOptions(self.configHandler.getDeferSize())
+        keyColumns = self.getPrimaryKeyColumns(elementsDict["nonElementColumns"]) or ['file_path']
+        parentFolder = self.configHandler.getParentFolder()
+        pathlist = [os.path.join(parentFolder, fileRelPath) for fileRelPath in self.dbHandler.getColumnValues(metaTableName, 'file_path')]
+
+        self.metrics = self.createMetrics()
+        self.dbHandler.metrics = self.metrics
+        self.metrics.setTotalFiles(len(pathlist))
+        logging.info('Backfilling %s from %d DCMs', ', '.join(newColumns), len(pathlist))
+
+        batchWriter = self.createBatchWriter(metaTableName, plan.columnNames, 'update', keyColumns,
+                                             statsCollector=self.createStatsCollector(metaTableName, plan.columnNames, newColumns))
+        if self.configHandler.getParallel():
+            self.storeInParallel(pathlist, plan, readOptions, batchWriter)
+        else:
+            self.storeSerially(pathlist, plan, readOptions, batchWriter)
+        batchWriter.close()
+
+        self.metrics.finish()
+        logging.info('Done migrating table %s', metaTableName)
+        return newColumns
+
+    def storeDistributed(self, pathlist, plan, readOptions, batchWriter, manifestTableName=None, workerId=None):
+        """Store the DCMs in chunks claimed from a work queue table shared by workers on several nodes.
+
+        The first worker to start fills the queue from pathlist while the others already claim
+        chunks from it. Every worker claims a chunk at a time with FOR UPDATE SKIP LOCKED, stores
+        it and marks it as done. A thread sends heartbeats for the claimed chunk, and chunks whose
+        worker stopped sending them are claimed again by another worker. A worker stops when no
+        chunk is pending or claimed and the queue isn't being filled anymore. To start a new run,
+        drop the work queue table. The chunks are claimed under workerId, by default the host
+        name and process ID, so workers sharing a process need IDs of their own.
+        """
+        if self.configHandler.getParallel():
+            logging.warning('A distributed worker stores its chunks serially, start more workers per node instead')
+        queueTableName = self.configHandler.getTableName("work_queue")
+        parentFolder = self.configHandler.getParentFolder()
+        if workerId is None:
+            workerId = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.dbHandler.addWorkQueueTableToDb(queueTableName)
+
+        if self.dbHandler.tryLockWorkQueue(queueTableName):
+            try:
+                if self.dbHandler.countRecords(queueTableName) == 0:
+                    self.fillWorkQueue(pathlist, queueTableName, manifestTableName)
+            finally:
+                self.dbHandler.unlockWorkQueue(queueTableName)
+
+        heartbeat = ChunkHeartbeat(self.dbHandler, queueTableName, workerId, self.configHandler.getHeartbeatInterval())
+        heartbeat.start()
+        chunkCount = 0
+        try:
+            while True:
+                claimed = self.dbHandler.claimChunk(queueTableName, workerId, self.configHandler.getStaleAfter(),
+                                                    self.configHandler.getMaxAttempts())
+                if claimed is None:
+                    if self.dbHandler.countUnfinishedChunks(queueTableName) == 0 \
+                            and not self.dbHandler.isWorkQueueFilling(queueTableName):
+                        break
+                    # Other workers still have chunks that may need to be claimed again
+                    time.sleep(self.configHandler.getPollInterval())
+                    continue
+
+                chunkId, fileRelPaths = claimed
+                logging.debug('Worker %s claimed chunk %d', workerId, chunkId)
+                self.storeSerially([os.path.join(parentFolder, fileRelPath) for fileRelPath in fileRelPaths],
+                                   plan, readOptions, batchWriter)
+                batchWriter.flush()
+                if self.dbHandler.finishChunk(queueTableName, chunkId, workerId):
+                    chunkCount += 1
+                else:
+                    logging.warning('Chunk %d was claimed by another worker before it was finished', chunkId)
+        finally:
+            heartbeat.stop()
+        logging.info('Worker %s stored %d chunks', workerId, chunkCount)
+
+    def fillWorkQueue(self, pathlist, queueTableName, manifestTableName=None):
+        """Add the paths relative to the parent folder to the work queue in chunks, as the walk goes."""
+        if manifestTableName is not None:
+            pathlist = self.findFilesToStore(pathlist, manifestTableName)
+        parentFolder = self.configHandler.getParentFolder()
+        chunkSize = self.configHandler.getQueueChunkSize()
+        chunks = []
+        chunk = []
+        fileCount = 0
+        for path in pathlist:
+            chunk.append(getRelativePath(str(path), parentFolder))
+            fileCount += 1
+            if len(chunk) == chunkSize:
+                chunks.append(chunk)
+                chunk = []
+            # Hand out what was found so far, so the other workers can start
+            if len(chunks) == QUEUE_FILL_CHUNKS:
+                self.dbHandler.enqueueChunks(queueTableName, chunks)
+                chunks = []
+        if chunk:
+            chunks.append(chunk)
+        if chunks:
+            self.dbHandler.enqueueChunks(queueTableName, chunks)
+        logging.info('Queued %d files in chunks of %d', fileCount, chunkSize)
+
+    def storeSerially(self, pathlist, plan, readOptions, batchWriter):
+        """Parse the DCMs one after the other and hand their records to the batch writer.
+
+        The values are transformed a chunk of DCMs at a time, like in the worker processes.
+        """
+        for results, stageTimes in iterResults(plan, pathlist, self.configHandler.getParentFolder(), readOptions,
+                                               self.metrics.enabled, self.getMemberFilter()):
+            self.storeResults(results, stageTimes, batchWriter)
+
+    def storeResults(self, results, stageTimes, batchWriter):
+        """Hand the records of a chunk to the batch writer and count the DCMs that failed.
+
+        The manifest status of a DCM in a tar archive is set on the archive, which is read as a whole.
+        Returns the number of DCMs that failed.
+        """
+        parentFolder = self.configHandler.getParentFolder()
+        self.metrics.addStageTimes(stageTimes, len(results))
+        failedCount = 0
+        for filePath, record, error in results:
+            sourceRelPath = getRelativePath(getSourcePath(filePath), parentFolder)
+            if error is None:
+                # Buffer the DICOM metadata as a record, it is stored once the batch is full
+                self.metrics.countFile()
+                batchWriter.addRecord(record, sourceRelPath)
+            else:
+                stage, errorType, message = error
+                logging.warning('Cannot store %s: %s', filePath, errorType + ': ' + message)
+                self.metrics.countError(stage, errorType)
+                self.metrics.countFile(failed=True)
+                batchWriter.addFailure(sourceRelPath)
+                failedCount += 1
+        return failedCount
+
+    def storeInParallel(self, pathlist, plan, readOptions, batchWriter):
+        """Parse the DCMs in a pool of worker processes and store the records from this process.
+
+        A thread walks the folder into a bounded queue, the paths are handed to the workers in
+        chunks with a bounded number of chunks in flight, and the records coming back are written
+        by the single batch writer of this process. A tar archive is handed to a worker on its own,
+        so that several archives are read at the same time.
+        """
+        workers = self.configHandler.getWorkers()
+        parentFolder = self.configHandler.getParentFolder()
+        memberFilter = self.getMemberFilter()
+        logging.info('Parsing DCMs with %d worker processes', workers)
+
+        pathQueue = queue.Queue(maxsize=CHUNK_SIZE * workers * 2)
+        walker = threading.Thread(target=walkPaths, args=(pathlist, pathQueue), daemon=True)
+        walker.start()
+
+        failedCount = 0
+        pending = set()
+        chunk = []
+        walkDone = False
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while not walkDone or pending:
+                # Hand out chunks of paths until the workers have enough queued up
+                while not walkDone and len(pending) < workers * 2:
+                    filePath = pathQueue.get()
+                    if filePath is None:
+                        walkDone = True
+                    elif isinstance(filePath, Exception):
+                        raise filePath
+                    elif isTarArchive(filePath):
+                        pending.add(executor.submit(readRecords, plan, [filePath], parentFolder, readOptions,
+                                                    self.metrics.enabled, memberFilter))
+                    else:
+                        chunk.append(filePath)
+                    if chunk and (walkDone or len(chunk) == CHUNK_SIZE):
+                        pending.add(executor.submit(readRecords, plan, chunk, parentFolder, readOptions,
+                                                    self.metrics.enabled, memberFilter))
+                        chunk = []
+
+                if not pending:
+                    continue
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    failedCount += self.storeResults(*future.result(), batchWriter)
+
+        logging.info('%d DCMs could not be parsed', failedCount)
+
+    def createPlan(self, elements, derived=None):
+        """Compile the elements section of the column spec, with the header and dedup columns if they are enabled.
+
+        derived is the derived section of the column spec, with the features of the pixel data to store.
+        """
+        return ExtractionPlan(elements, self.configHandler.getFullHeaderColumn(),
+                              self.configHandler.getDedupColumn(), self.configHandler.getDedupMode(), derived)
+
+    def addHeaderColumn(self, tableName, plan, withIndex=True):
+        """Add the JSONB column the header is stored in and its GIN index, if they aren't there yet."""
+        if plan.headerColumn is None or self.dbHandler is None:
+            return
+        self.dbHandler.addColumns(tableName, [(plan.headerColumn, 'JSONB')])
+        if withIndex:
+            self.dbHandler.addIndexes(tableName, self.getHeaderIndexes(plan))
+
+    def getHeaderIndexes(self, plan):
+        """Get the GIN index of the header column in the form of the indexes section of the column spec."""
+        if plan.headerColumn is None:
+            return {}
+        return {plan.headerColumn + '_idx': {'columns': [plan.headerColumn], 'method': 'gin'}}
+
+    def addDedupColumn(self, tableName, plan):
+        """Add the dedup key column and its unique index, if they aren't there yet.
+
+        The index is built right away even in a fast load, since the keys that might be duplicates
+        are looked up in it while the table is loaded. If the table already has duplicate keys,
+        the index can't be built and the error is raised, since dedup relies on it.
+        """
+        if plan.dedupColumn is None or self.dbHandler is None:
+            return
+        self.dbHandler.addColumns(tableName, [(plan.dedupColumn, 'TEXT')])
+        try:
+            self.dbHandler.buildIndexes(tableName, self.getDedupIndexes(plan))
+        except (psycopg2.IntegrityError) as error:
+            raise Exception('The unique index of column {0} of table {1} can\'t be built because the table already has '
+                            'duplicate keys. Find them with SELECT "{0}", array_agg(file_path) FROM "{1}" GROUP BY "{0}" '
+                            'HAVING COUNT(*) > 1, move all but one file of every key to the {2} table or delete them, '
+                            'and run again'.format(plan.dedupColumn, tableName,
+                                                   self.configHandler.getTableName("duplicates"))) from error
+
+    def addDerivedColumns(self, tableName, plan):
+        """Add the columns of the pixel data features, if they aren't there yet."""
+        if not plan.derivedColumns or self.dbHandler is None:
+            return
+        self.dbHandler.addColumns(tableName, plan.derivedColumns)
+
+    def getDedupIndexes(self, plan):
+        """Get the unique index of the dedup column in the form of the indexes section of the column spec."""
+        if plan.dedupColumn is None:
+            return {}
+        return {plan.dedupColumn + '_idx': {'columns': [plan.dedupColumn], 'method': 'btree', 'unique': True}}
+
+    def createDuplicateFilter(self, tableName, plan):
+        """Create the filter that pre-screens the dedup keys, loaded with the keys already in the table.
+
+        None if dedup isn't enabled.
+        """
+        if plan.dedupColumn is None or self.dbHandler is None:
+            return None
+        duplicatesTableName = self.configHandler.getTableName("duplicates")
+        self.dbHandler.addDuplicatesTableToDb(duplicatesTableName)
+        duplicateFilter = DuplicateFilter(plan.dedupColumn, plan.columnNames, duplicatesTableName,
+                                          self.configHandler.getDedupCapacity(), self.configHandler.getDedupErrorRate())
+        keyCount = duplicateFilter.load(self.dbHandler.streamColumnValues(tableName, plan.dedupColumn))
+        logging.info('Loaded %d stored %s keys into the duplicate filter', keyCount, plan.dedupMode)
+        return duplicateFilter
+
+    def createBatchWriter(self, metaTableName, columnNames, loadMethod, conflictColumns=None, manifestTableName=None,
+                          statsCollector=None, duplicateFilter=None):
+        """Create the writer that the records are handed to, override to send them elsewhere."""
+        return BatchWriter(self.dbHandler, metaTableName, columnNames, self.configHandler.getBatchSize(),
+                           loadMethod, conflictColumns, manifestTableName, statsCollector, duplicateFilter)
+
+    def createStatsCollector(self, tableName, recordColumnNames, statsColumnNames):
+        """Create the collector of the statistics of the stored columns, None if they aren't kept.
+
+        The statistics are merged per batch, so they add up over workers, nodes and incremental
+        runs. A file that is stored again because it changed is counted again.
+        """
+        statsTableName = self.configHandler.getColumnStatsTableName()
+        if statsTableName is None or self.dbHandler is None:
+            return None
+        self.dbHandler.addColumnStatsTableToDb(statsTableName)
+        return StatsCollector(statsTableName, tableName, recordColumnNames, statsColumnNames,
+                              self.configHandler.getStatsTopValues())
+
+    def createMetrics(self):
+        """Create the metrics of a run, a stand-in that does nothing if they are disabled."""
+        if not self.configHandler.getMetricsEnabled():
+            return NullMetrics()
+        return IngestMetrics(self.configHandler.getProgressInterval(),
+                             self.configHandler.getMetricsJsonPath(),
+                             self.configHandler.getMetricsPrometheusPath())
+
+    def findDicomFiles(self):
+        """Get a generator of the paths of the DCMs in the unpack folder, found as the walk goes.
+
+        If archives are set in the config, the DCMs are found in them instead, as archive!member
+        paths for zip archives and as the archive paths for tar archives.
+        """
+        archivePaths = self.configHandler.getArchivePaths()
+        if archivePaths:
+            return findArchiveFiles(archivePaths, self.getMemberFilter())
+        return findFiles(self.configHandler.getUnpackFolderPath(),
+                         self.configHandler.getDicomExtensions(),
+                         self.configHandler.getDetectDicomMagic(),
+                         self.configHandler.getDiscoveryWalkers())
+
+    def getMemberFilter(self):
+        """Get the filter for the DCMs inside archives, the same one the unpack folder is walked with."""
+        return MemberFilter(self.configHandler.getDicomExtensions(), self.configHandler.getDetectDicomMagic())
+
+    def findFilesToStore(self, pathlist, manifestTableName):
+        """Get the paths of the files that are new or changed since they were last stored."""
+        self.dbHandler.addManifestTableToDb(manifestTableName)
+
+        parentFolder = self.configHandler.getParentFolder()
+        fileStats = []
+        for path in pathlist:
+            fileStat = statFile(str(path))
+            fileStats.append((getRelativePath(str(path), parentFolder), fileStat.st_size, fileStat.st_mtime_ns))
+
+        with self.metrics.timeStage('discover'):
+            changedFiles = self.dbHandler.findChangedFiles(manifestTableName, fileStats)
+        logging.info('%d of %d files are new or changed', len(changedFiles), len(fileStats))
+        return [os.path.join(parentFolder, fileRelPath) for fileRelPath in changedFiles]
+
+    def migratePrimaryKey(self, metaTableName, nonElementColumns):
+        """Move the primary key of the table to the columns the column spec puts it on, if it's on others.
+
+        Tables created before the shipped column spec moved the key from file_name to file_path
+        have it on file_name. If two stored DCMs have the same file_path, the key can't be moved
+        and the error is raised, leaving the table as it was.
+
+        Returns
+        -------
+        bool
+            Whether the key was moved
+        """
+        keyColumns = self.getPrimaryKeyColumns(nonElementColumns)
+        constraintName, tableKeyColumns = self.dbHandler.getTablePrimaryKey(metaTableName)
+        if not keyColumns or set(keyColumns) == set(tableKeyColumns):
+            return False
+        logging.info('Moving the primary key of %s from %s to %s', metaTableName,
+                     ', '.join(tableKeyColumns) or 'no columns', ', '.join(keyColumns))
+        self.dbHandler.replacePrimaryKey(metaTableName, constraintName, keyColumns)
+        return True
+
+    def checkPrimaryKey(self, metaTableName, keyColumns):
+        """Raise if the table's primary key isn't on the key columns, which the records replace the stored ones by."""
+        if not self.dbHandler.tableExists(metaTableName):
+            return
+        _, tableKeyColumns = self.dbHandler.getTablePrimaryKey(metaTableName)
+        if set(tableKeyColumns) != set(keyColumns):
+            raise Exception('The primary key of table {0} is on {1}, not on {2} like in the column spec, '
+                            'run migrateTable.py to move it'.format(metaTableName, ', '.join(tableKeyColumns) or 'no columns',
+                                                                     ', '.join(keyColumns)))
+
+    def getPrimaryKeyColumns(self, nonElementColumns):
+        return [columnName for columnName in nonElementColumns
+                if 'PRIMARY KEY' in nonElementColumns[columnName]['constraints'].upper()]
+
+    def getReadOptions(self, plan):
+        """Get the keyword arguments of pydicom.dcmread used to read the DCMs.
+
+        In header-only mode the read stops before the pixel data, only the tags in the column spec
+        are parsed and large values are deferred until they are accessed.
+        """
+        if not self.configHandler.getHeaderOnly():
+            return {}
+        return plan.getReadOptions(self.configHandler.getDeferSize())
+
+    def createSqlQuery(self, metaTableName, elements, filePath, readOptions=None):
+        """Create the SQL query for inserting a record, with the header as JSON if it is enabled."""
+        plan = self.createPlan(elements)
+        record = readRecord(plan, filePath, self.configHandler.getParentFolder(), readOptions)
+        return (plan.getInsertQuery(metaTableName), list(record))
+
+def walkPaths(pathlist, pathQueue):
+    """Put the paths from pathlist on the queue, followed by None once the walk is done.
+
+    If the walk fails, e.g. on a folder that can't be listed, the exception is put on the queue
+    before the None, for the consumer to raise.
+    """
+    try:
+        for path in pathlist:
+            pathQueue.put(str(path))
+    except Exception as error:
+        pathQueue.put(error)
+    finally:
+        pathQueue.put(None)
+
+def iterResults(plan, pathlist, parentFolder, readOptions=None, timed=False, memberFilter=None):
+    """Read the DCMs of pathlist a chunk at a time, yielding the (results, stageTimes) of readRecords for every chunk."""
+    chunk = []
+    for path in pathlist:
+        chunk.append(str(path))
+        if len(chunk) == CHUNK_SIZE:
+            yield readRecords(plan, chunk, parentFolder, readOptions, timed, memberFilter)
+            chunk = []
+    if chunk:
+        yield readRecords(plan, chunk, parentFolder, readOptions, timed, memberFilter)
+
+def readRecords(plan, filePaths, parentFolder, readOptions=None, timed=False, memberFilter=None):
+    """Read the records of a chunk of DCMs, runs in the worker processes.
+
+    The elements are read from every DCM first and then transformed for the whole chunk at once.
+    If the transform of the chunk fails, the DCMs are transformed one at a time so that only the
+    ones it fails for are left out. A tar archive in filePaths is read in one pass, every member
+    that passes memberFilter is a DCM of the chunk.
+
+    Returns a list of (filePath, record, error) where error is None if the DCM could be read,
+    otherwise (stage, exception type, message), and the time spent per stage if timed is set.
+    """
+    stageTimes = createStageTimes() if timed else None
+    rows = []
+    errors = {}
+    readPaths = []
+    for filePath in filePaths:
+        if isTarArchive(filePath):
+            readTarRows(plan, filePath, memberFilter or MemberFilter(), readOptions, stageTimes, rows, errors, readPaths)
+            continue
+        readPaths.append(filePath)
+        try:
+            rows.append(extractRow(plan, filePath, readOptions, stageTimes))
+        except Exception as error:
+            errors[filePath] = (getattr(error, 'stage', 'read'), type(error).__name__, str(error))
+
+    start = time.perf_counter()
+    records = {}
+    try:
+        records = dict(zip([row[0] for row in rows], plan.createRecords(rows, parentFolder)))
+    except Exception:
+        for row in rows:
+            try:
+                records[row[0]] = plan.createRecords([row], parentFolder)[0]
+            except Exception as error:
+                errors[row[0]] = ('transform', type(error).__name__, str(error))
+    if timed:
+        addElapsed(stageTimes, 'transform', start)
+
+    results = [(filePath, records.get(filePath), errors.get(filePath)) for filePath in readPaths]
+    return (results, stageTimes or {})
+
+def readTarRows(plan, archivePath, memberFilter, readOptions, stageTimes, rows, errors, readPaths):
+    """Stream the DCMs of a tar archive into rows, adding the failed ones to errors.
+
+    If the archive itself can't be read, the error is added for the archive path.
+    """
+    members = readTarMembers(archivePath, memberFilter)
+    while True:
+        start = time.perf_counter()
+        try:
+            memberPath, fileReader = next(members)
+        except StopIteration:
+            break
+        except Exception as error:
+            readPaths.append(archivePath)
+            errors[archivePath] = ('read', type(error).__name__, str(error))
+            break
+        finally:
+            if stageTimes is not None:
+                addElapsed(stageTimes, 'read', start)
+
+        readPaths.append(memberPath)
+        try:
+            rows.append(extractFileRow(plan, memberPath, fileReader, readOptions, stageTimes))
+        except Exception as error:
+            errors[memberPath] = (getattr(error, 'stage', 'read'), type(error).__name__, str(error))
+
+def readRecord(plan, filePath, parentFolder, readOptions=None, stageTimes=None):
+    """Read a DCM and create its record.
+
+    If stageTimes is given, the time spent reading, extracting and transforming is added to it
+    and an exception raised on the way gets the stage it was raised in as its stage attribute.
+    """
+    row = extractRow(plan, filePath, readOptions, stageTimes)
+    if stageTimes is None:
+        return plan.createRecords([row], parentFolder)[0]
+
+    start = time.perf_counter()
+    try:
+        return plan.createRecords([row], parentFolder)[0]
+    except Exception as error:
+        error.stage = 'transform'
+        raise
+    finally:
+        addElapsed(stageTimes, 'transform', start)
+
+def extractRow(plan, filePath, readOptions=None, stageTimes=None):
+    """Read a DCM and its raw values, returns the (filePath, values, extra values) row the plan transforms.
+
+    A DCM in an archive is read from the archive!member path without extracting it.
+    If stageTimes is given, the time spent reading and extracting is added to it and an exception
+    raised on the way gets the stage it was raised in as its stage attribute.
+    """
+    if splitMemberPath(filePath)[1] is None:
+        return extractFileRow(plan, filePath, filePath, readOptions, stageTimes)
+    # The member stays open until the deferred values have been extracted
+    with openMember(filePath) as fileReader:
+        return extractFileRow(plan, filePath, fileReader, readOptions, stageTimes)
+
+def extractFileRow(plan, filePath, source, readOptions=None, stageTimes=None):
+    """Read a DCM from a path or an open file and create the row of filePath, like extractRow."""
+    if stageTimes is None:
+        dcm = pdm.dcmread(source, **(readOptions or {}))
+        return (filePath, plan.extractValues(dcm), plan.createExtraValues(dcm, source))
+
+    stage = 'read'
+    start = time.perf_counter()
+    try:
+        dcm = pdm.dcmread(source, **(readOptions or {}))
+        start = addElapsed(stageTimes, stage, start)
+        stage = 'extract'
+        row = (filePath, plan.extractValues(dcm), plan.createExtraValues(dcm, source))
+        addElapsed(stageTimes, stage, start)
+        return row
+    except Exception as error:
+        addElapsed(stageTimes, stage, start)
+        error.stage = stage
+        raise
+
+def createStageTimes():
+    return {'read': 0.0, 'extract': 0.0, 'transform': 0.0}
+
+def addElapsed(stageTimes, stage, start):
+    """Add the time since start to a stage, returns the current time to start the next stage from."""
+    now = time.perf_counter()
+    stageTimes[stage] += now - start
+    return now
+
+class ChunkHeartbeat:
+    """Thread that marks the chunks claimed by a worker as still being worked on every interval seconds."""
+    def __init__(self, dbHandler, queueTableName, workerId, interval):
+        self.dbHandler = dbHandler
+        self.queueTableName = queueTableName
+        self.workerId = workerId
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
 
-        # Adjust the data as necessary before storing
-        self.dataAdjustments(elements)
-
-        # Create the list of values that we're going to use to build the query
-        names = ['file_name', 'file_path']
-        fileRelPath = filePath.replace(self.configHandler.getParentFolder() + os.path.sep, "")
-        values = [filePath.split(os.sep)[-1], fileRelPath]
-        placeholders = ['%s', '%s']
-        # Append any value to this list that isn't birth_date or study_date
-        for elementName in elements.keys():
-            if not elements[elementName]['calculation_only']:
-                names.append(elementName)
-                values.append(elements[elementName]['value'])
-                placeholders.append('%s')
-
-        # Build the SQL query
-        sqlQuery = 'INSERT INTO ' + metaTableName + ' (' + ', '.join(names) + ') VALUES (' + ', '.join(placeholders) + ');'
-
-        return (sqlQuery, values)
-
-    def dataAdjustments(self, elements):
-        """Make adjustments to the data if they are needed."""
-        # Calculate patient_age if it's in the list of elements but wasn't read from the DCM
-        if ('patient_age' in elements) and (elements['patient_age']['value'] is None):
-            if (elements['patient_birth_date']['value'] is not None) and (elements['study_date']['value'] is not None):
-                logging.info('Calculating the patient age (0x0010, 0x1010)')
-                patientBirthDate = elements['patient_birth_date']['value']
-                studyDate = elements['study_date']['value']
-
-                patientBirthDate = datetime.strptime(patientBirthDate, '%Y%m%d')
-                studyDate = datetime.strptime(studyDate, '%Y%m%d')
-                elements['patient_age']['value'] = relativedelta(studyDate, patientBirthDate).years
-
-        # Combine patient_orientation into a string, otherwise it is treated as a list
-        if ('patient_orientation' in elements) and (elements['patient_orientation']['value'] is not None):
-            elements['patient_orientation']['value'] = '\\'.join(elements['patient_orientation']['value'])
+    def run(self):
+        # A connection of its own, the main connection is busy with the worker's queries
+        connection = self.dbHandler.openConnection()
+        try:
+            while not self.stopped.wait(self.interval):
+                self.dbHandler.heartbeatChunks(connection, self.queueTableName, self.workerId)
+        finally:
+            self.dbHandler.closeConnection(connection)
@@ -0,0 +1,82 @@
+"""Module contains classes for telling which records might duplicate one that is already stored."""
+import math
+import hashlib
+
+# Ways a DCM can be identified as a duplicate of another one
+DEDUP_MODES = ('sop_instance_uid', 'content_hash')
+
+class BloomFilter:
+    """Set of keys that can answer "maybe there" or "certainly not there", in a fixed number of bits.
+
+    The bits are sized so that with capacity keys in it, errorRate of the keys that aren't in it
+    are answered with "maybe there".
+    """
+    def __init__(self, capacity, errorRate=0.01):
+        self.bitCount = max(8, int(math.ceil(-capacity * math.log(errorRate) / (math.log(2) ** 2))))
+        self.hashCount = max(1, int(round(self.bitCount / max(capacity, 1) * math.log(2))))
+        self.bits = bytearray((self.bitCount + 7) // 8)
+
+    def getBitIndexes(self, key):
+        # Double hashing: the bit indexes are h1 + i * h2 for two halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(hash1 + i * hash2) % self.bitCount for i in range(self.hashCount)]
+
+    def add(self, key):
+        """Add a key, returns whether it might have been there already."""
+        wasThere = True
+        for bitIndex in self.getBitIndexes(key):
+            byteIndex, mask = bitIndex >> 3, 1 << (bitIndex & 7)
+            if not self.bits[byteIndex] & mask:
+                wasThere = False
+                self.bits[byteIndex] |= mask
+        return wasThere
+
+    def __contains__(self, key):
+        return all(self.bits[bitIndex >> 3] & (1 << (bitIndex & 7)) for bitIndex in self.getBitIndexes(key))
+
+class DuplicateFilter:
+    """Pre-screens the dedup keys of the records written to a table with a Bloom filter of the stored keys.
+
+    A record whose key isn't in the filter can't be a duplicate and is copied into the table as
+    usual. A batch with a key that might be in it is written through a staging table instead, where
+    the keys are confirmed against the index of the key column and the duplicates are moved to the
+    duplicates table. Keys are added to the filter as the records pass, so duplicates within a
+    run are caught too.
+    """
+    def __init__(self, keyColumn, recordColumnNames, duplicatesTableName, capacity, errorRate=0.01):
+        self.keyColumn = keyColumn
+        self.keyIndex = list(recordColumnNames).index(keyColumn)
+        self.duplicatesTableName = duplicatesTableName
+        self.bloomFilter = BloomFilter(capacity, errorRate)
+
+    def load(self, keys):
+        """Add the keys that are already stored, returns how many there were."""
+        keyCount = 0
+        for key in keys:
+            if key is not None:
+                self.bloomFilter.add(key)
+                keyCount += 1
+        return keyCount
+
+    def mightBeDuplicate(self, record):
+        """Check the key of a record and add it to the filter, records without a key are never duplicates."""
+        key = record[self.keyIndex]
+        if key is None:
+            return False
+        return self.bloomFilter.add(key)
+
+def hashContent(source, blockSize=1 << 20):
+    """Hash the content of a file, given by path or as an open binary file, a block at a time."""
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, 'rb') as fileReader:
+            return hashBlocks(digest, fileReader, blockSize)
+    source.seek(0)
+    return hashBlocks(digest, source, blockSize)
+
+def hashBlocks(digest, fileReader, blockSize):
+    for block in iter(lambda: fileReader.read(blockSize), b''):
+        digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,270 @@
+"""Module contains the sinks that the records can be written to instead of the PostgreSQL table.
+
+Every sink takes the records like BatchWriter does, through addRecord, addFailure, flush and
+close, and writes them batchSize at a time. The ingest pipeline is the same whichever sink the
+records go to, and only one batch of records is in memory. The column types come from the
+db_datatype of the column spec, so a Parquet file or SQLite table has the types the PostgreSQL
+table would have.
+"""
+import csv
+import abc
+import json
+import time
+import numbers
+import logging
+import sqlite3
+from ingestMetrics import NullMetrics
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for the Parquet sink and Arrow record batches
+    pa = None
+
+SINKS = ('postgres', 'parquet', 'csv', 'sqlite')
+
+class RecordSink(abc.ABC):
+    """Buffers records and writes them to a file a batch at a time, subclasses write a batch with writeBatch.
+
+    If a batch can't be written, the records are written one at a time so that only the
+    offending ones are dropped.
+    """
+    # Errors of writing a batch that are caused by the values of its records
+    recordErrors = (ValueError, TypeError)
+
+    def __init__(self, outputPath, columnNames, batchSize=1000, metrics=None):
+        self.outputPath = outputPath
+        self.columnNames = list(columnNames)
+        self.batchSize = batchSize
+        self.metrics = metrics or NullMetrics()
+        self.buffer = []
+        self.batchCount = 0
+        self.writtenCount = 0
+        self.failedFilePaths = []
+        self.failedRecords = []
+
+    def addRecord(self, record, filePath=None):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def addFailure(self, filePath):
+        """Keeps the path of a file that couldn't be turned into a record, there is no manifest to mark it in."""
+        self.failedFilePaths.append(filePath)
+
+    def flush(self):
+        """Writes the buffered records to the output."""
+        if not self.buffer:
+            return
+        records = self.buffer
+        self.buffer = []
+        self.batchCount += 1
+
+        start = time.perf_counter()
+        try:
+            self.writeBatch(records)
+            writtenCount = len(records)
+        except self.recordErrors as error:
+            self.metrics.countError('write', type(error).__name__)
+            logging.warning('Batch %d failed, retrying record by record: %s', self.batchCount, error)
+            writtenCount = self.writeRecordsIndividually(records)
+        self.writtenCount += writtenCount
+        self.metrics.countWritten(writtenCount)
+        self.metrics.addStageTime('write', time.perf_counter() - start)
+
+    def writeRecordsIndividually(self, records):
+        writtenCount = 0
+        for record in records:
+            try:
+                self.writeBatch([record])
+                writtenCount += 1
+            except self.recordErrors as error:
+                self.dropRecord(record, error)
+        return writtenCount
+
+    def dropRecord(self, record, error):
+        logging.warning('Batch %d: record %s not written: %s', self.batchCount, record[0], error)
+        self.failedRecords.append((record, str(error).strip()))
+        self.metrics.countError('write', type(error).__name__)
+
+    def close(self):
+        """Writes any buffered records and closes the output."""
+        self.flush()
+        self.closeOutput()
+        logging.info('Wrote %d records in %d batches to %s, %d records failed',
+                     self.writtenCount, self.batchCount, self.outputPath, len(self.failedRecords))
+        if self.failedFilePaths:
+            logging.info('%d files could not be read', len(self.failedFilePaths))
+
+    @abc.abstractmethod
+    def writeBatch(self, records):
+        """Writes a batch of records to the output, raising one of recordErrors if a value can't be written."""
+
+    def closeOutput(self):
+        pass
+
+class CsvSink(RecordSink):
+    """Writes the records to a CSV file with a header row, lists are written as JSON and NULLs as empty fields."""
+    def __init__(self, outputPath, columnNames, batchSize=1000, metrics=None):
+        RecordSink.__init__(self, outputPath, columnNames, batchSize, metrics)
+        self.fileWriter = open(outputPath, 'w', newline='', encoding='utf-8')
+        self.csvWriter = csv.writer(self.fileWriter)
+        self.csvWriter.writerow(self.columnNames)
+
+    def writeBatch(self, records):
+        # Format the whole batch first, so that a value that can't be formatted leaves no half batch behind
+        rows = [['' if value is None else value for value in toPlainRecord(record)] for record in records]
+        self.csvWriter.writerows(rows)
+
+    def closeOutput(self):
+        self.fileWriter.close()
+
+class SqliteSink(RecordSink):
+    """Writes the records to a table of a SQLite DB, one transaction per batch.
+
+    The table is created with the SQLite affinity of every column's DB datatype if it isn't
+    there yet. If keyColumns is given, they are the primary key and a record replaces the row
+    with the same key, like an incremental run does in PostgreSQL. Lists are stored as JSON.
+    """
+    recordErrors = (ValueError, TypeError, sqlite3.Error)
+
+    def __init__(self, outputPath, tableName, columnNames, columnTypes, keyColumns=None, batchSize=1000, metrics=None):
+        RecordSink.__init__(self, outputPath, columnNames, batchSize, metrics)
+        self.connection = sqlite3.connect(outputPath)
+        # The DB is a build artifact, so trade crash safety for speed
+        self.connection.execute('PRAGMA journal_mode = WAL;')
+        self.connection.execute('PRAGMA synchronous = OFF;')
+        columnDefinitions = ['"{0}" {1}'.format(columnName, toSqliteType(columnType))
+                             for columnName, columnType in zip(self.columnNames, columnTypes)]
+        if keyColumns:
+            columnDefinitions.append('PRIMARY KEY (' + ', '.join('"' + columnName + '"' for columnName in keyColumns) + ')')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "' + tableName + '" (' + ', '.join(columnDefinitions) + ');')
+        self.connection.commit()
+        self.insertQuery = ('INSERT OR REPLACE INTO "' if keyColumns else 'INSERT INTO "') + tableName + '" (' \
+            + ', '.join('"' + columnName + '"' for columnName in self.columnNames) + ') VALUES (' \
+            + ', '.join(['?'] * len(self.columnNames)) + ');'
+
+    def writeBatch(self, records):
+        with self.connection:
+            self.connection.executemany(self.insertQuery, [toPlainRecord(record) for record in records])
+
+    def closeOutput(self):
+        self.connection.close()
+
+class ParquetSink(RecordSink):
+    """Writes the records to a Parquet file with pyarrow, every batch is a row group of the file.
+
+    The schema has the Arrow type of every column's DB datatype, see toArrowType.
+    """
+    def __init__(self, outputPath, columnNames, columnTypes, batchSize=1000, metrics=None):
+        if pa is None:
+            raise Exception('The Parquet sink needs pyarrow, install it with pip install pyarrow')
+        RecordSink.__init__(self, outputPath, columnNames, batchSize, metrics)
+        self.recordErrors = (ValueError, TypeError, OverflowError, pa.ArrowException)
+        self.schema = createSchema(self.columnNames, columnTypes)
+        self.parquetWriter = pq.ParquetWriter(outputPath, self.schema)
+
+    def writeBatch(self, records):
+        self.parquetWriter.write_table(pa.Table.from_batches([toRecordBatch(records, self.schema)]))
+
+    def writeRecordsIndividually(self, records):
+        # Find the records that can't be converted and write the rest as one row group
+        convertibleRecords = []
+        for record in records:
+            try:
+                toRecordBatch([record], self.schema)
+                convertibleRecords.append(record)
+            except self.recordErrors as error:
+                self.dropRecord(record, error)
+        if convertibleRecords:
+            self.writeBatch(convertibleRecords)
+        return len(convertibleRecords)
+
+    def closeOutput(self):
+        self.parquetWriter.close()
+
+def createSink(sinkName, outputPath, tableName, columnNames, columnTypes, keyColumns=None, batchSize=1000, metrics=None):
+    """Create the file sink with the given name, see SINKS. The postgres sink is BatchWriter."""
+    if sinkName == 'csv':
+        return CsvSink(outputPath, columnNames, batchSize, metrics)
+    if sinkName == 'sqlite':
+        return SqliteSink(outputPath, tableName, columnNames, columnTypes, keyColumns, batchSize, metrics)
+    if sinkName == 'parquet':
+        return ParquetSink(outputPath, columnNames, columnTypes, batchSize, metrics)
+    raise Exception('Unknown export sink {0}, use one of {1}'.format(sinkName, ', '.join(SINKS)))
+
+def getDefaultExtension(sinkName):
+    return {'parquet': '.parquet', 'csv': '.csv', 'sqlite': '.sqlite'}.get(sinkName, '')
+
+def toPlainValue(value):
+    """Convert a value into a str, int, float or None that CSV and SQLite can take, lists into JSON."""
+    if value is None or type(value) in (str, int, float):
+        return value
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return json.dumps(toPlainList(value))
+    return str(value)
+
+def toPlainList(values):
+    return [toPlainList(value) if isinstance(value, (list, tuple)) else
+            value if value is None or isinstance(value, numbers.Real) and not isinstance(value, bool) else str(value)
+            for value in values]
+
+def toPlainRecord(record):
+    return tuple(toPlainValue(value) for value in record)
+
+def toSqliteType(dbDatatype):
+    """Get the SQLite column type of a DB datatype, arrays and JSON are stored as text."""
+    datatype = dbDatatype.upper().strip()
+    if datatype.endswith('[]'):
+        return 'TEXT'
+    baseType = datatype.split('(')[0].strip()
+    if baseType in ('SMALLINT', 'INT', 'INTEGER', 'BIGINT', 'BOOLEAN'):
+        return 'INTEGER'
+    if baseType in ('REAL', 'DOUBLE PRECISION', 'FLOAT', 'NUMERIC', 'DECIMAL'):
+        return 'REAL'
+    return 'TEXT'
+
+def toArrowType(dbDatatype):
+    """Get the Arrow type of a DB datatype, e.g. SMALLINT[] is a list of int16. Unknown types are strings."""
+    datatype = dbDatatype.upper().strip()
+    if datatype.endswith('[]'):
+        return pa.list_(toArrowType(datatype[:-2]))
+    baseType = datatype.split('(')[0].strip()
+    return {
+        'SMALLINT': pa.int16(),
+        'INT': pa.int32(),
+        'INTEGER': pa.int32(),
+        'BIGINT': pa.int64(),
+        'REAL': pa.float32(),
+        'DOUBLE PRECISION': pa.float64(),
+        'FLOAT': pa.float64(),
+        'NUMERIC': pa.float64(),
+        'DECIMAL': pa.float64(),
+        'BOOLEAN': pa.bool_(),
+    }.get(baseType, pa.string())
+
+def createSchema(columnNames, columnTypes):
+    """Create the Arrow schema of records with the given columns and DB datatypes."""
+    if pa is None:
+        raise Exception('Arrow record batches need pyarrow, install it with pip install pyarrow')
+    return pa.schema([pa.field(columnName, toArrowType(columnType)) for columnName, columnType in zip(columnNames, columnTypes)])
+
+def toRecordBatch(records, schema):
+    """Convert records into an Arrow record batch with the schema, a column at a time."""
+    columns = list(zip(*records)) if records else [()] * len(schema)
+    return pa.RecordBatch.from_arrays([pa.array(toArrowColumn(column, field.type), type=field.type)
+                                       for column, field in zip(columns, schema)], schema=schema)
+
+def toArrowColumn(column, arrowType):
+    # Values like pydicom's PersonName or MultiValue aren't str or list, Arrow needs them to be
+    if pa.types.is_string(arrowType):
+        return [value if value is None or type(value) is str else
+                json.dumps(toPlainList(value)) if isinstance(value, (list, tuple)) else str(value) for value in column]
+    if pa.types.is_list(arrowType):
+        return [None if value is None else list(value) for value in column]
+    return column
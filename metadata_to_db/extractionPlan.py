@@ -0,0 +1,169 @@
+"""Module contains class for turning DCMs into records using a column spec that is compiled once."""
+import os
+import logging
+import pydicom as pdm
+from headerJson import headerToJson
+from columnTransforms import TRANSFORMS, getTransformSpec
+from duplicateFilter import DEDUP_MODES, hashContent
+from pixelFeatures import PIXEL_TAGS, getDerivedColumns, computeDicomFeatures
+
+# SOP Instance UID, which identifies a DCM
+SOP_INSTANCE_UID_TAG = pdm.tag.Tag(0x0008, 0x0018)
+
+class ExtractionPlan:
+    """The elements section of the column spec compiled into what is needed per DCM.
+
+    The tags are parsed into integers and the order of the record columns is fixed, so that
+    reading a DCM only needs a lookup per element. The values are transformed into what is stored
+    a batch of DCMs at a time, per column, with the transform declared in the column spec.
+
+    If headerColumn is given, the whole header is also serialized into JSON as the next column.
+    If dedupColumn is given, the key that duplicates are found by is the last column, either the
+    SOP Instance UID or the hash of the file content depending on dedupMode.
+    If derived is given, the features of the pixel data in that section of the column spec are
+    computed into the last columns.
+    """
+    def __init__(self, elements, headerColumn=None, dedupColumn=None, dedupMode='sop_instance_uid', derived=None):
+        self.elementNames = list(elements.keys())
+        self.tags = []
+        for elementName in self.elementNames:
+            [groupNum, elementNum] = elements[elementName]['tag'].split(',')
+            self.tags.append(pdm.tag.Tag(int(groupNum, 16), int(elementNum, 16)))
+
+        # Indexes of the values that are stored, the rest are only used for calculations
+        self.storedIndexes = [index for index, elementName in enumerate(self.elementNames)
+                              if not elements[elementName]['calculation_only']]
+        self.columnNames = ['file_name', 'file_path'] + [self.elementNames[index] for index in self.storedIndexes]
+        self.columnTypes = {elementName: elements[elementName]['db_datatype'] for elementName in self.elementNames}
+        self.headerColumn = headerColumn
+        if headerColumn is not None:
+            self.columnNames.append(headerColumn)
+        self.dedupColumn = dedupColumn
+        self.dedupMode = dedupMode
+        if dedupColumn is not None:
+            if dedupMode not in DEDUP_MODES:
+                raise Exception('Unknown dedup mode {0}, use one of {1}'.format(dedupMode, ', '.join(DEDUP_MODES)))
+            self.columnNames.append(dedupColumn)
+        self.derived = derived or {}
+        self.derivedColumns = getDerivedColumns(self.derived)
+        self.columnNames.extend(columnName for columnName, _ in self.derivedColumns)
+
+        # The transform of every stored value and the indexes of the values it is calculated from
+        self.transforms = []
+        for index in self.storedIndexes:
+            elementName = self.elementNames[index]
+            transform = getTransformSpec(elementName, elements[elementName], elements)
+            self.transforms.append((TRANSFORMS[transform['name']],
+                                    [self.elementNames.index(sourceName) for sourceName in transform['from']]))
+
+    def getElementColumnNames(self):
+        """Get the names of the stored element columns, without file_name, file_path and the header column."""
+        return [self.elementNames[index] for index in self.storedIndexes]
+
+    def getColumnTypes(self, nonElementColumns):
+        """Get the DB datatype of every column in the order of columnNames, file_name and file_path from nonElementColumns."""
+        columnTypes = dict(self.columnTypes, **{columnName: column['db_datatype'] for columnName, column in nonElementColumns.items()})
+        if self.headerColumn is not None:
+            columnTypes[self.headerColumn] = 'JSONB'
+        if self.dedupColumn is not None:
+            columnTypes[self.dedupColumn] = 'TEXT'
+        columnTypes.update(self.derivedColumns)
+        return [columnTypes[columnName] for columnName in self.columnNames]
+
+    def getInsertQuery(self, tableName):
+        """Get the SQL query for inserting one record, with a placeholder per column."""
+        return 'INSERT INTO ' + tableName + ' (' + ', '.join(self.columnNames) + ') VALUES (' \
+            + ', '.join(['%s'] * len(self.columnNames)) + ');'
+
+    def getReadOptions(self, deferSize):
+        """Get the keyword arguments of pydicom.dcmread for a header-only read of the plan's tags.
+
+        The whole header is read if it is stored in the header column.
+        """
+        if self.headerColumn is not None:
+            return {
+                'stop_before_pixels': True,
+                'defer_size': deferSize,
+            }
+        tags = self.tags
+        if self.dedupColumn is not None and self.dedupMode == 'sop_instance_uid':
+            tags = tags + [SOP_INSTANCE_UID_TAG]
+        if self.derived:
+            # The pixel data itself is decoded a frame at a time when the features are computed
+            tags = tags + PIXEL_TAGS
+        return {
+            'stop_before_pixels': True,
+            'specific_tags': tags,
+            'defer_size': deferSize,
+        }
+
+    def createRecord(self, dcm, filePath, parentFolder):
+        """Read the elements from a DCM and create its record in the order of columnNames."""
+        return self.createRecords([(filePath, self.extractValues(dcm), self.createExtraValues(dcm, filePath))], parentFolder)[0]
+
+    def createRecords(self, rows, parentFolder):
+        """Create the records of a batch of DCMs from their (filePath, values, extra values) rows.
+
+        The values are transposed into columns and every stored column is transformed at once.
+        """
+        if not rows:
+            return []
+        columns = list(zip(*[values for _, values, _ in rows]))
+        storedColumns = [transform(columns[index], [columns[sourceIndex] for sourceIndex in sourceIndexes])
+                         for index, (transform, sourceIndexes) in zip(self.storedIndexes, self.transforms)]
+        storedRows = zip(*storedColumns) if storedColumns else [()] * len(rows)
+        return [(filePath.split(os.sep)[-1], getRelativePath(filePath, parentFolder)) + tuple(storedValues) + extraValues
+                for (filePath, _, extraValues), storedValues in zip(rows, storedRows)]
+
+    def createExtraValues(self, dcm, source):
+        """Get the values of the header, dedup and derived columns that are stored, source is the DCM's path or open file."""
+        return self.createHeader(dcm) + self.createDedupKey(dcm, source) + self.createDerivedValues(dcm, source)
+
+    def createDerivedValues(self, dcm, source):
+        """Get the values of the derived columns of a DCM in a tuple, an empty tuple if there are none."""
+        if not self.derived:
+            return ()
+        return computeDicomFeatures(self.derived, dcm, source)
+
+    def createHeader(self, dcm):
+        """Get the header of a DCM as a JSON string in a tuple, an empty tuple if it isn't stored."""
+        if self.headerColumn is None:
+            return ()
+        return (headerToJson(dcm),)
+
+    def createDedupKey(self, dcm, source):
+        """Get the dedup key of a DCM in a tuple, an empty tuple if it isn't stored."""
+        if self.dedupColumn is None:
+            return ()
+        if self.dedupMode == 'content_hash':
+            return (hashContent(source),)
+        element = dcm.get(SOP_INSTANCE_UID_TAG)
+        return (str(element.value) if element is not None and element.value else None,)
+
+    def extractValues(self, dcm):
+        """Read the raw value of every element in the plan from a DCM, None if it isn't there."""
+        values = []
+        for tag in self.tags:
+            try:
+                values.append(dcm[tag].value)
+            except (KeyError): # if the value isn't there, then set it as None
+                logging.debug('Cannot read the following DICOM tag: ' + str(tag))
+                values.append(None)
+        return values
+
+def selectElements(elements, elementNames):
+    """Get the part of the elements section that is needed to create the given columns.
+
+    The elements that the columns are calculated from are included as calculation only.
+    """
+    selected = {}
+    for elementName in elementNames:
+        for dependencyName in getTransformSpec(elementName, elements[elementName], elements)['from']:
+            if dependencyName not in elementNames:
+                selected[dependencyName] = dict(elements[dependencyName], calculation_only=True)
+        selected[elementName] = elements[elementName]
+    return selected
+
+def getRelativePath(filePath, parentFolder):
+    """Get the path of a file relative to the parent folder, as it is stored in the file_path column."""
+    return filePath.replace(parentFolder + os.path.sep, "")
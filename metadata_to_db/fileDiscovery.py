@@ -0,0 +1,73 @@
+"""Module contains functions for finding the image files in a folder tree."""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# A DICOM file starts with a 128-byte preamble followed by these 4 bytes
+DICOM_PREAMBLE_SIZE = 128
+DICOM_MAGIC = b'DICM'
+
+def findFiles(folderPath, extensions=(), detectDicom=False, walkers=1):
+    """Find the files in a folder tree, yielding their paths while the walk is still going.
+
+    Parameters
+    ----------
+    folderPath : string
+        Root of the folder tree
+    extensions : iterable of string
+        A file is found if its name ends in one of these, ignoring case
+    detectDicom : bool
+        Also find the files with other names if they start with the DICOM preamble and magic
+    walkers : int
+        Number of threads that scan directories at the same time, which helps on network
+        filesystems where every directory listing is a round trip
+    """
+    extensions = tuple(extension.lower() for extension in extensions)
+    if walkers <= 1:
+        folderPaths = [folderPath]
+        while folderPaths:
+            filePaths, subfolderPaths = scanFolder(folderPaths.pop(), extensions, detectDicom)
+            folderPaths.extend(subfolderPaths)
+            for filePath in filePaths:
+                yield filePath
+        return
+
+    with ThreadPoolExecutor(max_workers=walkers) as executor:
+        pending = {executor.submit(scanFolder, folderPath, extensions, detectDicom)}
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                filePaths, subfolderPaths = future.result()
+                for subfolderPath in subfolderPaths:
+                    pending.add(executor.submit(scanFolder, subfolderPath, extensions, detectDicom))
+                for filePath in filePaths:
+                    yield filePath
+
+def scanFolder(folderPath, extensions, detectDicom):
+    """List one folder, returns the paths of the files that were found and of the subfolders."""
+    filePaths = []
+    subfolderPaths = []
+    try:
+        with os.scandir(folderPath) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolderPaths.append(entry.path)
+                elif not entry.is_file():
+                    continue
+                elif entry.name.lower().endswith(extensions):
+                    filePaths.append(entry.path)
+                elif detectDicom and isDicomFile(entry.path):
+                    filePaths.append(entry.path)
+    except OSError as error:
+        logging.warning('Cannot scan folder %s: %s', folderPath, error)
+    return (filePaths, subfolderPaths)
+
+def isDicomFile(filePath):
+    """Check for the DICOM magic after the preamble, reading only those bytes."""
+    try:
+        with open(filePath, 'rb') as fileReader:
+            fileReader.seek(DICOM_PREAMBLE_SIZE)
+            return fileReader.read(len(DICOM_MAGIC)) == DICOM_MAGIC
+    except OSError as error:
+        logging.warning('Cannot read %s: %s', filePath, error)
+        return False
@@ -0,0 +1,255 @@
+"""Module contains classes for noticing the files that arrive in a folder tree while it is being watched.
+
+Files are reported by inotify where the kernel has it and by walking the tree every interval
+otherwise. A reported file is only handed on once its size and modification time stopped
+changing for a while, so that files that are still being written aren't read half-way.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+from fileDiscovery import isDicomFile
+
+WATCH_METHODS = ('auto', 'inotify', 'poll')
+
+# inotify event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# wd, mask, cookie and name length of an inotify event, followed by the name
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+class InotifyWatcher:
+    """Reports the files in a folder tree that were closed after writing or moved into it.
+
+    Every folder of the tree has a watch of its own, folders that are created or moved in get
+    theirs as they appear and the files already in them are reported. If the kernel's event
+    queue overflows, the whole tree is reported so that no file is missed.
+    """
+    def __init__(self, folderPath):
+        self.folderPath = folderPath
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'Cannot initialize inotify: ' + os.strerror(ctypes.get_errno()))
+        self.folderPaths = {}
+        try:
+            self.addTree(folderPath)
+        except OSError:
+            self.close()
+            raise
+
+    def addTree(self, folderPath):
+        """Watch a folder and its subfolders, returns the paths of the files that are already in them."""
+        filePaths = []
+        for currentPath, subfolderNames, fileNames in os.walk(folderPath):
+            self.addWatch(currentPath)
+            filePaths.extend(os.path.join(currentPath, fileName) for fileName in fileNames)
+        return filePaths
+
+    def addWatch(self, folderPath):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folderPath), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'Out of inotify watches, raise fs.inotify.max_user_watches or watch by polling')
+            raise OSError(error, 'Cannot watch {0}: {1}'.format(folderPath, os.strerror(error)))
+        self.folderPaths[wd] = folderPath
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for events, returns the paths of the files they are about."""
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return []
+        filePaths = []
+        while True:
+            try:
+                data = os.read(self.fd, EVENT_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            filePaths.extend(self.readEvents(data))
+        return filePaths
+
+    def readEvents(self, data):
+        filePaths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, nameLength = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + nameLength].rstrip(b'\0'))
+            offset += nameLength
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('Missed inotify events, looking for new files in all of %s', self.folderPath)
+                filePaths.extend(self.rescan())
+                continue
+            folderPath = self.folderPaths.get(wd)
+            if mask & IN_IGNORED or folderPath is None:
+                self.folderPaths.pop(wd, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+            path = os.path.join(folderPath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        filePaths.extend(self.addTree(path))
+                    except OSError as error:
+                        logging.warning('Not watching %s: %s', path, error)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                filePaths.append(path)
+        return filePaths
+
+    def rescan(self):
+        watchedPaths = set(self.folderPaths.values())
+        filePaths = []
+        for currentPath, _, fileNames in os.walk(self.folderPath):
+            if currentPath not in watchedPaths:
+                try:
+                    self.addWatch(currentPath)
+                except OSError as error:
+                    logging.warning('Not watching %s: %s', currentPath, error)
+            filePaths.extend(os.path.join(currentPath, fileName) for fileName in fileNames)
+        return filePaths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class PollingWatcher:
+    """Reports the files in a folder tree that are new or changed, by walking it every interval seconds.
+
+    The files that are there when the watcher is created aren't reported.
+    """
+    def __init__(self, folderPath, interval=5.0):
+        self.folderPath = folderPath
+        self.interval = interval
+        self.fileStats = dict(scanTree(folderPath))
+        self.nextScan = time.monotonic() + interval
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for the next walk, returns the paths of the files it found to be new or changed."""
+        waitTime = self.nextScan - time.monotonic()
+        if waitTime > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(waitTime, 0))
+        self.nextScan = time.monotonic() + self.interval
+        fileStats = dict(scanTree(self.folderPath))
+        filePaths = [filePath for filePath, fileStat in fileStats.items() if self.fileStats.get(filePath) != fileStat]
+        self.fileStats = fileStats
+        return filePaths
+
+    def close(self):
+        pass
+
+def createWatcher(folderPath, method='auto', pollInterval=5.0):
+    """Create the watcher of a folder tree, with inotify if the method is auto and the kernel has it."""
+    if method not in WATCH_METHODS:
+        raise Exception('Unknown watch method {0}, use one of {1}'.format(method, ', '.join(WATCH_METHODS)))
+    if method != 'poll':
+        try:
+            watcher = InotifyWatcher(folderPath)
+            logging.info('Watching %s with inotify', folderPath)
+            return watcher
+        except (OSError, AttributeError) as error:
+            if method == 'inotify':
+                raise
+            logging.warning('Cannot watch %s with inotify, polling instead: %s', folderPath, error)
+    logging.info('Watching %s by walking it every %.1f s', folderPath, pollInterval)
+    return PollingWatcher(folderPath, pollInterval)
+
+def scanTree(folderPath):
+    """Yield the (path, (size, modification time)) of every file in a folder tree."""
+    folderPaths = [folderPath]
+    while folderPaths:
+        currentPath = folderPaths.pop()
+        try:
+            with os.scandir(currentPath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            folderPaths.append(entry.path)
+                        elif entry.is_file():
+                            fileStat = entry.stat()
+                            yield (entry.path, (fileStat.st_size, fileStat.st_mtime_ns))
+                    except OSError:
+                        # Removed while the folder was listed
+                        continue
+        except OSError as error:
+            logging.warning('Cannot scan folder %s: %s', currentPath, error)
+
+class ArrivalTracker:
+    """Holds back the reported files until they stopped changing for settleTime seconds.
+
+    A file is checked again once its settle time is up, and if its size or modification time
+    changed in the meantime it has to settle again. Files that disappear are dropped.
+    """
+    def __init__(self, settleTime=1.0, extensions=(), detectDicom=False):
+        self.settleTime = settleTime
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self.detectDicom = detectDicom
+        self.pending = {}
+
+    def add(self, filePath, now=None):
+        """Start or restart the settle time of a reported file, if it is one that is stored."""
+        if not filePath.lower().endswith(self.extensions) and not self.detectDicom:
+            return
+        fileStat = statOrNone(filePath)
+        if fileStat is not None:
+            self.pending[filePath] = (fileStat, (time.monotonic() if now is None else now) + self.settleTime)
+
+    def popReady(self, now=None):
+        """Get the (path, (size, modification time in ns)) of the files that settled and stop tracking them."""
+        now = time.monotonic() if now is None else now
+        readyFiles = []
+        for filePath, (fileStat, readyTime) in list(self.pending.items()):
+            if readyTime > now:
+                continue
+            currentStat = statOrNone(filePath)
+            if currentStat is None:
+                del self.pending[filePath]
+            elif currentStat != fileStat:
+                self.pending[filePath] = (currentStat, now + self.settleTime)
+            else:
+                del self.pending[filePath]
+                if filePath.lower().endswith(self.extensions) or isDicomFile(filePath):
+                    readyFiles.append((filePath, fileStat))
+        return readyFiles
+
+    def getWaitTime(self, now=None):
+        """Get the seconds until the next file might have settled, None if no file is pending."""
+        if not self.pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(min(readyTime for _, readyTime in self.pending.values()) - now, 0)
+
+    def __len__(self):
+        return len(self.pending)
+
+def statOrNone(filePath):
+    try:
+        fileStat = os.stat(filePath)
+    except OSError:
+        return None
+    return (fileStat.st_size, fileStat.st_mtime_ns)
@@ -0,0 +1,173 @@
+"""Module contains functions for serializing a DICOM header into JSON for a JSONB column."""
+import json
+import math
+import struct
+from pydicom.dataelem import RawDataElement
+from pydicom.datadict import dictionary_VR, private_dictionary_VR
+from pydicom.multival import MultiValue
+
+# VRs of binary values, which are stored with their VR but without their value
+BINARY_VRS = frozenset(['OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN', 'OB or OW', 'US or OW', 'US or SS or OW'])
+
+# VRs of numbers stored as strings in the DCM, converted so that they can be compared in the DB
+DECIMAL_VRS = frozenset(['DS'])
+INTEGER_VRS = frozenset(['IS'])
+
+# VRs whose raw bytes are decoded here instead of by pydicom, which is the bulk of the cost
+ASCII_VRS = frozenset(['AE', 'AS', 'CS', 'DA', 'DS', 'DT', 'IS', 'TM', 'UI', 'UR'])
+TEXT_VRS = frozenset(['LO', 'LT', 'PN', 'SH', 'ST', 'UC', 'UT'])
+SINGLE_VALUE_VRS = frozenset(['LT', 'ST', 'UR', 'UT'])
+NUMBER_FORMATS = {'US': 'H', 'SS': 'h', 'UL': 'I', 'SL': 'i', 'FL': 'f', 'FD': 'd'}
+
+# Character sets that decode as latin-1, the text VRs of other character sets are decoded by pydicom
+LATIN1_CHARACTER_SETS = ('', 'ISO_IR 6', 'ISO_IR 100', 'ISO 2022 IR 6', 'ISO 2022 IR 100')
+
+def headerToJson(dataset):
+    """Serialize the elements of a DCM, sequences included, into a JSON string.
+
+    The layout follows the DICOM JSON model (PS3.18 F.2): an object keyed by the tag as 8 hex
+    digits, with the VR and a list of values per element, e.g.
+    {"00080060": {"vr": "CS", "Value": ["CR"]}}. The values of binary VRs are left out, and
+    person names are stored as {"Alphabetic": name}.
+    """
+    return json.dumps(headerToDict(dataset), separators=(',', ':'))
+
+def headerToDict(dataset):
+    characterSet = dataset.get_item(0x00080005)
+    latin1Text = characterSet is None or getRawText(characterSet) in LATIN1_CHARACTER_SETS
+
+    header = {}
+    for tag in sorted(dataset.keys()):
+        # A deferred element stays a RawDataElement without its value, get_item would read it
+        element = dataset.get_item(tag, keep_deferred=True)
+        entry = None
+        if isinstance(element, RawDataElement):
+            if element.value is None:
+                entry = deferredToEntry(dataset, element)
+            else:
+                entry = rawToEntry(element, latin1Text)
+        if entry is None:
+            entry = elementToEntry(dataset[tag])
+        header['{0:08X}'.format(tag)] = entry
+    return header
+
+def rawToEntry(element, latin1Text):
+    """Create the entry of an element that pydicom hasn't converted yet from its raw bytes.
+
+    Returns None if the element has to be converted by pydicom, e.g. a sequence.
+    """
+    vr = element.VR
+    if vr is None:
+        # Implicit VR, take it from the dictionary if it's unambiguous
+        try:
+            vr = dictionary_VR(element.tag)
+        except KeyError:
+            return None
+        if ' or ' in vr:
+            return None if vr not in BINARY_VRS else {'vr': vr}
+    entry = {'vr': vr}
+    if vr in BINARY_VRS:
+        return entry
+
+    value = element.value
+    if vr in ASCII_VRS or (vr in TEXT_VRS and latin1Text):
+        text = value.decode('latin-1').rstrip(' \x00')
+        if not text:
+            return entry
+        items = [text] if vr in SINGLE_VALUE_VRS else text.split('\\')
+        entry['Value'] = [convertValue(vr, item.strip() if vr in ASCII_VRS else item.rstrip(' ')) for item in items]
+        return entry
+    if vr in NUMBER_FORMATS:
+        size = struct.calcsize(NUMBER_FORMATS[vr])
+        count = len(value) // size
+        if count:
+            byteOrder = '<' if element.is_little_endian else '>'
+            values = struct.unpack(byteOrder + NUMBER_FORMATS[vr] * count, value[:count * size])
+            entry['Value'] = [convertValue(vr, item) for item in values]
+        return entry
+    return None
+
+def deferredToEntry(dataset, element):
+    """Create the entry of a deferred element of a binary VR without reading its value.
+
+    Returns None if the element has another VR, its value is then read by pydicom.
+    """
+    vr = element.VR
+    if vr is None:
+        vr = getImplicitVR(dataset, element.tag)
+    return {'vr': vr} if vr in BINARY_VRS else None
+
+def getImplicitVR(dataset, tag):
+    """Get the VR of an implicit VR element the way pydicom would, None if it's unknown.
+
+    A private element is looked up under its private creator, and is UN if it's not in the
+    private dictionary.
+    """
+    if tag.is_private:
+        creatorTag = tag.group << 16 | (tag.element >> 8)
+        creator = dataset.get(creatorTag) if tag.element & 0xFF00 else None
+        if creator is not None and creator.value:
+            try:
+                return private_dictionary_VR(tag, creator.value)
+            except (KeyError):
+                pass
+        return 'UN'
+    try:
+        return dictionary_VR(tag)
+    except (KeyError):
+        return None
+
+def elementToEntry(element):
+    """Create the entry of an element that pydicom has converted."""
+    vr = element.VR
+    entry = {'vr': vr}
+    if vr in BINARY_VRS:
+        pass
+    elif vr == 'SQ':
+        entry['Value'] = [headerToDict(item) for item in element.value]
+    else:
+        value = element.value
+        if isinstance(value, (MultiValue, list)):
+            entry['Value'] = [convertValue(vr, item) for item in value]
+        elif value is not None and value != '':
+            entry['Value'] = [convertValue(vr, value)]
+    return entry
+
+def getRawText(element):
+    """Get the value of a text element, raw or converted, as a string."""
+    value = element.value
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    if isinstance(value, (MultiValue, list)):
+        value = value[0] if value else ''
+    return (value or '').strip(' \x00')
+
+def convertValue(vr, value):
+    """Convert a value of an element into something JSON can hold and Postgres accepts."""
+    if isinstance(value, str):
+        if vr == 'PN':
+            return {'Alphabetic': str(value)}
+        if vr in DECIMAL_VRS or vr in INTEGER_VRS:
+            return convertNumberString(vr, value)
+        # Postgres doesn't accept the NUL character in JSONB
+        return value.replace('\x00', '') if '\x00' in value else str(value)
+    if isinstance(value, float):
+        # NaN and infinity are not valid JSON
+        return float(value) if math.isfinite(value) else str(value)
+    if isinstance(value, int):
+        if vr == 'AT':
+            return '{0:08X}'.format(value)
+        return int(value)
+    if isinstance(value, bytes):
+        return value.decode('latin-1').replace('\x00', '')
+    if vr == 'PN':
+        return {'Alphabetic': str(value)}
+    return str(value)
+
+def convertNumberString(vr, value):
+    """Convert a DS or IS that is still a string, keeping it as a string if it isn't a number."""
+    try:
+        number = int(value) if vr in INTEGER_VRS else float(value)
+    except ValueError:
+        return value.strip()
+    return number if vr in INTEGER_VRS or math.isfinite(number) else value.strip()
@@ -0,0 +1,257 @@
+"""Module contains classes for timing the stages of an ingest run and reporting its progress."""
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Stages of the ingest in the order a file goes through them
+STAGES = ('discover', 'read', 'extract', 'transform', 'write')
+
+class IngestMetrics:
+    """Per-stage timers and counters of an ingest run, with progress and ETA reporting.
+
+    The time of a stage is summed over every call of it, so with worker processes the read,
+    extract and transform times are the total over the workers and can exceed the wall time.
+    Every progressInterval seconds the progress is logged and the Prometheus file, if any,
+    is rewritten so that a scraper sees the run as it goes. In watch mode the lag of a file is
+    the time from its last modification until its record was committed.
+    """
+    enabled = True
+
+    def __init__(self, progressInterval=30, jsonPath=None, prometheusPath=None):
+        self.progressInterval = progressInterval
+        self.jsonPath = jsonPath
+        self.prometheusPath = prometheusPath
+
+        self.stageSeconds = dict.fromkeys(STAGES, 0.0)
+        self.stageCalls = dict.fromkeys(STAGES, 0)
+        self.errorCounts = {}
+        self.discoveredCount = 0
+        self.discoveryDone = False
+        self.totalFiles = None
+        self.processedCount = 0
+        self.failedCount = 0
+        self.writtenCount = 0
+        self.lagCount = 0
+        self.lagSum = 0.0
+        self.lastLag = None
+        self.maxLag = None
+        self.waitingCount = 0
+
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.startCounter = time.perf_counter()
+        self.lastReport = self.startCounter
+
+    def addStageTime(self, stage, seconds, calls=1):
+        self.stageSeconds[stage] += seconds
+        self.stageCalls[stage] += calls
+
+    def addStageTimes(self, stageTimes, calls=1):
+        """Add the times of a dict of stage to seconds, as collected by readRecord."""
+        for stage, seconds in stageTimes.items():
+            self.addStageTime(stage, seconds, calls)
+
+    @contextmanager
+    def timeStage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addStageTime(stage, time.perf_counter() - start)
+
+    def timeDiscovery(self, pathlist):
+        """Wrap a path generator so that the time spent walking and the files found are counted."""
+        iterator = iter(pathlist)
+        while True:
+            start = time.perf_counter()
+            try:
+                path = next(iterator)
+            except StopIteration:
+                self.addStageTime('discover', time.perf_counter() - start, 0)
+                self.discoveryDone = True
+                return
+            self.addStageTime('discover', time.perf_counter() - start)
+            self.discoveredCount += 1
+            yield path
+
+    def setTotalFiles(self, totalFiles):
+        """Set the number of files the run will process, once it is known before the walk ends."""
+        self.totalFiles = totalFiles
+
+    def countError(self, stage, errorType):
+        with self.lock:
+            key = (stage, errorType)
+            self.errorCounts[key] = self.errorCounts.get(key, 0) + 1
+
+    def countFile(self, failed=False):
+        """Count a file that went through the pipeline and report the progress when it is due."""
+        self.processedCount += 1
+        if failed:
+            self.failedCount += 1
+        self.reportIfDue()
+
+    def countWritten(self, recordCount):
+        self.writtenCount += recordCount
+
+    def addLags(self, lags):
+        """Add the lags in seconds of files whose records were just committed."""
+        for lag in lags:
+            self.lagCount += 1
+            self.lagSum += lag
+            self.lastLag = lag
+            self.maxLag = lag if self.maxLag is None else max(self.maxLag, lag)
+
+    def setWaitingFiles(self, waitingCount):
+        """Set the number of files that arrived but aren't committed yet."""
+        self.waitingCount = waitingCount
+
+    def reportIfDue(self):
+        if time.perf_counter() - self.lastReport >= self.progressInterval:
+            self.reportProgress()
+
+    def getElapsed(self):
+        return time.perf_counter() - self.startCounter
+
+    def getThroughput(self):
+        elapsed = self.getElapsed()
+        return self.processedCount / elapsed if elapsed > 0 else 0.0
+
+    def getEta(self):
+        """Get the estimated seconds left, None while the number of files isn't known."""
+        totalFiles = self.totalFiles
+        if totalFiles is None and self.discoveryDone:
+            totalFiles = self.discoveredCount
+        throughput = self.getThroughput()
+        if totalFiles is None or throughput == 0:
+            return None
+        return max(totalFiles - self.processedCount, 0) / throughput
+
+    def reportProgress(self):
+        self.lastReport = time.perf_counter()
+        eta = self.getEta()
+        logging.info('Processed %d files (%d failed) of %s, %.1f files/s, ETA %s',
+                     self.processedCount, self.failedCount,
+                     self.totalFiles if self.totalFiles is not None else
+                     str(self.discoveredCount) + ('' if self.discoveryDone else '+'),
+                     self.getThroughput(), 'unknown' if eta is None else formatDuration(eta))
+        if self.lagCount:
+            logging.info('Lag %.2f s, mean %.2f s, max %.2f s, %d files waiting',
+                         self.lastLag, self.lagSum / self.lagCount, self.maxLag, self.waitingCount)
+        if self.prometheusPath:
+            self.writePrometheus(self.prometheusPath)
+
+    def getSummary(self):
+        """Get the counters and timers of the run as a JSON-serializable dict."""
+        return {
+            'start_time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.startTime)),
+            'elapsed_seconds': self.getElapsed(),
+            'files_discovered': self.discoveredCount,
+            'files_processed': self.processedCount,
+            'files_failed': self.failedCount,
+            'records_written': self.writtenCount,
+            'files_per_second': self.getThroughput(),
+            'eta_seconds': self.getEta(),
+            'lag_seconds': {'last': self.lastLag, 'max': self.maxLag,
+                            'mean': self.lagSum / self.lagCount if self.lagCount else None},
+            'files_waiting': self.waitingCount,
+            'stages': {stage: {'seconds': self.stageSeconds[stage], 'calls': self.stageCalls[stage]} for stage in STAGES},
+            'errors': [{'stage': stage, 'type': errorType, 'count': count}
+                       for (stage, errorType), count in sorted(self.errorCounts.items())],
+        }
+
+    def finish(self):
+        """Log the final progress and write the summary files that are configured."""
+        self.reportProgress()
+        for stage in STAGES:
+            logging.info('Stage %-9s %10.2f s over %d calls', stage, self.stageSeconds[stage], self.stageCalls[stage])
+        if self.jsonPath:
+            writeAtomically(self.jsonPath, json.dumps(self.getSummary(), indent=4))
+            logging.info('Wrote the ingest metrics to %s', self.jsonPath)
+
+    def writePrometheus(self, filePath):
+        """Write the metrics in the Prometheus text format, e.g. for the node exporter textfile collector."""
+        lines = []
+        def addMetric(name, metricType, helpText, samples):
+            lines.append('# HELP {0} {1}'.format(name, helpText))
+            lines.append('# TYPE {0} {1}'.format(name, metricType))
+            for labels, value in samples:
+                labelText = ','.join('{0}="{1}"'.format(key, value) for key, value in labels)
+                lines.append('{0}{1} {2}'.format(name, '{' + labelText + '}' if labelText else '', value))
+
+        addMetric('dicom_ingest_stage_seconds_total', 'counter', 'Time spent in each stage of the ingest.',
+                  [((('stage', stage),), self.stageSeconds[stage]) for stage in STAGES])
+        addMetric('dicom_ingest_stage_calls_total', 'counter', 'Number of times each stage of the ingest ran.',
+                  [((('stage', stage),), self.stageCalls[stage]) for stage in STAGES])
+        addMetric('dicom_ingest_errors_total', 'counter', 'Errors of the ingest by stage and exception type.',
+                  [((('stage', stage), ('type', errorType)), count) for (stage, errorType), count in sorted(self.errorCounts.items())])
+        addMetric('dicom_ingest_files_discovered_total', 'counter', 'Files found by the walk.', [((), self.discoveredCount)])
+        addMetric('dicom_ingest_files_processed_total', 'counter', 'Files that went through the pipeline.', [((), self.processedCount)])
+        addMetric('dicom_ingest_files_failed_total', 'counter', 'Files that could not be turned into a record.', [((), self.failedCount)])
+        addMetric('dicom_ingest_records_written_total', 'counter', 'Records stored in the DB.', [((), self.writtenCount)])
+        addMetric('dicom_ingest_files_per_second', 'gauge', 'Files processed per second since the start.', [((), self.getThroughput())])
+        eta = self.getEta()
+        addMetric('dicom_ingest_eta_seconds', 'gauge', 'Estimated seconds left, -1 while unknown.', [((), -1 if eta is None else eta)])
+        addMetric('dicom_ingest_lag_seconds', 'summary', 'Seconds from the last change of a file until its record was committed.', [])
+        lines.append('dicom_ingest_lag_seconds_sum {0}'.format(self.lagSum))
+        lines.append('dicom_ingest_lag_seconds_count {0}'.format(self.lagCount))
+        addMetric('dicom_ingest_last_lag_seconds', 'gauge', 'Lag of the file committed last, -1 before the first one.',
+                  [((), -1 if self.lastLag is None else self.lastLag)])
+        addMetric('dicom_ingest_files_waiting', 'gauge', 'Files that arrived but are not committed yet.', [((), self.waitingCount)])
+        addMetric('dicom_ingest_start_time_seconds', 'gauge', 'Unix time the ingest started.', [((), self.startTime)])
+        writeAtomically(filePath, '\n'.join(lines) + '\n')
+
+class NullMetrics:
+    """Stands in for IngestMetrics when the metrics are disabled, every method does nothing."""
+    enabled = False
+
+    def addStageTime(self, stage, seconds, calls=1):
+        pass
+
+    def addStageTimes(self, stageTimes, calls=1):
+        pass
+
+    @contextmanager
+    def timeStage(self, stage):
+        yield
+
+    def timeDiscovery(self, pathlist):
+        return pathlist
+
+    def setTotalFiles(self, totalFiles):
+        pass
+
+    def countError(self, stage, errorType):
+        pass
+
+    def countFile(self, failed=False):
+        pass
+
+    def countWritten(self, recordCount):
+        pass
+
+    def addLags(self, lags):
+        pass
+
+    def setWaitingFiles(self, waitingCount):
+        pass
+
+    def reportIfDue(self):
+        pass
+
+    def finish(self):
+        pass
+
+def writeAtomically(filePath, text):
+    """Write a file through a temporary file and a rename, so that a reader never sees half of it."""
+    tempPath = filePath + '.tmp'
+    with open(tempPath, 'w') as fileWriter:
+        fileWriter.write(text)
+    os.replace(tempPath, filePath)
+
+def formatDuration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0:d}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
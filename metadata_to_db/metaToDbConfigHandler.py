@@ -1,6 +1,70 @@
 from configHandler import ConfigHandler
 import os
 
+# Settings that are filled in if the config file doesn't have them
+DEFAULT_SETTINGS = {
+    "tableNames": {
+        "manifest": "ingest_manifest",
+        "nifti_metadata": "nifti_metadata",
+        "work_queue": "ingest_queue",
+        "column_stats": "column_stats",
+        "duplicates": "duplicate_files",
+    },
+    "misc": {
+        "nifti_folder_name": "nifti_dataset",
+    },
+    "ingest": {
+        "load_method": "copy",
+        "batch_size": "1000",
+        "header_only": "true",
+        "defer_size": "1 KB",
+        "parallel": "false",
+        "workers": "0",
+        "incremental": "false",
+        "pool_size": "4",
+        "dicom_extensions": ".dcm,.ima",
+        "detect_dicom_magic": "false",
+        "discovery_walkers": "4",
+        "fast_load": "false",
+        "full_header": "false",
+        "full_header_column": "dicom_header",
+        "archives": "",
+        "nifti_archives": "",
+        "column_stats": "false",
+        "stats_top_values": "100",
+        "dedup": "none",
+        "dedup_column": "dedup_key",
+        "dedup_capacity": "10000000",
+        "dedup_error_rate": "0.01",
+    },
+    "distributed": {
+        "enabled": "false",
+        "chunk_size": "256",
+        "heartbeat_interval": "10",
+        "stale_after": "60",
+        "max_attempts": "3",
+        "poll_interval": "5",
+    },
+    "watch": {
+        "method": "auto",
+        "settle_time": "1",
+        "max_latency": "1",
+        "poll_interval": "2",
+        "max_reconnect_delay": "60",
+    },
+    "export": {
+        "sink": "postgres",
+        "path": "",
+        "batch_size": "10000",
+    },
+    "metrics": {
+        "enabled": "false",
+        "json_file": "ingest_metrics.json",
+        "prometheus_file": "",
+        "progress_interval": "30",
+    },
+}
+
 class MetaToDbConfigHandler(ConfigHandler):
     """Config handler specifically for CXR project."""
     def __init__(self, configFilePath):
@@ -10,6 +74,7 @@ class MetaToDbConfigHandler(ConfigHandler):
     def prepConfigIni(self):
         self.setParentFolder()
         self.setColumnsInfoName()
+        self.setDefaultSettings()
 
     def getDbInfo(self):
         return self.getSection('postgresql')
@@ -29,11 +94,180 @@ class MetaToDbConfigHandler(ConfigHandler):
     def getLogLevel(self):
         return self.getSetting("logging", "level")
 
+    def getLoadMethod(self):
+        return self.getSetting("ingest", "load_method")
+
+    def getBatchSize(self):
+        return int(self.getSetting("ingest", "batch_size"))
+
+    def getHeaderOnly(self):
+        return self.getBooleanSetting("ingest", "header_only")
+
+    def getDeferSize(self):
+        return self.getSetting("ingest", "defer_size")
+
+    def getParallel(self):
+        return self.getBooleanSetting("ingest", "parallel")
+
+    def getWorkers(self):
+        """Get the number of worker processes, 0 means one per CPU core."""
+        workers = int(self.getSetting("ingest", "workers"))
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        return workers
+
+    def getIncremental(self):
+        return self.getBooleanSetting("ingest", "incremental")
+
+    def getPoolSize(self):
+        return int(self.getSetting("ingest", "pool_size"))
+
+    def getDicomExtensions(self):
+        return [extension.strip() for extension in self.getSetting("ingest", "dicom_extensions").split(',') if extension.strip()]
+
+    def getDetectDicomMagic(self):
+        return self.getBooleanSetting("ingest", "detect_dicom_magic")
+
+    def getDiscoveryWalkers(self):
+        return int(self.getSetting("ingest", "discovery_walkers"))
+
+    def getFastLoad(self):
+        return self.getBooleanSetting("ingest", "fast_load")
+
+    def getFullHeaderColumn(self):
+        """Get the name of the JSONB column the whole header is stored in, None if it isn't stored."""
+        if not self.getBooleanSetting("ingest", "full_header"):
+            return None
+        return self.getSetting("ingest", "full_header_column")
+
+    def getColumnStatsTableName(self):
+        """Get the name of the table the column statistics are kept in, None if they aren't kept."""
+        if not self.getBooleanSetting("ingest", "column_stats"):
+            return None
+        return self.getTableName("column_stats")
+
+    def getStatsTopValues(self):
+        return int(self.getSetting("ingest", "stats_top_values"))
+
+    def getDedupMode(self):
+        """Get how duplicate DCMs are found, sop_instance_uid or content_hash, None if they aren't looked for."""
+        dedupMode = self.getSetting("ingest", "dedup").strip().lower()
+        if dedupMode in ('', 'none', 'false'):
+            return None
+        return dedupMode
+
+    def getDedupColumn(self):
+        """Get the name of the column the dedup key is stored in, None if duplicates aren't looked for."""
+        if self.getDedupMode() is None:
+            return None
+        return self.getSetting("ingest", "dedup_column")
+
+    def getDedupCapacity(self):
+        """Get the number of keys the Bloom filter of the dedup keys is sized for."""
+        return int(self.getSetting("ingest", "dedup_capacity"))
+
+    def getDedupErrorRate(self):
+        return float(self.getSetting("ingest", "dedup_error_rate"))
+
+    def getArchivePaths(self):
+        """Get the paths of the archives the DCMs are read from instead of the unpack folder, if any."""
+        return self.getPathList("archives")
+
+    def getNiftiArchivePaths(self):
+        """Get the paths of the archives the NIFTIs are read from instead of the NIFTI folder, if any."""
+        return self.getPathList("nifti_archives")
+
+    def getPathList(self, settingName):
+        """Get a comma-separated list of paths from the ingest section, relative ones are in the parent folder."""
+        return [os.path.join(self.getParentFolder(), path.strip())
+                for path in self.getSetting("ingest", settingName).split(',') if path.strip()]
+
+    def getDistributed(self):
+        return self.getBooleanSetting("distributed", "enabled")
+
+    def getQueueChunkSize(self):
+        return int(self.getSetting("distributed", "chunk_size"))
+
+    def getHeartbeatInterval(self):
+        return float(self.getSetting("distributed", "heartbeat_interval"))
+
+    def getStaleAfter(self):
+        """Get the seconds without a heartbeat after which a claimed chunk can be claimed by another worker."""
+        return float(self.getSetting("distributed", "stale_after"))
+
+    def getMaxAttempts(self):
+        return int(self.getSetting("distributed", "max_attempts"))
+
+    def getPollInterval(self):
+        return float(self.getSetting("distributed", "poll_interval"))
+
+    def getWatchMethod(self):
+        return self.getSetting("watch", "method").strip().lower()
+
+    def getSettleTime(self):
+        """Get the seconds a file has to stay unchanged before it is considered fully written."""
+        return float(self.getSetting("watch", "settle_time"))
+
+    def getMaxLatency(self):
+        """Get the seconds a stored file can wait for its batch to be committed."""
+        return float(self.getSetting("watch", "max_latency"))
+
+    def getWatchPollInterval(self):
+        return float(self.getSetting("watch", "poll_interval"))
+
+    def getMaxReconnectDelay(self):
+        return float(self.getSetting("watch", "max_reconnect_delay"))
+
+    def getExportSink(self):
+        return self.getSetting("export", "sink").strip().lower()
+
+    def getExportPath(self, defaultFileName):
+        """Get the path of the file the export sink writes, relative to the parent folder, defaultFileName if it isn't set."""
+        fileName = self.getSetting("export", "path").strip() or defaultFileName
+        return os.path.join(self.getParentFolder(), fileName)
+
+    def getExportBatchSize(self):
+        """Get the number of records written to the export file at once, a row group for Parquet."""
+        return int(self.getSetting("export", "batch_size"))
+
+    def getMetricsEnabled(self):
+        return self.getBooleanSetting("metrics", "enabled")
+
+    def getMetricsJsonPath(self):
+        return self.getMetricsPath("json_file")
+
+    def getMetricsPrometheusPath(self):
+        return self.getMetricsPath("prometheus_file")
+
+    def getMetricsPath(self, settingName):
+        """Get the path of a metrics file relative to the parent folder, None if it isn't set."""
+        fileName = self.getSetting("metrics", settingName).strip()
+        if not fileName:
+            return None
+        return os.path.join(self.getParentFolder(), fileName)
+
+    def getProgressInterval(self):
+        return float(self.getSetting("metrics", "progress_interval"))
+
     def getUnpackFolderPath(self):
         return os.path.join(self.getParentFolder(), "NLMCXR_subset_dataset")
 
+    def getNiftiFolderPath(self):
+        return os.path.join(self.getParentFolder(), self.getSetting("misc", "nifti_folder_name"))
+
     def setParentFolder(self):
         self.setSetting("misc", "parent_folder", os.path.dirname(self.getConfigFilePath()))
 
     def setColumnsInfoName(self):
         self.setSetting("misc", "columns_info_name", "columns_info.json")
+
+    def setDefaultSettings(self):
+        """Fill in the settings the config file doesn't have, writing it once if any were missing."""
+        missing = False
+        for sectionName, settings in DEFAULT_SETTINGS.items():
+            for settingName, value in settings.items():
+                if not self.hasSetting(sectionName, settingName):
+                    self.fillSetting(sectionName, settingName, value)
+                    missing = True
+        if missing:
+            self.writeConfigFile()
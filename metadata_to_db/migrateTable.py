@@ -0,0 +1,17 @@
+"""Contains script that adds the new columns of the column spec to the metadata table and backfills them."""
+import logging
+import sys
+import os
+# This line is so modules using this package as a submodule can use this.
+sys.path.append(os.path.dirname(os.path.abspath(__file__)).replace('\\', '/'))
+#
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler
+from dicomToDb import DicomToDatabase
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='migrate_table.log', level=logging.INFO)
+    configHandler = MetaToDbConfigHandler('config.ini')
+    dbHandler = DatabaseHandler(configHandler)
+    metaTableName = configHandler.getTableName('metadata')
+    DicomToDatabase(configHandler, dbHandler).migrateTable(metaTableName, configHandler.getColumnsInfoFullPath())
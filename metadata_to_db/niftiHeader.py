@@ -0,0 +1,112 @@
+"""Module contains functions for reading NIfTI-1/2 headers without loading the image."""
+import os
+import zlib
+import logging
+import numpy as np
+import nibabel as nib
+
+# Layout of the NIfTI-1 header, 348 bytes
+NIFTI1_HEADER = [
+    ('sizeof_hdr', 'i4'), ('data_type', 'S10'), ('db_name', 'S18'), ('extents', 'i4'),
+    ('session_error', 'i2'), ('regular', 'S1'), ('dim_info', 'u1'), ('dim', 'i2', (8,)),
+    ('intent_p1', 'f4'), ('intent_p2', 'f4'), ('intent_p3', 'f4'), ('intent_code', 'i2'),
+    ('datatype', 'i2'), ('bitpix', 'i2'), ('slice_start', 'i2'), ('pixdim', 'f4', (8,)),
+    ('vox_offset', 'f4'), ('scl_slope', 'f4'), ('scl_inter', 'f4'), ('slice_end', 'i2'),
+    ('slice_code', 'u1'), ('xyzt_units', 'u1'), ('cal_max', 'f4'), ('cal_min', 'f4'),
+    ('slice_duration', 'f4'), ('toffset', 'f4'), ('glmax', 'i4'), ('glmin', 'i4'),
+    ('descrip', 'S80'), ('aux_file', 'S24'), ('qform_code', 'i2'), ('sform_code', 'i2'),
+    ('quatern_b', 'f4'), ('quatern_c', 'f4'), ('quatern_d', 'f4'),
+    ('qoffset_x', 'f4'), ('qoffset_y', 'f4'), ('qoffset_z', 'f4'),
+    ('srow_x', 'f4', (4,)), ('srow_y', 'f4', (4,)), ('srow_z', 'f4', (4,)),
+    ('intent_name', 'S16'), ('magic', 'S4'),
+]
+
+# Layout of the NIfTI-2 header, 540 bytes
+NIFTI2_HEADER = [
+    ('sizeof_hdr', 'i4'), ('magic', 'S4'), ('eol_check', 'i1', (4,)), ('datatype', 'i2'),
+    ('bitpix', 'i2'), ('dim', 'i8', (8,)), ('intent_p1', 'f8'), ('intent_p2', 'f8'),
+    ('intent_p3', 'f8'), ('pixdim', 'f8', (8,)), ('vox_offset', 'i8'), ('scl_slope', 'f8'),
+    ('scl_inter', 'f8'), ('cal_max', 'f8'), ('cal_min', 'f8'), ('slice_duration', 'f8'),
+    ('toffset', 'f8'), ('slice_start', 'i8'), ('slice_end', 'i8'), ('descrip', 'S80'),
+    ('aux_file', 'S24'), ('qform_code', 'i4'), ('sform_code', 'i4'),
+    ('quatern_b', 'f8'), ('quatern_c', 'f8'), ('quatern_d', 'f8'),
+    ('qoffset_x', 'f8'), ('qoffset_y', 'f8'), ('qoffset_z', 'f8'),
+    ('srow_x', 'f8', (4,)), ('srow_y', 'f8', (4,)), ('srow_z', 'f8', (4,)),
+    ('slice_code', 'i4'), ('xyzt_units', 'i4'), ('intent_code', 'i4'), ('intent_name', 'S16'),
+    ('dim_info', 'u1'), ('unused_str', 'S15'),
+]
+
+# Structured dtypes by (sizeof_hdr, byte order)
+HEADER_DTYPES = {
+    (348, '<'): np.dtype(NIFTI1_HEADER).newbyteorder('<'),
+    (348, '>'): np.dtype(NIFTI1_HEADER).newbyteorder('>'),
+    (540, '<'): np.dtype(NIFTI2_HEADER).newbyteorder('<'),
+    (540, '>'): np.dtype(NIFTI2_HEADER).newbyteorder('>'),
+}
+
+MAX_HEADER_SIZE = 540
+
+# Number of compressed bytes read at a time from gzip files until the header is decompressed
+GZIP_READ_SIZE = 4096
+
+def readNiftiHeader(filePath, fileReader=None):
+    """Read the header of a .nii or .nii.gz file.
+
+    Only the header bytes are read from uncompressed files and only the header bytes are
+    decompressed from gzip files. Files that don't start with a NIfTI-1/2 header are handed
+    to nibabel. If fileReader is given, e.g. for a file in an archive, the header is read from
+    it instead of from filePath and it has to be a NIfTI-1/2 header.
+
+    Returns
+    -------
+    numpy.ndarray
+        0-d structured array, indexing it by field name gives the same values as indexing
+        the header nibabel reads from the file, a loaded nibabel image resets vox_offset,
+        scl_slope and scl_inter in its copy of the header
+    """
+    if fileReader is not None:
+        headerBytes = readGzipHeaderBytes(fileReader) if filePath.endswith('.gz') else fileReader.read(MAX_HEADER_SIZE)
+    elif filePath.endswith('.gz'):
+        with open(filePath, 'rb') as fileReader:
+            headerBytes = readGzipHeaderBytes(fileReader)
+    else:
+        # A single read on a file descriptor, which costs less than setting up a memory map
+        fileDescriptor = os.open(filePath, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            headerBytes = os.read(fileDescriptor, MAX_HEADER_SIZE)
+        finally:
+            os.close(fileDescriptor)
+
+    header = parseNiftiHeader(headerBytes)
+    if header is None:
+        if fileReader is not None:
+            raise ValueError('No NIfTI-1/2 header found in ' + filePath)
+        logging.debug('No NIfTI-1/2 header found, reading with nibabel: ' + filePath)
+        return readNiftiHeaderWithNibabel(filePath)
+    return header
+
+def readGzipHeaderBytes(fileReader):
+    """Decompress only as much of an open gzip file as the largest header needs."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    headerBytes = b''
+    while len(headerBytes) < MAX_HEADER_SIZE:
+        compressedBytes = fileReader.read(GZIP_READ_SIZE)
+        if not compressedBytes:
+            break
+        headerBytes += decompressor.decompress(decompressor.unconsumed_tail + compressedBytes,
+                                               MAX_HEADER_SIZE - len(headerBytes))
+    return headerBytes
+
+def parseNiftiHeader(headerBytes):
+    """Parse the first bytes of a file as a NIfTI-1/2 header, returns None if they aren't one."""
+    if len(headerBytes) < 4:
+        return None
+    for byteOrder in ('<', '>'):
+        sizeofHdr = int(np.frombuffer(headerBytes, dtype=byteOrder + 'i4', count=1)[0])
+        dtype = HEADER_DTYPES.get((sizeofHdr, byteOrder))
+        if dtype is not None and len(headerBytes) >= dtype.itemsize:
+            return np.frombuffer(headerBytes, dtype=dtype, count=1).reshape(())
+    return None
+
+def readNiftiHeaderWithNibabel(filePath):
+    return nib.load(filePath).header
@@ -1,152 +1,268 @@
-"""Contains script that moves all DCM tag-values from a directory of DCMs into a PostgreSQL DB."""
+"""Contains script that moves the header values of a directory of NIFTIs into a PostgreSQL DB."""
 import logging
 import sys
 import os
 import json
-from pathlib import Path
-import psycopg2
-import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 # This line is so modules using this package as a submodule can use this.
 sys.path.append(os.path.dirname(os.path.abspath(__file__)).replace('\\', '/'))
 #
-from config import config
-import basic_db_ops as bdo
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler
+from batchWriter import BatchWriter
+from niftiHeader import readNiftiHeader
+from pixelFeatures import getDerivedColumns, computeNiftiFeatures
+from fileDiscovery import findFiles
+from exportSinks import createSink, getDefaultExtension
+from archiveReader import MemberFilter, findArchiveFiles, readTarMembers, openMember, isTarArchive, splitMemberPath
 
 # Types of files we want from the dataset
 DESIRED_SUFFIXES = ['injured.nii', 'uninjured.nii']
 
-def nifti_to_db(elements_json, config_file_name, sectionName):
-    """Move all desired NIFTI metadata from a directory full of NIFTIs into a PostgreSQL DB.
-
-    This function goes through all of the NIFTI files in the directory specified in the 'postgresql'
-    section of the config file specified by config_file_name. For each NIFTI, the function reads the
-    values of the tags specified in the JSON named in elements_json and stores them all in a
-    PostgreSQL DB table where the columns are the tags and each row is a NIFTI.
-
-    Parameters
-    ----------
-    elements_json : string
-        The name of the JSON that contains the list of elements we want to read from the DICOM
-    config_file_name : string
-        The name of the file that contains DB and DICOM folder info
-    sectionName : string
-        Name of the section in the elements_json that has the column info for that table
-    """
-    logging.info('Attempting to store NIFTI metadata from DCMs in a folder to Postgres DB')
-    
-    # Create the database if it isn't already there
-    dbName = config(filename=config_file_name, section='postgresql')['database']
-    if not bdo.dbExists(config_file_name, dbName):
-        bdo.createNewDb(dbName)
-
-    # Create table if it isn't already there
-    dbName = config(filename=config_file_name, section='postgresql')['database']
-    tableName = config(filename=config_file_name, section='table_info')['metadata_tableName']
-    if not bdo.tableExists(config_file_name, dbName, tableName):
-        bdo.addTableToDb(tableName, elements_json, config_file_name, sectionName)
-
-    # Open the json with the list of elements we're interested in
-    with open(elements_json) as fileReader:
-        elementsDict = json.load(fileReader)
-    elementsOriginal = elementsDict[sectionName]
-
-    folder_path = config(filename=config_file_name, section='nifti_folder')['folder_path']
-    pathlist = Path(folder_path).glob('**/*.nii')
-    for path in pathlist:
-        # read each image in the subdirectories
-        file_path = str(path)
+NIFTI_EXTENSIONS = ['.nii', '.nii.gz']
+
+# Number of files that a worker process reads per task
+CHUNK_SIZE = 32
+
+class NiftiToDatabase:
+    def __init__(self, configHandler, dbHandler):
+        self.configHandler = configHandler
+        self.dbHandler = dbHandler
+
+    def niftiToDb(self, metaTableName, columnsInfoPath, sectionName='nifti_elements',
+                  nonElementSectionName='niftiNonElementColumns', indexSectionName='nifti_indexes',
+                  derivedSectionName='nifti_derived'):
+        """Move all desired NIFTI metadata from a directory full of NIFTIs into a PostgreSQL DB.
+
+        This function goes through all of the NIFTI files in the NIFTI folder of the config file.
+        For each NIFTI, the function reads the values of the header fields in the sectionName
+        section of the column spec, and the features of the data array in the optional
+        derivedSectionName section. The records are written in batched transactions over a
+        pooled connection, the table has a column per field and a row per NIFTI. If archives
+        are set in the config, the NIFTIs are read from them instead, without unpacking them.
+
+        Parameters
+        ----------
+        metaTableName : string
+            Name of the table the records are stored in
+        columnsInfoPath : string
+            Path of the JSON that contains the list of header fields we want to read from the NIFTIs
+        sectionName : string
+            Name of the section in the column spec that has the column info for that table
+        nonElementSectionName : string
+            Name of the section with the other columns, used to build the primary key after a fast load
+        indexSectionName : string
+            Name of the section with the indexes that are built after a fast load
+        derivedSectionName : string
+            Name of the section with the columns computed from the data array, if there is one
+        """
+        logging.info('Attempting to store NIFTI metadata from NIFTIs in a folder to Postgres DB')
+
+        with open(columnsInfoPath) as fileReader:
+            elementsDict = json.load(fileReader)
+        elements = elementsDict[sectionName]
+        elementNames = [elementName for elementName in elements.keys() if not elements[elementName]['calculation_only']]
+        derived = elementsDict.get(derivedSectionName, {})
+        derivedColumns = getDerivedColumns(derived)
+
+        loadMethod = self.configHandler.getLoadMethod()
+        if loadMethod == 'insert':
+            logging.warning('NIFTIs are always stored in batches, using COPY')
+            loadMethod = 'copy'
+        sinkName = self.configHandler.getExportSink()
+        fastLoad = self.configHandler.getFastLoad() and sinkName == 'postgres'
+        loadTableName = metaTableName
+        if fastLoad:
+            # Load into an unlogged table without indexes and build them once it's full
+            loadTableName = self.dbHandler.startFastLoad(metaTableName, columnsInfoPath, nonElementSectionName, sectionName)
+        columnNames = ['file_path'] + elementNames + [columnName for columnName, _ in derivedColumns]
+        if sinkName != 'postgres':
+            columnTypes = [elementsDict[nonElementSectionName]['file_path']['db_datatype']] \
+                + [elements[elementName]['db_datatype'] for elementName in elementNames] \
+                + [columnType for _, columnType in derivedColumns]
+            batchWriter = self.createSink(sinkName, metaTableName, columnNames, columnTypes, ['file_path'])
+        else:
+            if derivedColumns:
+                self.dbHandler.addColumns(loadTableName, derivedColumns)
+            batchWriter = self.createBatchWriter(loadTableName, columnNames, loadMethod)
+
+        memberFilter = MemberFilter(NIFTI_EXTENSIONS)
+        pathlist = self.findNiftiFiles(memberFilter)
 
+        if self.configHandler.getParallel():
+            self.storeInParallel(pathlist, elementNames, derived, memberFilter, batchWriter)
+        else:
+            for results in iterResults(elementNames, pathlist, memberFilter, derived):
+                self.storeResults(results, batchWriter)
+        batchWriter.close()
+        if fastLoad:
+            self.dbHandler.finishFastLoad(loadTableName, metaTableName, columnsInfoPath, nonElementSectionName, indexSectionName)
+
+        logging.info('Done storing metadata')
+
+    def storeInParallel(self, pathlist, elementNames, derived, memberFilter, batchWriter):
+        """Read the NIFTIs in a pool of worker processes and store the records from this process.
+
+        Every tar archive is handed to a worker on its own and the other files in chunks, so that
+        several archives and the members of a zip archive are read at the same time.
+        """
+        workers = self.configHandler.getWorkers()
+        logging.info('Reading NIFTIs with %d worker processes', workers)
+        pending = set()
+        chunk = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for filePath in pathlist:
+                if isTarArchive(filePath):
+                    pending.add(executor.submit(readRecords, elementNames, [filePath], memberFilter, derived))
+                else:
+                    chunk.append(filePath)
+                if len(chunk) == CHUNK_SIZE:
+                    pending.add(executor.submit(readRecords, elementNames, chunk, memberFilter, derived))
+                    chunk = []
+                # Keep a bounded number of tasks in flight
+                while len(pending) >= workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self.storeResults(future.result(), batchWriter)
+            if chunk:
+                pending.add(executor.submit(readRecords, elementNames, chunk, memberFilter, derived))
+            for future in wait(pending).done:
+                self.storeResults(future.result(), batchWriter)
+
+    def findNiftiFiles(self, memberFilter):
+        """Get a generator of the paths of the desired NIFTIs in the NIFTI folder, found as the walk goes.
+
+        If archives are set in the config, the NIFTIs are found in them instead, as archive!member
+        paths for zip archives and as the archive paths for tar archives.
+        """
+        archivePaths = self.configHandler.getNiftiArchivePaths()
+        if archivePaths:
+            pathlist = findArchiveFiles(archivePaths, memberFilter)
+        else:
+            pathlist = findFiles(self.configHandler.getNiftiFolderPath(), NIFTI_EXTENSIONS,
+                                 walkers=self.configHandler.getDiscoveryWalkers())
         # Only want image files that contain suffixes in the DESIRED_SUFFIXES list
-        suffix_exists_in_path = [suffix for suffix in DESIRED_SUFFIXES if(suffix in file_path)] 
-        if not bool(suffix_exists_in_path):
-            continue
+        return (str(path) for path in pathlist if isTarArchive(str(path)) or isDesired(str(path)))
+
+    def storeResults(self, results, batchWriter):
+        for filePath, record, error in results:
+            if error is None:
+                logging.debug('Buffering: ' + filePath)
+                batchWriter.addRecord(record)
+            else:
+                logging.warning('Cannot store %s: %s', filePath, error)
+
+    def createBatchWriter(self, metaTableName, columnNames, loadMethod):
+        """Create the writer that the records are handed to, override to send them elsewhere."""
+        return BatchWriter(self.dbHandler, metaTableName, columnNames, self.configHandler.getBatchSize(), loadMethod)
+
+    def createSink(self, sinkName, tableName, columnNames, columnTypes, keyColumns=None):
+        """Create the export sink that the records are written to instead of the DB."""
+        outputPath = self.configHandler.getExportPath(tableName + getDefaultExtension(sinkName))
+        logging.info('Writing the records to %s with the %s sink', outputPath, sinkName)
+        return createSink(sinkName, outputPath, tableName, columnNames, columnTypes, keyColumns,
+                          self.configHandler.getExportBatchSize())
 
-        elements = elementsOriginal.copy()
+    def createSqlQuery(self, metaTableName, elements, filePath):
+        """Create the SQL query for inserting a record.
 
-        logging.info('Storing: ' + file_path)
+        Returns
+        -------
+        (string, list)
+            Return the completed SQL query and a list of the values that will be formatted
+            into the SQL query by the psycopg2 execute function.
+        """
+        elementNames = [elementName for elementName in elements.keys() if not elements[elementName]['calculation_only']]
+        names = ['file_path'] + elementNames
+        placeholders = ['%s'] * len(names)
 
-        # Insert the DICOM metadata as a new record in the Postgres DB
-        conn = None
+        # Build the SQL query
+        sqlQuery = 'INSERT INTO ' + metaTableName + ' (' + ', '.join(names) + ')' + os.linesep \
+            + 'VALUES (' + ', '.join(placeholders) + ');'
+
+        return (sqlQuery, list(readRecord(elementNames, filePath)))
+
+def isDesired(filePath):
+    return any(suffix in filePath for suffix in DESIRED_SUFFIXES)
+
+def iterResults(elementNames, pathlist, memberFilter, derived=None):
+    """Read the NIFTIs of pathlist a chunk at a time, yielding the results of readRecords for every chunk."""
+    chunk = []
+    for filePath in pathlist:
+        chunk.append(str(filePath))
+        if len(chunk) == CHUNK_SIZE:
+            yield readRecords(elementNames, chunk, memberFilter, derived)
+            chunk = []
+    if chunk:
+        yield readRecords(elementNames, chunk, memberFilter, derived)
+
+def readRecords(elementNames, filePaths, memberFilter, derived=None):
+    """Read the records of a chunk of NIFTIs, runs in the worker processes.
+
+    If derived is given, the features of the data array in it are computed into the last values
+    of the records.
+
+    A tar archive in filePaths is read in one pass, its desired members that pass memberFilter
+    are the NIFTIs of the chunk.
+
+    Returns a list of (filePath, record, error) where error is None if the NIFTI could be read,
+    otherwise the exception type and message.
+    """
+    results = []
+    for filePath in filePaths:
+        if not isTarArchive(filePath):
+            results.append(readResult(elementNames, filePath, derived=derived))
+            continue
         try:
-            # read the connection parameters
-            params = config(filename=config_file_name, section='postgresql')
-            tableName = config(filename=config_file_name, section='table_info')['metadata_tableName']
-            # # connect to the PostgreSQL server
-            conn = psycopg2.connect(**params)
-            cur = conn.cursor()
-            # Create the SQL query to be used
-            sqlQuery, values = createSqlQuery(tableName, elements, file_path)
-            logging.debug('SQL Query: %s', sqlQuery)
-            # create table one by one
-            cur.execute(sqlQuery, values)
-            # close communication with the PostgreSQL database server
-            cur.close()
-            # commit the changes
-            conn.commit()
-            logging.info('Stored')
-        except (psycopg2.DatabaseError) as error:
-            logging.warning(error)
-            logging.warning('Not stored')
-        finally:
-            if conn is not None:
-                conn.close()
-
-# TODO: Create a more specific name for this function
-def createSqlQuery(tableName, elements, file_path):
-    """Create the SQL query for inserting a record.
-
-    This function reads each element in elementsDict from the NIFTI specified by file_path and
-    formats the data into a SQL query to be later executed by psycopg2.
-
-    Parameters
-    ----------
-    tableName : string
-        The name of the table that the SQL query is to be aimed at
-    elements : dict
-        The dictionary containing all of the info from the elements_json
-    file_path : [type]
-        The file path of the DCM we're interested in
-
-    Returns
-    -------
-    (string, list)
-        Return the completed SQL query and a list of the values that will be formatted
-        into the SQL query by the psycopg2 execute function.
+            for memberPath, fileReader in readTarMembers(filePath, memberFilter):
+                if isDesired(memberPath):
+                    results.append(readResult(elementNames, memberPath, fileReader, derived))
+        except Exception as error:
+            results.append((filePath, None, type(error).__name__ + ': ' + str(error)))
+    return results
+
+def readResult(elementNames, filePath, fileReader=None, derived=None):
+    try:
+        return (filePath, readRecord(elementNames, filePath, fileReader, derived), None)
+    except Exception as error:
+        return (filePath, None, type(error).__name__ + ': ' + str(error))
+
+def readRecord(elementNames, filePath, fileReader=None, derived=None):
+    """Read the header fields from a NIFTI and create its record, file_path first.
+
+    A NIFTI in an archive is read from the archive!member path, or from fileReader if it's given.
+    The features of the data array in derived come after the header fields.
     """
-    img = nib.load(file_path)
+    if fileReader is None and splitMemberPath(filePath)[1] is not None:
+        with openMember(filePath) as memberReader:
+            return readRecord(elementNames, filePath, memberReader, derived)
+    header = readNiftiHeader(filePath, fileReader)
     # Go through the list of elements and try to read the value
-    for elementName in elements.keys():
+    values = [filePath]
+    for elementName in elementNames:
         try:
-            value = img.header[elementName]
+            value = header[elementName]
             if isinstance(value, np.ndarray):
                 value = value.tolist()
-            elements[elementName]['value'] = value
-        except (KeyError) as tag: # if the value isn't there, then set it as None
+            if isinstance(value, bytes):
+                value = value.rstrip(b'\x00').decode('latin-1')
+            values.append(value)
+        except (KeyError, ValueError): # if the value isn't there, then set it as None
             logging.warning('Cannot read the following NIFTI tag: ' + elementName)
-            elements[elementName]['value'] = None
-            continue
-
-    # Adjust the data as necessary before storing
-    # dataAdjustments(elements)
-
-    # Create the list of values that we're going to use to build the query
-    names = ['file_path']
-    values = [file_path]
-    placeholders = ['%s']
-    # Append any value to this list that isn't birth_date or study_date
-    for elementName in elements.keys():
-        if not elements[elementName]['calculation_only']:
-            names.append(elementName)
-            values.append(elements[elementName]['value'])
-            placeholders.append('%s')
-
-    # Build the SQL query
-    sqlQuery = 'INSERT INTO ' + tableName + ' (' + ', '.join(names) + ')' + os.linesep \
-        + 'VALUES (' + ', '.join(placeholders) + ');'
-
-    return (sqlQuery, values)
+            values.append(None)
+    if derived:
+        values.extend(computeNiftiFeatures(derived, filePath, fileReader, int(header['sizeof_hdr'])))
+    return tuple(values)
 
 if __name__ == "__main__":
     logging.basicConfig(filename='nifti_to_db.log', level=logging.INFO)
-    nifti_to_db('elements.json', 'config.ini', 'nifti_elements')
+    configHandler = MetaToDbConfigHandler('config.ini')
+    niftiTableName = configHandler.getTableName('nifti_metadata')
+    dbHandler = None
+    # The other sinks write a file and don't need the DB
+    if configHandler.getExportSink() == 'postgres':
+        dbHandler = DatabaseHandler(configHandler)
+        if not dbHandler.tableExists(niftiTableName):
+            dbHandler.addTableToDb(niftiTableName, configHandler.getColumnsInfoFullPath(), 'niftiNonElementColumns', 'nifti_elements', 'nifti_indexes')
+    NiftiToDatabase(configHandler, dbHandler).niftiToDb(niftiTableName, configHandler.getColumnsInfoFullPath())
@@ -0,0 +1,200 @@
+"""Module contains functions for computing features of the pixel data of images, one frame at a time.
+
+The features are declared in the derived section of the column spec, e.g.
+"pixel_p99": {"feature": "percentile", "q": 99} or "thumbnail": {"feature": "thumbnail", "size": 16}.
+They are computed on the values after the rescale slope and intercept are applied, and only one
+frame or slice of an image is in memory at a time, so large multi-frame images and volumes don't
+need more memory than a single frame.
+"""
+import gzip
+import math
+import itertools
+import numpy as np
+import nibabel as nib
+import pydicom as pdm
+from pydicom.pixels import iter_pixels
+
+FEATURES = ('min', 'max', 'mean', 'std', 'percentile', 'zero_fraction', 'thumbnail')
+
+# Tags that are needed besides the pixel data to compute the features
+NUMBER_OF_FRAMES_TAG = pdm.tag.Tag(0x0028, 0x0008)
+RESCALE_INTERCEPT_TAG = pdm.tag.Tag(0x0028, 0x1052)
+RESCALE_SLOPE_TAG = pdm.tag.Tag(0x0028, 0x1053)
+PIXEL_TAGS = [NUMBER_OF_FRAMES_TAG, RESCALE_INTERCEPT_TAG, RESCALE_SLOPE_TAG]
+
+# Number of values the percentiles of an image are estimated from, sampled evenly over its frames
+PERCENTILE_SAMPLE_SIZE = 1 << 20
+
+DEFAULT_THUMBNAIL_SIZE = 16
+
+def getDerivedColumns(derived):
+    """Check the derived section of the column spec, returns the (column name, DB datatype) of every column."""
+    columns = []
+    for columnName, spec in derived.items():
+        feature = spec.get('feature')
+        if feature not in FEATURES:
+            raise Exception('Unknown feature {0} of derived column {1}, use one of {2}'.format(feature, columnName, ', '.join(FEATURES)))
+        if feature == 'percentile' and not 0 <= spec.get('q', -1) <= 100:
+            raise Exception('Derived column {0} needs a percentile q between 0 and 100'.format(columnName))
+        # A thumbnail is 2D, which PostgreSQL doesn't tell apart from REAL[] but Arrow does
+        defaultDatatype = 'REAL[][]' if feature == 'thumbnail' else 'DOUBLE PRECISION'
+        columns.append((columnName, spec.get('db_datatype', defaultDatatype)))
+    return columns
+
+class PixelFeatures:
+    """Features of an image that are updated a frame at a time.
+
+    The mean and standard deviation are merged per frame with the parallel variance formula, the
+    percentiles are estimated from an even sample of at most PERCENTILE_SAMPLE_SIZE values and
+    the thumbnail is the block mean of the middle frame.
+    """
+    def __init__(self, derived, frameCount):
+        self.derived = derived
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minValue = None
+        self.maxValue = None
+        self.zeroCount = 0
+        self.samples = []
+        self.sampleSize = max(1, PERCENTILE_SAMPLE_SIZE // max(frameCount, 1))
+        self.needsSamples = any(spec['feature'] == 'percentile' for spec in derived.values())
+        self.thumbnailSizes = set(spec.get('size', DEFAULT_THUMBNAIL_SIZE) for spec in derived.values()
+                                  if spec['feature'] == 'thumbnail')
+        self.thumbnailIndex = frameCount // 2
+        self.thumbnails = {}
+
+    def addFrame(self, frame, index):
+        values = np.asarray(frame, dtype=np.float64)
+        if values.size == 0:
+            return
+        frameCount = values.size
+        frameMean = float(values.mean())
+        frameM2 = float(np.square(values - frameMean).sum())
+        delta = frameMean - self.mean
+        total = self.count + frameCount
+        self.mean += delta * frameCount / total
+        self.m2 += frameM2 + delta * delta * self.count * frameCount / total
+        self.count = total
+
+        frameMin, frameMax = float(values.min()), float(values.max())
+        self.minValue = frameMin if self.minValue is None else min(self.minValue, frameMin)
+        self.maxValue = frameMax if self.maxValue is None else max(self.maxValue, frameMax)
+        self.zeroCount += frameCount - int(np.count_nonzero(values))
+
+        if self.needsSamples:
+            flatValues = values.ravel()
+            self.samples.append(flatValues[::max(1, math.ceil(flatValues.size / self.sampleSize))].copy())
+        if index == self.thumbnailIndex:
+            # Color frames are averaged over their samples
+            image = values.mean(axis=-1) if values.ndim == 3 else values.reshape(values.shape[0], -1)
+            for size in self.thumbnailSizes:
+                self.thumbnails[size] = downsample(image, size)
+
+    def getValues(self):
+        """Get the value of every derived column, in the order of the derived section."""
+        sample = np.concatenate(self.samples) if self.samples else None
+        values = []
+        for spec in self.derived.values():
+            feature = spec['feature']
+            if self.count == 0:
+                values.append(None)
+            elif feature == 'min':
+                values.append(self.minValue)
+            elif feature == 'max':
+                values.append(self.maxValue)
+            elif feature == 'mean':
+                values.append(self.mean)
+            elif feature == 'std':
+                values.append(math.sqrt(self.m2 / self.count))
+            elif feature == 'percentile':
+                values.append(float(np.percentile(sample, spec['q'])))
+            elif feature == 'zero_fraction':
+                values.append(self.zeroCount / self.count)
+            else:
+                thumbnail = self.thumbnails.get(spec.get('size', DEFAULT_THUMBNAIL_SIZE))
+                values.append(None if thumbnail is None else np.round(thumbnail, 3).tolist())
+        return tuple(values)
+
+def downsample(image, size):
+    """Shrink a 2D image to at most size x size by averaging the blocks of pixels."""
+    rowEdges = np.linspace(0, image.shape[0], min(size, image.shape[0]) + 1).astype(np.int64)
+    columnEdges = np.linspace(0, image.shape[1], min(size, image.shape[1]) + 1).astype(np.int64)
+    sums = np.add.reduceat(np.add.reduceat(image, rowEdges[:-1], axis=0), columnEdges[:-1], axis=1)
+    return sums / np.outer(np.diff(rowEdges), np.diff(columnEdges))
+
+def computeDicomFeatures(derived, dcm, source):
+    """Compute the derived columns of a DCM from its pixel data, source is the DCM's path or open file.
+
+    dcm only needs the tags in PIXEL_TAGS, the frames are decoded one at a time from source.
+    A DCM without pixel data, e.g. a structured report, gets None in every derived column.
+    """
+    slope = getNumber(dcm, RESCALE_SLOPE_TAG, 1.0)
+    intercept = getNumber(dcm, RESCALE_INTERCEPT_TAG, 0.0)
+    frameCount = int(getNumber(dcm, NUMBER_OF_FRAMES_TAG, 1))
+    frames = iterDicomFrames(source)
+    # The pixel data element is looked for when the first frame is decoded, errors after that are raised
+    try:
+        firstFrame = next(frames)
+    except (AttributeError, StopIteration): # no pixel data element or no frames in it
+        return (None,) * len(derived)
+    features = PixelFeatures(derived, frameCount)
+    for index, frame in enumerate(itertools.chain([firstFrame], frames)):
+        features.addFrame(frame * slope + intercept, index)
+    return features.getValues()
+
+def iterDicomFrames(source):
+    """Yield the frames of a DCM's pixel data, decoding only one of them at a time."""
+    if not isinstance(source, str):
+        source.seek(0)
+    return iter_pixels(source)
+
+def getNumber(dcm, tag, default):
+    element = dcm.get(tag)
+    if element is None or element.value is None or element.value == '':
+        return default
+    return float(element.value)
+
+def computeNiftiFeatures(derived, filePath, fileReader=None, sizeofHdr=348):
+    """Compute the derived columns of a NIFTI from its data array, a 2D slice at a time.
+
+    The file is read once from start to end, the slices in the order they are stored in, and
+    scl_slope and scl_inter are applied to them. Reading every slice through nibabel's array
+    proxy would decompress a gzip file from its start again for each slice. If fileReader is
+    given, e.g. for a file in an archive, the image is read from it instead of from filePath.
+    """
+    if fileReader is not None:
+        fileReader.seek(0)
+        if filePath.endswith('.gz'):
+            fileReader = gzip.GzipFile(fileobj=fileReader)
+        return computeStreamFeatures(derived, fileReader, sizeofHdr)
+    with (gzip.open(filePath, 'rb') if filePath.endswith('.gz') else open(filePath, 'rb')) as fileReader:
+        return computeStreamFeatures(derived, fileReader, sizeofHdr)
+
+def computeStreamFeatures(derived, fileReader, sizeofHdr=348):
+    """Compute the derived columns of a NIFTI that is read from the start of an uncompressed stream."""
+    headerClass = nib.Nifti2Header if sizeofHdr == 540 else nib.Nifti1Header
+    header = headerClass.from_fileobj(fileReader)
+    dtype = header.get_data_dtype()
+    shape = tuple(int(length) for length in header.get_data_shape())
+    shape = shape + (1,) * (2 - len(shape))
+    slope, intercept = header.get_slope_inter()
+
+    # The data array is stored in Fortran order, so every 2D slice is a contiguous run of bytes
+    sliceShape = shape[:2]
+    sliceCount = int(np.prod(shape[2:], dtype=np.int64))
+    sliceSize = int(np.prod(sliceShape, dtype=np.int64)) * dtype.itemsize
+    dataOffset = int(header.get_data_offset())
+    if dataOffset > fileReader.tell():
+        fileReader.seek(dataOffset)
+
+    features = PixelFeatures(derived, sliceCount)
+    for index in range(sliceCount):
+        sliceBytes = fileReader.read(sliceSize)
+        if len(sliceBytes) < sliceSize:
+            raise ValueError('The data array ends after {0} of {1} slices'.format(index, sliceCount))
+        image = np.frombuffer(sliceBytes, dtype=dtype).reshape(sliceShape, order='F')
+        if slope is not None:
+            image = image * slope + intercept
+        features.addFrame(image, index)
+    return features.getValues()
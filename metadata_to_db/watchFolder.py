@@ -0,0 +1,22 @@
+"""Contains script that keeps storing the DCMs that arrive in the unpack folder until it is stopped."""
+import logging
+import signal
+import threading
+import sys
+import os
+# This line is so modules using this package as a submodule can use this.
+sys.path.append(os.path.dirname(os.path.abspath(__file__)).replace('\\', '/'))
+#
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler
+from dicomToDb import DicomToDatabase
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='watch_folder.log', level=logging.INFO)
+    configHandler = MetaToDbConfigHandler('config.ini')
+    dbHandler = DatabaseHandler(configHandler)
+    metaTableName = configHandler.getTableName('metadata')
+    # Stop between batches on SIGTERM, e.g. from a service manager
+    stopEvent = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: stopEvent.set())
+    DicomToDatabase(configHandler, dbHandler).watchFolder(metaTableName, configHandler.getColumnsInfoFullPath(), stopEvent)
@@ -14,8 +14,20 @@ setuptools.setup(
     url="https://github.com/Matt-Conrad/DicomToDatabase",
     packages=setuptools.find_packages(),
     classifiers=[
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.10",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.10',
+    install_requires=[
+        "psycopg2>=2.9",
+        "pydicom>=3.0",
+        "numpy>=1.22",
+        "nibabel>=5.0",
+    ],
+    extras_require={
+        # For the Parquet export sink and Arrow record batches
+        "parquet": ["pyarrow>=12.0"],
+        # For benchmark/benchmarkTransform.py, which compares the age transform with relativedelta
+        "benchmark": ["python-dateutil>=2.8"],
+    },
 )
\ No newline at end of file
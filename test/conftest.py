@@ -0,0 +1,9 @@
+"""Lets the tests import the modules of metadata_to_db like its scripts do.
+
+testM2Db.py stores a folder of DCMs in the DB of the config and is run on its own, not by pytest.
+"""
+import os, sys
+projectDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(projectDir, "metadata_to_db"))
+
+collect_ignore = ["testM2Db.py"]
@@ -0,0 +1,125 @@
+import io
+import os
+import zipfile
+import tarfile
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+import archiveReader
+from archiveReader import MemberFilter, splitMemberPath, joinMemberPath, getSourcePath, statFile, \
+    findArchiveFiles, readTarMembers, openMember
+from extractionPlan import ExtractionPlan
+from dicomToDb import readRecords
+
+def createDcmBytes(patientId):
+    dcm = Dataset()
+    dcm.PatientID = patientId
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'
+    dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    fileWriter = io.BytesIO()
+    dcm.save_as(fileWriter, enforce_file_format=True)
+    return fileWriter.getvalue()
+
+MEMBERS = {
+    'study/a.dcm': createDcmBytes('A'),
+    'study/series/IMG0001': createDcmBytes('B'),
+    'study/notes.txt': b'not a DCM' * 20,
+    'study/C.DCM': createDcmBytes('C'),
+}
+
+def writeZip(archivePath):
+    with zipfile.ZipFile(archivePath, 'w', zipfile.ZIP_DEFLATED) as zipFile:
+        zipFile.writestr('study/', b'')
+        for memberName, content in MEMBERS.items():
+            zipFile.writestr(memberName, content)
+    return archivePath
+
+def writeTar(archivePath):
+    with tarfile.open(archivePath, 'w:gz' if archivePath.endswith('gz') else 'w') as tarFile:
+        for memberName, content in MEMBERS.items():
+            info = tarfile.TarInfo(memberName)
+            info.size = len(content)
+            tarFile.addfile(info, io.BytesIO(content))
+    return archivePath
+
+@pytest.fixture(autouse=True)
+def closeArchives():
+    yield
+    while archiveReader.openArchives:
+        archiveReader.openArchives.popitem()[1].close()
+
+def testSplitMemberPath():
+    assert splitMemberPath('/data/scans.zip!study/a.dcm') == ('/data/scans.zip', 'study/a.dcm')
+    assert splitMemberPath('/data/scans.TAR.GZ!a.dcm') == ('/data/scans.TAR.GZ', 'a.dcm')
+    # Only a separator after an archive path splits the path
+    assert splitMemberPath('/data/a!b/scans.tgz!c!d.dcm') == ('/data/a!b/scans.tgz', 'c!d.dcm')
+    assert splitMemberPath('/data/a!b/image.dcm') == ('/data/a!b/image.dcm', None)
+    assert splitMemberPath(joinMemberPath('/data/scans.zip', 'x.dcm')) == ('/data/scans.zip', 'x.dcm')
+
+def testSourcePath(tmp_path):
+    # Tar members are read with their archive, zip members on their own
+    assert getSourcePath('/data/scans.tar!a.dcm') == '/data/scans.tar'
+    assert getSourcePath('/data/scans.zip!a.dcm') == '/data/scans.zip!a.dcm'
+    assert getSourcePath('/data/image.dcm') == '/data/image.dcm'
+    archivePath = writeZip(str(tmp_path / 'scans.zip'))
+    assert statFile(joinMemberPath(archivePath, 'study/a.dcm')).st_size == os.stat(archivePath).st_size
+
+@pytest.mark.parametrize("detectDicom", [False, True])
+def testFindArchiveFiles(tmp_path, detectDicom):
+    zipPath = writeZip(str(tmp_path / 'scans.zip'))
+    tarPath = writeTar(str(tmp_path / 'scans.tar.gz'))
+    otherPath = str(tmp_path / 'scans.rar')
+    memberNames = ['study/a.dcm', 'study/series/IMG0001', 'study/C.DCM'] if detectDicom else ['study/a.dcm', 'study/C.DCM']
+    found = list(findArchiveFiles([zipPath, otherPath, tarPath], MemberFilter(['.dcm'], detectDicom)))
+    assert found == [joinMemberPath(zipPath, memberName) for memberName in memberNames] + [tarPath]
+
+def testBrokenZipIsSkipped(tmp_path):
+    archivePath = str(tmp_path / 'broken.zip')
+    with open(archivePath, 'wb') as fileWriter:
+        fileWriter.write(b'not a zip archive')
+    assert list(findArchiveFiles([archivePath], MemberFilter(['.dcm']))) == []
+
+@pytest.mark.parametrize("archiveName", ['scans.tar', 'scans.tar.gz'])
+@pytest.mark.parametrize("detectDicom", [False, True])
+def testReadTarMembers(tmp_path, archiveName, detectDicom):
+    archivePath = writeTar(str(tmp_path / archiveName))
+    memberNames = ['study/a.dcm', 'study/series/IMG0001', 'study/C.DCM'] if detectDicom else ['study/a.dcm', 'study/C.DCM']
+    members = list(readTarMembers(archivePath, MemberFilter(['.dcm'], detectDicom)))
+    assert [memberPath for memberPath, _ in members] == [joinMemberPath(archivePath, memberName) for memberName in memberNames]
+    assert [fileReader.read() for _, fileReader in members] == [MEMBERS[memberName] for memberName in memberNames]
+
+@pytest.mark.parametrize("archiveName", ['scans.zip', 'scans.tar.gz'])
+def testOpenMember(tmp_path, archiveName):
+    archivePath = str(tmp_path / archiveName)
+    if archiveName.endswith('.zip'):
+        writeZip(archivePath)
+    else:
+        writeTar(archivePath)
+    for memberName in ['study/C.DCM', 'study/a.dcm']:
+        with openMember(joinMemberPath(archivePath, memberName)) as fileReader:
+            assert fileReader.read() == MEMBERS[memberName]
+    # The archive is kept open for the next member
+    assert list(archiveReader.openArchives.keys()) == [archivePath]
+    with pytest.raises(KeyError):
+        openMember(joinMemberPath(archivePath, 'study/missing.dcm'))
+
+def testOpenArchivesAreLimited(tmp_path, monkeypatch):
+    monkeypatch.setattr(archiveReader, 'MAX_OPEN_ARCHIVES', 2)
+    archivePaths = [writeZip(str(tmp_path / 'scans{0}.zip'.format(index))) for index in range(3)]
+    for archivePath in archivePaths + archivePaths[:1]:
+        openMember(joinMemberPath(archivePath, 'study/a.dcm')).close()
+    assert list(archiveReader.openArchives.keys()) == [archivePaths[2], archivePaths[0]]
+
+def testReadRecordsFromArchives(tmp_path):
+    zipPath = writeZip(str(tmp_path / 'scans.zip'))
+    tarPath = writeTar(str(tmp_path / 'scans.tgz'))
+    plan = ExtractionPlan({'patient_id': {'tag': '0x0010, 0x0020', 'db_datatype': 'VARCHAR(64)', 'calculation_only': False}})
+    results, _ = readRecords(plan, [joinMemberPath(zipPath, 'study/C.DCM'), tarPath], str(tmp_path),
+                             memberFilter=MemberFilter(['.dcm']))
+    assert results == [
+        (joinMemberPath(zipPath, 'study/C.DCM'), ('C.DCM', 'scans.zip!study/C.DCM', 'C'), None),
+        (joinMemberPath(tarPath, 'study/a.dcm'), ('a.dcm', 'scans.tgz!study/a.dcm', 'A'), None),
+        (joinMemberPath(tarPath, 'study/C.DCM'), ('C.DCM', 'scans.tgz!study/C.DCM', 'C'), None),
+    ]
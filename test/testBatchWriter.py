@@ -0,0 +1,101 @@
+import psycopg2
+import pytest
+from ingestMetrics import NullMetrics
+from batchWriter import BatchWriter
+
+class FakeCursor:
+    def execute(self, query, values=None):
+        pass
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.commitCount = 0
+
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        self.commitCount += 1
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+
+class FakeDbHandler:
+    """Stands in for DatabaseHandler, keeps the stored records and fails the writes it is told to."""
+    def __init__(self):
+        self.metrics = NullMetrics()
+        self.storedRecords = []
+        self.badValues = set()
+        self.connections = []
+        self.returnedConnections = []
+        # Raised by a write on a closed connection, psycopg2 raises OperationalError if it finds the connection lost
+        self.lostError = psycopg2.InterfaceError
+
+    def getPooledConnection(self):
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+    def returnPooledConnection(self, connection, close=False):
+        self.returnedConnections.append((connection, close))
+
+    def copyRecords(self, connection, tableName, columnNames, records, conflictColumns=None):
+        if connection.closed:
+            raise self.lostError('connection already closed')
+        if any(record[1] in self.badValues for record in records):
+            raise psycopg2.DataError('invalid input syntax')
+        self.storedRecords.extend(records)
+
+    def insertRecords(self, connection, tableName, columnNames, records, conflictColumns=None):
+        self.copyRecords(connection, tableName, columnNames, records, conflictColumns)
+
+def createBatchWriter(dbHandler, batchSize=10):
+    return BatchWriter(dbHandler, 'metadata', ['file_path', 'value'], batchSize)
+
+@pytest.mark.parametrize("error", [psycopg2.InterfaceError, psycopg2.OperationalError])
+def testBatchIsKeptWhenTheConnectionIsLost(error):
+    dbHandler = FakeDbHandler()
+    dbHandler.lostError = error
+    batchWriter = createBatchWriter(dbHandler)
+    batchWriter.addRecord(('a.dcm', 1))
+    batchWriter.addRecord(('b.dcm', 2))
+
+    batchWriter.connection.closed = 2
+    with pytest.raises(error):
+        batchWriter.flush()
+    assert batchWriter.buffer == [('a.dcm', 1), ('b.dcm', 2)]
+
+    lostConnection = batchWriter.connection
+    batchWriter.reconnect()
+    assert dbHandler.returnedConnections == [(lostConnection, True)]
+    batchWriter.addRecord(('c.dcm', 3))
+    batchWriter.close()
+    assert dbHandler.storedRecords == [('a.dcm', 1), ('b.dcm', 2), ('c.dcm', 3)]
+    assert batchWriter.writtenCount == 3
+
+def testFailedReconnectKeepsTheLostConnection():
+    dbHandler = FakeDbHandler()
+    batchWriter = createBatchWriter(dbHandler)
+    lostConnection = batchWriter.connection
+    lostConnection.closed = 2
+    def getPooledConnection():
+        raise psycopg2.OperationalError('could not connect to server')
+    dbHandler.getPooledConnection = getPooledConnection
+    with pytest.raises(psycopg2.OperationalError):
+        batchWriter.reconnect()
+    assert batchWriter.connection is lostConnection
+    assert dbHandler.returnedConnections == []
+
+def testOffendingRecordsAreDropped():
+    dbHandler = FakeDbHandler()
+    dbHandler.badValues = {'x'}
+    batchWriter = createBatchWriter(dbHandler, batchSize=3)
+    for record in [('a.dcm', 1), ('b.dcm', 'x'), ('c.dcm', 3)]:
+        batchWriter.addRecord(record)
+    assert dbHandler.storedRecords == [('a.dcm', 1), ('c.dcm', 3)]
+    assert [record for record, _ in batchWriter.failedRecords] == [('b.dcm', 'x')]
+    assert batchWriter.buffer == []
@@ -0,0 +1,116 @@
+import random
+from collections import Counter
+import pytest
+from columnStats import HyperLogLog, ColumnStats, StatsCollector
+
+def createHyperLogLog(keys):
+    hyperLogLog = HyperLogLog()
+    for key in keys:
+        hyperLogLog.add(key)
+    return hyperLogLog
+
+@pytest.mark.parametrize("distinctCount", [0, 1, 50, 1000, 20000, 200000])
+def testHyperLogLogCount(distinctCount):
+    hyperLogLog = createHyperLogLog('value{0}'.format(index) for index in range(distinctCount))
+    # Four standard errors of 2^12 registers
+    assert abs(hyperLogLog.count() - distinctCount) <= max(1, 0.065 * distinctCount)
+
+def testHyperLogLogMerge():
+    keys = ['1.2.840.{0}'.format(index) for index in range(30000)]
+    parts = [keys[:12000], keys[8000:20000], keys[20000:]]
+    merged = HyperLogLog()
+    for part in parts:
+        merged.merge(createHyperLogLog(part))
+    # The same registers as adding every value to one, whatever the overlap and order
+    assert merged.registers == createHyperLogLog(keys).registers
+    reversedMerge = createHyperLogLog(parts[2])
+    reversedMerge.merge(createHyperLogLog(parts[1]))
+    reversedMerge.merge(createHyperLogLog(parts[0]))
+    assert reversedMerge.registers == merged.registers
+    # Values added to both aren't counted twice
+    doubled = createHyperLogLog(keys)
+    doubled.merge(createHyperLogLog(keys))
+    assert doubled.count() == createHyperLogLog(keys).count()
+    assert HyperLogLog(bytes(merged.registers)).count() == merged.count()
+
+def createStats(values, topValueCount, batchSize=1000):
+    stats = ColumnStats(topValueCount)
+    for start in range(0, len(values), batchSize):
+        stats.addValues(values[start:start + batchSize])
+    return stats
+
+def createSkewedValues(count, seed):
+    """A few frequent values and a long tail of rare ones."""
+    rng = random.Random(seed)
+    return [rng.choice(['CT', 'MR', 'CR', 'DX']) if rng.random() < 0.6 else 'rare{0}'.format(rng.randrange(count))
+            for _ in range(count)]
+
+def checkTopValues(stats, values, topValueCount):
+    """Misra-Gries keeps every value in more than 1/(k+1) of the values, undercounting each by at most n/(k+1)."""
+    trueCounts = Counter(values)
+    maxError = len(values) / (topValueCount + 1)
+    assert len(stats.topValues) <= topValueCount
+    for key, count in stats.topValues.items():
+        assert trueCounts[key] - maxError <= count <= trueCounts[key]
+    for key, count in trueCounts.items():
+        if count > maxError:
+            assert key in stats.topValues
+
+@pytest.mark.parametrize("topValueCount", [5, 20])
+def testTopValuesOfOneStream(topValueCount):
+    values = createSkewedValues(20000, 0)
+    checkTopValues(createStats(values, topValueCount), values, topValueCount)
+
+@pytest.mark.parametrize("topValueCount", [5, 20])
+def testTopValuesOfMergedStreams(topValueCount):
+    # Batches written by different workers, each with a different mix of values
+    parts = [createSkewedValues(7000, seed) for seed in range(1, 5)]
+    parts.append(['US'] * 3000 + ['rare'] * 10)
+    merged = ColumnStats(topValueCount)
+    for part in parts:
+        merged.merge(createStats(part, topValueCount, batchSize=333))
+    values = [value for part in parts for value in part]
+    checkTopValues(merged, values, topValueCount)
+    assert merged.rowCount == len(values)
+
+def testFewDistinctValuesAreCountedExactly():
+    values = ['AXIAL', 'AXIAL', None, 'LOCALIZER', 'AXIAL', None] * 100
+    merged = createStats(values[:250], 10, batchSize=7)
+    merged.merge(createStats(values[250:], 10, batchSize=11))
+    assert merged.getTopValues() == [['AXIAL', 300], ['LOCALIZER', 100]]
+    assert merged.nullCount == 200
+    assert merged.distinct.count() == 2
+
+def testNumericRangeAndRoundTrip():
+    first = createStats([3, 1.5, None, True, 'x'], 10)
+    second = createStats([-2, 40, [0.5, 0.5]], 10)
+    first.merge(second)
+    assert (first.rowCount, first.nullCount, first.minValue, first.maxValue) == (8, 1, -2.0, 40.0)
+    assert ['0.5\\0.5', 1] in first.getTopValues()
+
+    stored = ColumnStats.fromRow(first.toRow(), 10)
+    assert stored.toRow() == first.toRow()
+
+class FakeDbHandler:
+    """Stands in for DatabaseHandler, keeps the stats table rows of one table."""
+    def __init__(self):
+        self.rows = {}
+
+    def lockColumnStats(self, connection, statsTableName, tableName, columnNames):
+        return {columnName: self.rows[columnName] for columnName in columnNames if columnName in self.rows}
+
+    def writeColumnStats(self, connection, statsTableName, tableName, rows):
+        for row in rows:
+            self.rows[row[0]] = row[1:]
+
+def testStatsCollectorMergesIntoStoredRows():
+    dbHandler = FakeDbHandler()
+    collector = StatsCollector('column_stats', 'metadata', ['file_path', 'modality', 'rows'], ['modality', 'rows'])
+    collector.store(dbHandler, None, [('a.dcm', 'CT', 512), ('b.dcm', 'MR', 256)])
+    collector.store(dbHandler, None, [('c.dcm', 'CT', None)])
+    collector.store(dbHandler, None, [])
+    modality = ColumnStats.fromRow(dbHandler.rows['modality'])
+    assert modality.rowCount == 3
+    assert modality.getTopValues() == [['CT', 2], ['MR', 1]]
+    rows = ColumnStats.fromRow(dbHandler.rows['rows'])
+    assert (rows.nullCount, rows.minValue, rows.maxValue) == (1, 256.0, 512.0)
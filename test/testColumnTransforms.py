@@ -0,0 +1,98 @@
+import calendar
+import datetime
+import numpy as np
+import pytest
+from pydicom.multival import MultiValue
+from columnTransforms import getTransformSpec, transformRaw, transformJoin, transformInteger, transformFloat, \
+    transformAge, toDateArray, yearsBetween
+
+def relativedeltaYears(end, start):
+    """The years of dateutil's relativedelta(end, start), which moves start by months and clamps its day to the month."""
+    def addMonths(date, months):
+        year, month = divmod(date.month - 1 + months, 12)
+        year += date.year
+        return datetime.date(year, month + 1, min(date.day, calendar.monthrange(year, month + 1)[1]))
+    months = (end.year - start.year) * 12 + end.month - start.month
+    if end < start:
+        while end > addMonths(start, months):
+            months += 1
+    else:
+        while end < addMonths(start, months):
+            months -= 1
+    return abs(months) // 12 * (1 if months >= 0 else -1)
+
+@pytest.mark.parametrize("start, end, years", [
+    ('1980-05-17', '2020-05-16', 39),
+    ('1980-05-17', '2020-05-17', 40),
+    ('2000-02-29', '2021-02-28', 21),
+    ('2000-02-29', '2020-02-28', 19),
+    ('2000-02-29', '2020-02-29', 20),
+    ('2020-05-17', '1980-05-18', -39),
+    ('2020-02-29', '2019-02-28', -1),
+    ('2021-02-28', '2020-02-29', 0),
+    ('2001-01-01', '2001-01-01', 0),
+])
+def testYearsBetween(start, end, years):
+    assert yearsBetween(np.array([start], dtype='datetime64[D]'), np.array([end], dtype='datetime64[D]'))[0] == years
+    assert relativedeltaYears(datetime.date.fromisoformat(end), datetime.date.fromisoformat(start)) == years
+
+def testYearsBetweenMatchesRelativedelta():
+    # Every pair of dates around the leap days, and random ones
+    monthEnds = [datetime.date(year, month, day) for year in range(1995, 2006)
+                 for month, day in [(2, 28), (3, 1), (1, 31), (12, 31)]] \
+        + [datetime.date(year, 2, 29) for year in (1996, 2000, 2004)]
+    pairs = [(start, end) for start in monthEnds for end in monthEnds]
+    days = np.random.default_rng(0).integers(0, 365 * 60, (2000, 2))
+    pairs += [tuple(datetime.date(1950, 1, 1) + datetime.timedelta(days=int(day)) for day in pair) for pair in days]
+
+    startDates = np.array([start for start, _ in pairs], dtype='datetime64[D]')
+    endDates = np.array([end for _, end in pairs], dtype='datetime64[D]')
+    assert yearsBetween(startDates, endDates).tolist() == [relativedeltaYears(end, start) for start, end in pairs]
+
+def testTransformAge():
+    ages = transformAge(['045Y', None, '', None, None],
+                        [['19700101', '19800615', '2000.02.29', 'unknown', None],
+                         ['20150101', '20200614', '20210228', '20200101', '20200101']])
+    assert ages == ['045Y', 39, 21, None, None]
+    # Without the two dates there is nothing to calculate it from
+    assert transformAge([None], []) == [None]
+
+def testToDateArray():
+    dates = toDateArray(['20200131', '2020.02.29', '20200230', '2020', None, '20200131'])
+    assert dates.tolist()[:2] == [datetime.date(2020, 1, 31), datetime.date(2020, 2, 29)]
+    assert np.isnat(dates[2:5]).all()
+    assert dates[5] == dates[0]
+
+def testTransformInteger():
+    column = ['1.9', ' -2.5 ', MultiValue(str, ['3.2', '4']), 'n/a', None, '', 7, []]
+    assert transformInteger(column, []) == [1, -2, 3, None, None, None, 7, None]
+    assert all(type(value) is int for value in transformInteger(['1', 2.5], []))
+
+def testTransformFloat():
+    assert transformFloat(['0.5', MultiValue(float, [1.5, 2.0]), 'x', None], []) == [0.5, 1.5, None, None]
+
+def testTransformJoinAndRaw():
+    column = [MultiValue(str, ['ORIGINAL', 'PRIMARY']), 'AP', None]
+    assert transformJoin(column, []) == ['ORIGINAL\\PRIMARY', 'AP', None]
+    assert transformRaw(column, []) == [['ORIGINAL', 'PRIMARY'], 'AP', None]
+
+def testDefaultTransforms():
+    elementNames = ['patient_age', 'patient_birth_date', 'study_date', 'slice_thickness', 'modality', 'rows', 'private']
+    elements = {
+        'patient_age': {'tag': '0x0010, 0x1010', 'db_datatype': 'SMALLINT'},
+        'slice_thickness': {'tag': '0x0018, 0x0050', 'db_datatype': 'SMALLINT'},
+        'modality': {'tag': '0x0008, 0x0060', 'db_datatype': 'CHAR(2)'},
+        'rows': {'tag': '0x0028, 0x0010', 'db_datatype': 'SMALLINT'},
+        'private': {'tag': '0x0009, 0x0010', 'db_datatype': 'TEXT'},
+    }
+    assert [getTransformSpec(name, elements[name], elementNames)['name'] for name in elements] \
+        == ['age', 'integer', 'join', 'raw', 'raw']
+    assert getTransformSpec('patient_age', elements['patient_age'], elementNames)['from'] == ['patient_birth_date', 'study_date']
+    assert getTransformSpec('rows', dict(elements['rows'], transform='float'), elementNames) == {'name': 'float', 'from': []}
+
+def testInvalidTransforms():
+    element = {'tag': '0x0028, 0x0010', 'db_datatype': 'SMALLINT'}
+    with pytest.raises(Exception):
+        getTransformSpec('rows', dict(element, transform='median'), ['rows'])
+    with pytest.raises(Exception):
+        getTransformSpec('rows', dict(element, transform={'name': 'age', 'from': ['study_date']}), ['rows'])
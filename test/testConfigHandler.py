@@ -0,0 +1,45 @@
+import os
+import pytest
+from configHandler import ConfigHandler
+from metaToDbConfigHandler import MetaToDbConfigHandler, DEFAULT_SETTINGS
+
+@pytest.fixture
+def writeCount(monkeypatch):
+    writes = []
+    writeConfigFile = ConfigHandler.writeConfigFile
+    def countingWrite(self):
+        writes.append(self.getConfigFilePath())
+        writeConfigFile(self)
+    monkeypatch.setattr(ConfigHandler, 'writeConfigFile', countingWrite)
+    return writes
+
+def testMissingDefaultsAreWrittenOnce(tmp_path, writeCount):
+    configFilePath = str(tmp_path / "config.ini")
+    with open(configFilePath, 'w') as configFile:
+        configFile.write("[postgresql]\nhost = localhost\n")
+
+    configHandler = MetaToDbConfigHandler(configFilePath)
+    # parent_folder, columns_info_name and then all the defaults at once
+    assert len(writeCount) == 3
+    for sectionName, settings in DEFAULT_SETTINGS.items():
+        for settingName, value in settings.items():
+            assert configHandler.getSetting(sectionName, settingName) == value
+
+    # A complete config isn't written again
+    del writeCount[:]
+    configHandler = MetaToDbConfigHandler(configFilePath)
+    assert writeCount == []
+    assert configHandler.getSetting('misc', 'parent_folder') == os.path.dirname(configFilePath)
+
+def testSetSettingSkipsUnchangedValues(tmp_path, writeCount):
+    configFilePath = str(tmp_path / "config.ini")
+    with open(configFilePath, 'w') as configFile:
+        configFile.write("[misc]\nlog_level = info\n")
+    configHandler = ConfigHandler(configFilePath)
+
+    configHandler.setSetting('misc', 'log_level', 'info')
+    assert writeCount == []
+    configHandler.setSetting('misc', 'log_level', 'debug')
+    configHandler.setSetting('table_info', 'metadata_table_name', 'metadata')
+    assert len(writeCount) == 2
+    assert ConfigHandler(configFilePath).getSetting('table_info', 'metadata_table_name') == 'metadata'
@@ -0,0 +1,182 @@
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import pytest
+from databaseHandler import DatabaseHandler, copyFormat, copyBuffer
+
+class FakeConfigHandler:
+    def getPoolSize(self):
+        return 4
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, values=None):
+        if self.connection.lost:
+            # psycopg2 marks a connection as closed once a query finds it lost
+            self.connection.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def copy_expert(self, query, buffer):
+        self.execute(query)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        if self.connection.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+
+class FakeInfo:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection, it goes down with the server when lost is set."""
+    def __init__(self, server):
+        self.server = server
+        self.closed = 0
+        self.autocommit = True
+        self.info = FakeInfo()
+        server.openCount += 1
+
+    @property
+    def lost(self):
+        return self.server.down
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if self.lost:
+            self.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def commit(self):
+        self.rollback()
+
+    def close(self):
+        self.closed = 1
+
+class FakeServer:
+    def __init__(self):
+        self.down = False
+        self.openCount = 0
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(psycopg2.pool.psycopg2, 'connect', lambda *args, **kwargs: FakeConnection(server))
+    return server
+
+def createDbHandler():
+    # Without __init__, which connects to the server of the config
+    dbHandler = DatabaseHandler.__new__(DatabaseHandler)
+    dbHandler.configHandler = FakeConfigHandler()
+    dbHandler.dbInfo = {'database': 'test'}
+    dbHandler.connectionPool = None
+    return dbHandler
+
+def testLostConnectionsDontLeakPoolSlots(server):
+    dbHandler = createDbHandler()
+    server.down = True
+    # More outages than the pool has slots
+    for _ in range(10):
+        with pytest.raises(psycopg2.OperationalError):
+            dbHandler.findChangedFiles('manifest', [('a.dcm', 1, 1)])
+        with pytest.raises(psycopg2.OperationalError):
+            dbHandler.replaceColumnStats('stats', 'load', 'table')
+    assert not dbHandler.connectionPool._used
+
+    server.down = False
+    connection = dbHandler.getPooledConnection()
+    assert not connection.closed
+
+def testOpenConnectionsGoBackToThePool(server):
+    dbHandler = createDbHandler()
+    assert dbHandler.findChangedFiles('manifest', [('a.dcm', 1, 1)]) == []
+    assert dbHandler.findChangedFiles('manifest', [('a.dcm', 1, 1)]) == []
+    assert server.openCount == 1
+    assert not dbHandler.connectionPool._used
+
+COPY_ESCAPES = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r'}
+
+def parseCopyField(field):
+    """Reads a field of the COPY text format back, like the server does."""
+    if field == '\\N':
+        return None
+    value = []
+    index = 0
+    while index < len(field):
+        if field[index] == '\\':
+            value.append(COPY_ESCAPES[field[index + 1]])
+            index += 2
+        else:
+            value.append(field[index])
+            index += 1
+    return ''.join(value)
+
+def parseArrayLiteral(literal):
+    """Reads a Postgres array literal of quoted items back into nested lists of str and None."""
+    def parseItems(index):
+        items = []
+        index += 1
+        while literal[index] != '}':
+            if literal[index] == '{':
+                item, index = parseItems(index)
+            elif literal[index] == '"':
+                item = []
+                index += 1
+                while literal[index] != '"':
+                    if literal[index] == '\\':
+                        index += 1
+                    item.append(literal[index])
+                    index += 1
+                item = ''.join(item)
+                index += 1
+            else:
+                assert literal.startswith('NULL', index)
+                item, index = None, index + 4
+            items.append(item)
+            if literal[index] == ',':
+                index += 1
+        return items, index + 1
+    items, index = parseItems(0)
+    assert index == len(literal)
+    return items
+
+TRICKY_STRINGS = ['plain', '', 'tab\there', 'new\nline', 'carriage\rreturn', 'back\\slash', '\\N', 'NULL',
+                  'quote"d', "it's", '{braces}', 'com,ma', 'Doe^Jane', 'Ünïcödé 日本', '\\t literal', 'trailing\\']
+
+@pytest.mark.parametrize("value", TRICKY_STRINGS)
+def testCopyFormatEscapesStrings(value):
+    field = copyFormat(value)
+    assert '\t' not in field and '\n' not in field and '\r' not in field
+    assert parseCopyField(field) == value
+
+def testCopyFormatOfOtherValues():
+    assert copyFormat(None) == '\\N'
+    assert parseCopyField(copyFormat(None)) is None
+    assert copyFormat(True) == 't'
+    assert copyFormat(False) == 'f'
+    assert copyFormat(512) == '512'
+    assert float(copyFormat(0.1)) == 0.1
+
+def testCopyFormatOfArrays():
+    values = [TRICKY_STRINGS, [None, 'x', ''], [[1, 2], [3, None]], [], [0.5, 0.75]]
+    for value in values:
+        items = parseArrayLiteral(parseCopyField(copyFormat(value)))
+        assert items == [[None if item is None else str(item) for item in row] if isinstance(row, list) else
+                         None if row is None else str(row) for row in value]
+
+def testCopyBufferHasALinePerRecord():
+    records = [('a\tb.dcm', None, ['x\ny', None]), ('c.dcm', 'MR', [])]
+    lines = copyBuffer(records).read().split('\n')
+    assert lines[-1] == ''
+    assert len(lines) == 3
+    fields = [line.split('\t') for line in lines[:-1]]
+    assert [len(line) for line in fields] == [3, 3]
+    assert parseCopyField(fields[0][0]) == 'a\tb.dcm'
+    assert parseArrayLiteral(parseCopyField(fields[0][2])) == ['x\ny', None]
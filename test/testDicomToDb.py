@@ -0,0 +1,177 @@
+import io
+import types
+import tarfile
+import psycopg2
+import pytest
+import pydicom as pdm
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from dicomToDb import DicomToDatabase, readRecord
+from extractionPlan import ExtractionPlan
+from ingestMetrics import IngestMetrics
+
+NON_ELEMENT_COLUMNS = {
+    "file_name": {"db_datatype": "VARCHAR(255)", "constraints": ""},
+    "file_path": {"db_datatype": "VARCHAR(255)", "constraints": "PRIMARY KEY"},
+}
+
+class FakeDbHandler:
+    """Stands in for DatabaseHandler, keeps the primary key of one table."""
+    def __init__(self, keyColumns, constraintName='metadata_pkey'):
+        self.keyColumns = keyColumns
+        self.constraintName = constraintName if keyColumns else None
+        self.replacedKeys = []
+
+    def tableExists(self, tableName):
+        return True
+
+    def getTablePrimaryKey(self, tableName):
+        return self.constraintName, list(self.keyColumns)
+
+    def replacePrimaryKey(self, tableName, constraintName, columnNames):
+        self.replacedKeys.append((tableName, constraintName, columnNames))
+        self.constraintName, self.keyColumns = tableName + '_pkey', columnNames
+
+def testPrimaryKeyIsMovedFromFileName():
+    dbHandler = FakeDbHandler(['file_name'])
+    dicomToDatabase = DicomToDatabase(None, dbHandler)
+    with pytest.raises(Exception, match='migrateTable'):
+        dicomToDatabase.checkPrimaryKey('metadata', ['file_path'])
+
+    assert dicomToDatabase.migratePrimaryKey('metadata', NON_ELEMENT_COLUMNS)
+    assert dbHandler.replacedKeys == [('metadata', 'metadata_pkey', ['file_path'])]
+    dicomToDatabase.checkPrimaryKey('metadata', ['file_path'])
+    # Moved once, a second migration finds it in place
+    assert not dicomToDatabase.migratePrimaryKey('metadata', NON_ELEMENT_COLUMNS)
+    assert len(dbHandler.replacedKeys) == 1
+
+def testTableWithoutPrimaryKeyGetsOne():
+    dbHandler = FakeDbHandler([])
+    assert DicomToDatabase(None, dbHandler).migratePrimaryKey('metadata', NON_ELEMENT_COLUMNS)
+    assert dbHandler.replacedKeys == [('metadata', None, ['file_path'])]
+
+def testMigratingMissingTable():
+    dbHandler = FakeDbHandler(['file_path'])
+    dbHandler.tableExists = lambda tableName: False
+    with pytest.raises(Exception, match='Table metadata does not exist, run the ingest first'):
+        DicomToDatabase(None, dbHandler).migrateTable('metadata', 'missing_columns_info.json')
+    assert dbHandler.replacedKeys == []
+
+def testSpecWithoutPrimaryKeyLeavesTheTable():
+    dbHandler = FakeDbHandler(['file_name'])
+    nonElementColumns = {"file_path": {"db_datatype": "VARCHAR(255)", "constraints": ""}}
+    assert not DicomToDatabase(None, dbHandler).migratePrimaryKey('metadata', nonElementColumns)
+    assert dbHandler.replacedKeys == []
+
+class FakeConfigHandler:
+    def __init__(self, parentFolder='', headerOnly=True):
+        self.parentFolder = parentFolder
+        self.headerOnly = headerOnly
+
+    def getTableName(self, table):
+        return {'duplicates': 'duplicate_files'}[table]
+
+    def getParentFolder(self):
+        return self.parentFolder
+
+    def getDicomExtensions(self):
+        return ['.dcm']
+
+    def getDetectDicomMagic(self):
+        return False
+
+    def getHeaderOnly(self):
+        return self.headerOnly
+
+    def getDeferSize(self):
+        return '1 KB'
+
+class IndexDbHandler:
+    """Stands in for DatabaseHandler, fails to build a unique index over duplicate keys."""
+    def __init__(self, hasDuplicates):
+        self.hasDuplicates = hasDuplicates
+        self.columns = []
+        self.indexes = {}
+
+    def addColumns(self, tableName, columns):
+        self.columns.extend(columns)
+
+    def buildIndexes(self, tableName, indexes):
+        if self.hasDuplicates and any(index.get('unique') for index in indexes.values()):
+            raise psycopg2.IntegrityError('could not create unique index')
+        self.indexes.update(indexes)
+
+def testDedupColumnGetsUniqueIndex():
+    dbHandler = IndexDbHandler(hasDuplicates=False)
+    DicomToDatabase(FakeConfigHandler(), dbHandler).addDedupColumn('metadata', types.SimpleNamespace(dedupColumn='dedup_key'))
+    assert dbHandler.columns == [('dedup_key', 'TEXT')]
+    assert dbHandler.indexes == {'dedup_key_idx': {'columns': ['dedup_key'], 'method': 'btree', 'unique': True}}
+
+def testDuplicateKeysStopTheIngest():
+    dbHandler = IndexDbHandler(hasDuplicates=True)
+    with pytest.raises(Exception, match='duplicate_files'):
+        DicomToDatabase(FakeConfigHandler(), dbHandler).addDedupColumn('metadata', types.SimpleNamespace(dedupColumn='dedup_key'))
+
+class InsertDbHandler:
+    """Stands in for DatabaseHandler, keeps the records that were inserted."""
+    def __init__(self):
+        self.connection = None
+        self.records = []
+
+    def executeQuery(self, connection, sqlQuery, values=None):
+        self.records.append(values)
+
+def createDcmBytes(patientId, withPixelData=False):
+    dcm = Dataset()
+    dcm.PatientID = patientId
+    if withPixelData:
+        dcm.PatientName = 'Doe^Jane'
+        dcm.Modality = 'CT'
+        dcm.ImageComments = 'x' * 5000
+        dcm.Rows = dcm.Columns = 256
+        dcm.BitsAllocated = 16
+        dcm.PixelData = bytes(256 * 256 * 2)
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'
+    dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    fileWriter = io.BytesIO()
+    dcm.save_as(fileWriter, enforce_file_format=True)
+    return fileWriter.getvalue()
+
+def testUnreadableTarMemberIsSkipped(tmp_path):
+    archivePath = str(tmp_path / 'study.tar.gz')
+    with tarfile.open(archivePath, 'w:gz') as archive:
+        for memberName, content in [('a.dcm', createDcmBytes('A')), ('broken.dcm', b'not a DCM' * 50),
+                                    ('b.dcm', createDcmBytes('B'))]:
+            memberInfo = tarfile.TarInfo(memberName)
+            memberInfo.size = len(content)
+            archive.addfile(memberInfo, io.BytesIO(content))
+
+    plan = ExtractionPlan({'patient_id': {'tag': '0x0010, 0x0020', 'db_datatype': 'VARCHAR(64)', 'calculation_only': False}})
+    dbHandler = InsertDbHandler()
+    dicomToDatabase = DicomToDatabase(FakeConfigHandler(str(tmp_path)), dbHandler)
+    dicomToDatabase.metrics = IngestMetrics(progressInterval=3600)
+    assert dicomToDatabase.insertTarArchive(plan, archivePath, None, 'INSERT') == 1
+    assert [record[-1] for record in dbHandler.records] == ['A', 'B']
+    assert dicomToDatabase.metrics.processedCount == 3
+    assert dicomToDatabase.metrics.failedCount == 1
+    assert list(dicomToDatabase.metrics.errorCounts.values()) == [1]
+
+def testHeaderOnlyRead(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    with open(filePath, 'wb') as fileWriter:
+        fileWriter.write(createDcmBytes('A', withPixelData=True))
+    plan = ExtractionPlan({'modality': {'tag': '0x0008, 0x0060', 'db_datatype': 'VARCHAR(16)', 'calculation_only': False},
+                           'comments': {'tag': '0x0020, 0x4000', 'db_datatype': 'TEXT', 'calculation_only': False},
+                           'patient_id': {'tag': '0x0010, 0x0020', 'db_datatype': 'VARCHAR(64)', 'calculation_only': False}})
+
+    readOptions = DicomToDatabase(FakeConfigHandler(), None).getReadOptions(plan)
+    dcm = pdm.dcmread(filePath, **readOptions)
+    # Only the tags of the column spec are parsed and the pixel data is never read
+    assert sorted(dcm.keys()) == sorted(plan.tags)
+    assert 'PixelData' not in dcm
+    assert readRecord(plan, filePath, str(tmp_path), readOptions) == ('image.dcm', 'image.dcm', 'CT', 'x' * 5000, 'A')
+
+    assert DicomToDatabase(FakeConfigHandler(headerOnly=False), None).getReadOptions(plan) == {}
+    assert readRecord(plan, filePath, str(tmp_path), {}) == readRecord(plan, filePath, str(tmp_path), readOptions)
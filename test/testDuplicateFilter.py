@@ -0,0 +1,52 @@
+import io
+import hashlib
+import pytest
+from duplicateFilter import BloomFilter, DuplicateFilter, hashContent
+
+@pytest.mark.parametrize("capacity, errorRate", [(1, 0.01), (1000, 0.01), (20000, 0.001)])
+def testBloomFilterHasNoFalseNegatives(capacity, errorRate):
+    bloomFilter = BloomFilter(capacity, errorRate)
+    keys = ['1.2.826.0.1.{0}'.format(index) for index in range(capacity * 2)]
+    for key in keys:
+        bloomFilter.add(key)
+    # Even past its capacity every added key is there
+    assert all(key in bloomFilter for key in keys)
+    assert all(bloomFilter.add(key) for key in keys)
+
+@pytest.mark.parametrize("errorRate", [0.05, 0.01])
+def testBloomFilterErrorRate(errorRate):
+    capacity = 20000
+    bloomFilter = BloomFilter(capacity, errorRate)
+    for index in range(capacity):
+        bloomFilter.add('stored{0}'.format(index))
+    falsePositives = sum('new{0}'.format(index) in bloomFilter for index in range(capacity))
+    assert falsePositives < 2 * errorRate * capacity
+
+def testBloomFilterAddTellsIfTheKeyWasThere():
+    bloomFilter = BloomFilter(100)
+    assert not bloomFilter.add('a')
+    assert bloomFilter.add('a')
+    assert 'a' in bloomFilter
+    assert 'b' not in bloomFilter
+
+def testDuplicateFilter():
+    duplicateFilter = DuplicateFilter('dedup_key', ['file_path', 'dedup_key'], 'duplicate_files', 1000)
+    assert duplicateFilter.load(['k1', None, 'k2']) == 2
+    assert duplicateFilter.mightBeDuplicate(('a.dcm', 'k1'))
+    assert not duplicateFilter.mightBeDuplicate(('b.dcm', 'k3'))
+    # Caught within the run too
+    assert duplicateFilter.mightBeDuplicate(('c.dcm', 'k3'))
+    assert not duplicateFilter.mightBeDuplicate(('d.dcm', None))
+    assert not duplicateFilter.mightBeDuplicate(('e.dcm', None))
+
+def testHashContent(tmp_path):
+    content = bytes(range(256)) * 5000
+    filePath = str(tmp_path / 'image.dcm')
+    with open(filePath, 'wb') as fileWriter:
+        fileWriter.write(content)
+    expected = hashlib.sha256(content).hexdigest()
+    assert hashContent(filePath, blockSize=1000) == expected
+    fileReader = io.BytesIO(content)
+    fileReader.read(10)
+    # An open file is hashed from its start
+    assert hashContent(fileReader) == expected
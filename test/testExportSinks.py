@@ -0,0 +1,161 @@
+import csv
+import json
+import sqlite3
+import pytest
+from pydicom.valuerep import PersonName
+from pydicom.multival import MultiValue
+from exportSinks import RecordSink, CsvSink, SqliteSink, createSink, toArrowType, toSqliteType, pa
+if pa is not None:
+    import pyarrow.parquet as pq
+
+needsPyarrow = pytest.mark.skipif(pa is None, reason='the Parquet sink needs pyarrow')
+
+COLUMN_NAMES = ['file_path', 'patient_name', 'rows', 'slice_thickness', 'pixel_spacing', 'is_signed']
+COLUMN_TYPES = ['VARCHAR(255)', 'TEXT', 'SMALLINT', 'DOUBLE PRECISION', 'REAL[]', 'BOOLEAN']
+
+def createRecords(count):
+    """Records like the ones of a DCM, with pydicom values and NULLs in every other record."""
+    records = []
+    for index in range(count):
+        missing = index % 2 == 1
+        records.append(('scan_{0}.dcm'.format(index),
+                        None if missing else PersonName('Doe^Jane'),
+                        None if missing else 512,
+                        None if missing else 1.25,
+                        None if missing else MultiValue(float, [0.5, 0.75]),
+                        None if missing else True))
+    return records
+
+def testCsvSink(tmp_path):
+    outputPath = str(tmp_path / 'metadata.csv')
+    sink = CsvSink(outputPath, COLUMN_NAMES, batchSize=3)
+    for record in createRecords(7):
+        sink.addRecord(record)
+    sink.close()
+    assert sink.batchCount == 3
+    assert sink.writtenCount == 7
+
+    with open(outputPath, newline='', encoding='utf-8') as fileReader:
+        rows = list(csv.reader(fileReader))
+    assert rows[0] == COLUMN_NAMES
+    assert len(rows) == 8
+    assert rows[1] == ['scan_0.dcm', 'Doe^Jane', '512', '1.25', '[0.5, 0.75]', '1']
+    assert json.loads(rows[1][4]) == [0.5, 0.75]
+    assert rows[2] == ['scan_1.dcm', '', '', '', '', '']
+
+def testSqliteSink(tmp_path):
+    outputPath = str(tmp_path / 'metadata.sqlite')
+    sink = SqliteSink(outputPath, 'metadata', COLUMN_NAMES, COLUMN_TYPES, ['file_path'], batchSize=4)
+    for record in createRecords(9):
+        sink.addRecord(record)
+    sink.close()
+
+    connection = sqlite3.connect(outputPath)
+    try:
+        assert connection.execute('SELECT COUNT(*) FROM metadata;').fetchone()[0] == 9
+        columnTypes = [(row[1], row[2]) for row in connection.execute('PRAGMA table_info(metadata);')]
+        assert columnTypes == list(zip(COLUMN_NAMES, ['TEXT', 'TEXT', 'INTEGER', 'REAL', 'TEXT', 'INTEGER']))
+        assert connection.execute('SELECT * FROM metadata WHERE file_path = ?;', ('scan_0.dcm',)).fetchone() \
+            == ('scan_0.dcm', 'Doe^Jane', 512, 1.25, '[0.5, 0.75]', 1)
+        assert connection.execute('SELECT * FROM metadata WHERE file_path = ?;', ('scan_1.dcm',)).fetchone() \
+            == ('scan_1.dcm', None, None, None, None, None)
+    finally:
+        connection.close()
+
+    # Records with a stored key replace the stored rows, like an incremental run
+    sink = SqliteSink(outputPath, 'metadata', COLUMN_NAMES, COLUMN_TYPES, ['file_path'])
+    sink.addRecord(('scan_1.dcm', 'Roe^John', 256, 2.0, [1.0, 1.0], False))
+    sink.close()
+    connection = sqlite3.connect(outputPath)
+    try:
+        assert connection.execute('SELECT COUNT(*) FROM metadata;').fetchone()[0] == 9
+        assert connection.execute('SELECT patient_name, "rows" FROM metadata WHERE file_path = ?;', ('scan_1.dcm',)).fetchone() \
+            == ('Roe^John', 256)
+    finally:
+        connection.close()
+
+@needsPyarrow
+def testParquetSink(tmp_path):
+    outputPath = str(tmp_path / 'metadata.parquet')
+    sink = createSink('parquet', outputPath, 'metadata', COLUMN_NAMES, COLUMN_TYPES, batchSize=4)
+    for record in createRecords(10):
+        sink.addRecord(record)
+    sink.close()
+
+    parquetFile = pq.ParquetFile(outputPath)
+    # A row group per batch
+    assert parquetFile.metadata.num_row_groups == 3
+    table = parquetFile.read()
+    assert table.num_rows == 10
+    assert table.schema.types == [pa.string(), pa.string(), pa.int16(), pa.float64(), pa.list_(pa.float32()), pa.bool_()]
+    rows = table.to_pylist()
+    assert rows[0] == {'file_path': 'scan_0.dcm', 'patient_name': 'Doe^Jane', 'rows': 512, 'slice_thickness': 1.25,
+                       'pixel_spacing': [0.5, 0.75], 'is_signed': True}
+    assert rows[1] == dict(zip(COLUMN_NAMES, ['scan_1.dcm'] + [None] * 5))
+    assert table.column('rows').null_count == 5
+
+@needsPyarrow
+def testParquetSinkDropsRecordsThatDontFit(tmp_path):
+    outputPath = str(tmp_path / 'metadata.parquet')
+    sink = createSink('parquet', outputPath, 'metadata', COLUMN_NAMES, COLUMN_TYPES, batchSize=3)
+    records = createRecords(3)
+    # Out of range for SMALLINT
+    records[1] = ('scan_1.dcm', None, 70000, None, None, None)
+    for record in records:
+        sink.addRecord(record)
+    sink.close()
+    assert [record[0] for record, _ in sink.failedRecords] == ['scan_1.dcm']
+    assert pq.read_table(outputPath).column('file_path').to_pylist() == ['scan_0.dcm', 'scan_2.dcm']
+
+def testUnknownSink(tmp_path):
+    with pytest.raises(Exception):
+        createSink('feather', str(tmp_path / 'metadata'), 'metadata', COLUMN_NAMES, COLUMN_TYPES)
+
+@needsPyarrow
+@pytest.mark.parametrize("dbDatatype, arrowType", [
+    ('SMALLINT', 'int16'),
+    ('integer', 'int32'),
+    ('BIGINT', 'int64'),
+    ('REAL', 'float'),
+    ('DOUBLE PRECISION', 'double'),
+    ('NUMERIC(10, 2)', 'double'),
+    ('BOOLEAN', 'bool'),
+    ('VARCHAR(255)', 'string'),
+    ('DATE', 'string'),
+    ('JSONB', 'string'),
+    ('SMALLINT[]', 'list<item: int16>'),
+    ('REAL[][]', 'list<item: list<item: float>>'),
+])
+def testToArrowType(dbDatatype, arrowType):
+    assert str(toArrowType(dbDatatype)) == arrowType
+
+def testToSqliteType():
+    assert [toSqliteType(datatype) for datatype in ['INT', 'BOOLEAN', 'REAL', 'NUMERIC(4)', 'VARCHAR(64)', 'INT[]']] \
+        == ['INTEGER', 'INTEGER', 'REAL', 'REAL', 'TEXT', 'TEXT']
+
+class ListSink(RecordSink):
+    """Keeps the records in a list, fails a batch with a record whose first value is None."""
+    def __init__(self, columnNames, batchSize):
+        RecordSink.__init__(self, None, columnNames, batchSize)
+        self.records = []
+
+    def writeBatch(self, records):
+        if any(record[0] is None for record in records):
+            raise ValueError('no file path')
+        self.records.extend(records)
+
+def testSinkNeedsWriteBatch():
+    with pytest.raises(TypeError):
+        RecordSink(None, COLUMN_NAMES)
+    class IncompleteSink(RecordSink):
+        def closeOutput(self):
+            pass
+    with pytest.raises(TypeError):
+        IncompleteSink(None, COLUMN_NAMES)
+
+    sink = ListSink(['file_path'], batchSize=2)
+    for record in [('a.dcm',), (None,), ('c.dcm',)]:
+        sink.addRecord(record)
+    sink.close()
+    assert sink.records == [('a.dcm',), ('c.dcm',)]
+    assert sink.writtenCount == 2
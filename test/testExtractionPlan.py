@@ -0,0 +1,97 @@
+import os
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.tag import Tag
+from extractionPlan import ExtractionPlan, SOP_INSTANCE_UID_TAG, selectElements, getRelativePath
+from pixelFeatures import PIXEL_TAGS
+
+ELEMENTS = {
+    "patient_orientation": {"tag": "0x0020, 0x0020", "db_datatype": "VARCHAR(255)", "calculation_only": False},
+    "window_center": {"tag": "0x0028, 0x1050", "db_datatype": "INTEGER", "calculation_only": False},
+    "patient_birth_date": {"tag": "0x0010, 0x0030", "db_datatype": "VARCHAR(255)", "calculation_only": True},
+    "study_date": {"tag": "0x0008, 0x0020", "db_datatype": "VARCHAR(255)", "calculation_only": False},
+    "patient_age": {"tag": "0x0010, 0x1010", "db_datatype": "INTEGER", "calculation_only": False},
+}
+
+def createDcm(**values):
+    dcm = Dataset()
+    for keyword, value in values.items():
+        setattr(dcm, keyword, value)
+    return dcm
+
+def testColumnOrder():
+    plan = ExtractionPlan(ELEMENTS, headerColumn='header', dedupColumn='dedup_key',
+                          derived={'pixel_mean': {'feature': 'mean'}})
+    # Calculation only elements are read but not stored
+    assert plan.tags == [Tag(0x0020, 0x0020), Tag(0x0028, 0x1050), Tag(0x0010, 0x0030), Tag(0x0008, 0x0020), Tag(0x0010, 0x1010)]
+    assert plan.columnNames == ['file_name', 'file_path', 'patient_orientation', 'window_center', 'study_date', 'patient_age',
+                                'header', 'dedup_key', 'pixel_mean']
+    assert plan.getElementColumnNames() == ['patient_orientation', 'window_center', 'study_date', 'patient_age']
+    nonElementColumns = {"file_name": {"db_datatype": "VARCHAR(255)"}, "file_path": {"db_datatype": "TEXT"}}
+    assert plan.getColumnTypes(nonElementColumns) == ['VARCHAR(255)', 'TEXT', 'VARCHAR(255)', 'INTEGER', 'VARCHAR(255)',
+                                                      'INTEGER', 'JSONB', 'TEXT', 'DOUBLE PRECISION']
+    assert plan.getInsertQuery('metadata') == 'INSERT INTO metadata (' + ', '.join(plan.columnNames) + ') VALUES (' \
+        + ', '.join(['%s'] * 9) + ');'
+
+def testUnknownDedupMode():
+    with pytest.raises(Exception, match='Unknown dedup mode'):
+        ExtractionPlan(ELEMENTS, dedupColumn='dedup_key', dedupMode='file_name')
+
+def testRecords():
+    plan = ExtractionPlan(ELEMENTS)
+    parentFolder = os.path.join(os.sep, 'data')
+    dcms = [
+        (os.path.join(parentFolder, 'a', 'first.dcm'),
+         createDcm(PatientOrientation=['L', 'F'], WindowCenter='40.7', PatientBirthDate='19800229', StudyDate='20240228')),
+        # Elements that aren't in the DCM are stored as None
+        (os.path.join(parentFolder, 'second.dcm'), createDcm(StudyDate='20240101')),
+        (os.path.join(parentFolder, 'third.dcm'), createDcm(WindowCenter=['-600', '40'], PatientAge='045Y')),
+    ]
+    rows = [(filePath, plan.extractValues(dcm), ()) for filePath, dcm in dcms]
+    assert plan.createRecords(rows, parentFolder) == [
+        ('first.dcm', os.path.join('a', 'first.dcm'), 'L\\F', 40, '20240228', 43),
+        ('second.dcm', 'second.dcm', None, None, '20240101', None),
+        # The age in the DCM is kept as it is, it's only calculated from the dates if it's missing
+        ('third.dcm', 'third.dcm', None, -600, None, '045Y'),
+    ]
+    # One DCM at a time gives the same records as the batch
+    assert [plan.createRecord(dcm, filePath, parentFolder) for filePath, dcm in dcms] == plan.createRecords(rows, parentFolder)
+    assert plan.createRecords([], parentFolder) == []
+
+def testExtraValues():
+    plan = ExtractionPlan({"modality": {"tag": "0x0008, 0x0060", "db_datatype": "VARCHAR(16)", "calculation_only": False}},
+                          headerColumn='header', dedupColumn='sop_instance_uid')
+    record = plan.createRecord(createDcm(Modality='CT', SOPInstanceUID='1.2.3'), 'image.dcm', '')
+    assert record == ('image.dcm', 'image.dcm', 'CT',
+                      '{"00080018":{"vr":"UI","Value":["1.2.3"]},"00080060":{"vr":"CS","Value":["CT"]}}', '1.2.3')
+    assert plan.createRecord(createDcm(Modality='CT'), 'image.dcm', '')[-1] is None
+
+def testReadOptions():
+    plan = ExtractionPlan(ELEMENTS)
+    assert plan.getReadOptions('2 KB') == {'stop_before_pixels': True, 'specific_tags': plan.tags, 'defer_size': '2 KB'}
+    # The dedup key and the derived columns need tags that aren't columns of the spec
+    plan = ExtractionPlan(ELEMENTS, dedupColumn='dedup_key', derived={'pixel_mean': {'feature': 'mean'}})
+    assert plan.getReadOptions('2 KB')['specific_tags'] == plan.tags + [SOP_INSTANCE_UID_TAG] + PIXEL_TAGS
+    plan = ExtractionPlan(ELEMENTS, dedupColumn='dedup_key', dedupMode='content_hash')
+    assert plan.getReadOptions('2 KB')['specific_tags'] == plan.tags
+    # The whole header is read if it is stored
+    plan = ExtractionPlan(ELEMENTS, headerColumn='header')
+    assert plan.getReadOptions('2 KB') == {'stop_before_pixels': True, 'defer_size': '2 KB'}
+
+def testSelectElements():
+    selected = selectElements(ELEMENTS, ['patient_age', 'window_center'])
+    assert list(selected.keys()) == ['patient_birth_date', 'study_date', 'patient_age', 'window_center']
+    # The elements the age is calculated from are read for it but not stored
+    assert selected['study_date'] == dict(ELEMENTS['study_date'], calculation_only=True)
+    assert selected['patient_birth_date']['calculation_only']
+    assert not ELEMENTS['study_date']['calculation_only']
+    assert ExtractionPlan(selected).columnNames == ['file_name', 'file_path', 'patient_age', 'window_center']
+
+    selected = selectElements(ELEMENTS, ['study_date', 'patient_age'])
+    assert list(selected.keys()) == ['study_date', 'patient_birth_date', 'patient_age']
+    assert not selected['study_date']['calculation_only']
+
+def testRelativePath():
+    parentFolder = os.path.join(os.sep, 'data', 'scans')
+    assert getRelativePath(os.path.join(parentFolder, 'a', 'b.dcm'), parentFolder) == os.path.join('a', 'b.dcm')
+    assert getRelativePath(os.path.join(os.sep, 'other', 'b.dcm'), parentFolder) == os.path.join(os.sep, 'other', 'b.dcm')
@@ -0,0 +1,154 @@
+"""Runs the fast-load table mode against a real DB.
+
+Set M2DB_TEST_CONFIG to a config.ini whose postgresql section points to a server the tests can
+create tables on, the DB tests are skipped otherwise. Every test uses tables of its own and drops
+them at the end.
+"""
+import os
+import json
+import uuid
+import shutil
+import psycopg2
+import pytest
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler
+
+TEST_CONFIG = os.environ.get('M2DB_TEST_CONFIG')
+
+needsDb = pytest.mark.skipif(not TEST_CONFIG, reason='no test DB configured, set M2DB_TEST_CONFIG')
+
+COLUMNS_INFO = {
+    "nonElementColumns": {
+        "file_name": {"db_datatype": "VARCHAR(255)", "constraints": ""},
+        "file_path": {"db_datatype": "VARCHAR(255)", "constraints": "PRIMARY KEY"},
+    },
+    "elements": {
+        "modality": {"tag": "0x0008, 0x0060", "db_datatype": "VARCHAR(16)", "calculation_only": False},
+    },
+    "indexes": {
+        "modality_idx": {"columns": ["modality"], "method": "btree"},
+    },
+}
+
+COLUMN_NAMES = ['file_name', 'file_path', 'modality']
+
+@pytest.fixture
+def columnsInfoPath(tmp_path):
+    columnsInfoPath = str(tmp_path / 'columns_info.json')
+    with open(columnsInfoPath, 'w') as fileWriter:
+        json.dump(COLUMNS_INFO, fileWriter)
+    return columnsInfoPath
+
+@pytest.fixture
+def dbHandler(tmp_path):
+    configFilePath = str(tmp_path / 'config.ini')
+    shutil.copyfile(TEST_CONFIG, configFilePath)
+    dbHandler = DatabaseHandler(MetaToDbConfigHandler(configFilePath))
+    yield dbHandler
+    dbHandler.closeAllConnections()
+
+@pytest.fixture
+def tableName(dbHandler):
+    tableName = 'test_fast_load_' + uuid.uuid4().hex[:12]
+    yield tableName
+    for name in [tableName, tableName + '_load']:
+        dbHandler.executeQuery(dbHandler.connection, 'DROP TABLE IF EXISTS \"' + name + '\";')
+
+def load(dbHandler, tableName, columnsInfoPath, records):
+    loadTableName = dbHandler.startFastLoad(tableName, columnsInfoPath, "nonElementColumns", "elements")
+    connection = dbHandler.getPooledConnection()
+    try:
+        dbHandler.insertRecords(connection, loadTableName, COLUMN_NAMES, records)
+        connection.commit()
+    finally:
+        dbHandler.releasePooledConnection(connection)
+    return loadTableName
+
+def finishLoad(dbHandler, loadTableName, tableName, columnsInfoPath):
+    dbHandler.finishFastLoad(loadTableName, tableName, columnsInfoPath, "nonElementColumns", "indexes")
+
+def getRecords(dbHandler, tableName):
+    sqlQuery = 'SELECT file_name, file_path, modality FROM \"' + tableName + '\" ORDER BY file_path;'
+    return dbHandler.executeQuery(dbHandler.connection, sqlQuery).fetchall()
+
+def getPersistence(dbHandler, tableName):
+    sqlQuery = 'SELECT relpersistence FROM pg_class WHERE relname = %s;'
+    return dbHandler.executeQuery(dbHandler.connection, sqlQuery, (tableName,)).fetchone()[0]
+
+def getIndexNames(dbHandler, tableName):
+    sqlQuery = 'SELECT indexname FROM pg_indexes WHERE tablename = %s ORDER BY indexname;'
+    return [row[0] for row in dbHandler.executeQuery(dbHandler.connection, sqlQuery, (tableName,)).fetchall()]
+
+@needsDb
+def testLoadIntoNewTable(dbHandler, tableName, columnsInfoPath):
+    loadTableName = load(dbHandler, tableName, columnsInfoPath, [('a.dcm', 'a.dcm', 'CT'), ('b.dcm', 'x/b.dcm', 'MR')])
+    assert loadTableName == tableName
+    # Unlogged and without its key and indexes while it's loaded
+    assert getPersistence(dbHandler, tableName) == 'u'
+    assert getIndexNames(dbHandler, tableName) == []
+
+    finishLoad(dbHandler, loadTableName, tableName, columnsInfoPath)
+    assert getPersistence(dbHandler, tableName) == 'p'
+    assert dbHandler.getTablePrimaryKey(tableName) == (tableName + '_pkey', ['file_path'])
+    assert getIndexNames(dbHandler, tableName) == [tableName + '_modality_idx', tableName + '_pkey']
+    assert getRecords(dbHandler, tableName) == [('a.dcm', 'a.dcm', 'CT'), ('b.dcm', 'x/b.dcm', 'MR')]
+
+@needsDb
+def testLoadReplacesExistingTable(dbHandler, tableName, columnsInfoPath):
+    finishLoad(dbHandler, load(dbHandler, tableName, columnsInfoPath, [('a.dcm', 'a.dcm', 'CT')]), tableName, columnsInfoPath)
+    loadTableName = load(dbHandler, tableName, columnsInfoPath, [('b.dcm', 'b.dcm', 'MR'), ('c.dcm', 'c.dcm', 'US')])
+    assert loadTableName == tableName + '_load'
+    # The existing table is queried as it was while the load runs
+    assert getRecords(dbHandler, tableName) == [('a.dcm', 'a.dcm', 'CT')]
+
+    finishLoad(dbHandler, loadTableName, tableName, columnsInfoPath)
+    assert getRecords(dbHandler, tableName) == [('b.dcm', 'b.dcm', 'MR'), ('c.dcm', 'c.dcm', 'US')]
+    assert not dbHandler.tableExists(loadTableName)
+    assert getPersistence(dbHandler, tableName) == 'p'
+    # The key and indexes are renamed with the table, so the next load can build them again
+    assert dbHandler.getTablePrimaryKey(tableName) == (tableName + '_pkey', ['file_path'])
+    assert getIndexNames(dbHandler, tableName) == [tableName + '_modality_idx', tableName + '_pkey']
+
+@needsDb
+def testDuplicateKeysLeaveExistingTable(dbHandler, tableName, columnsInfoPath):
+    finishLoad(dbHandler, load(dbHandler, tableName, columnsInfoPath, [('a.dcm', 'a.dcm', 'CT')]), tableName, columnsInfoPath)
+    loadTableName = load(dbHandler, tableName, columnsInfoPath, [('b.dcm', 'b.dcm', 'MR'), ('b.dcm', 'b.dcm', 'US')])
+    with pytest.raises(psycopg2.IntegrityError):
+        finishLoad(dbHandler, loadTableName, tableName, columnsInfoPath)
+    assert getRecords(dbHandler, tableName) == [('a.dcm', 'a.dcm', 'CT')]
+    assert dbHandler.getTablePrimaryKey(tableName) == (tableName + '_pkey', ['file_path'])
+
+    # The load table left over is dropped by the next load
+    loadTableName = load(dbHandler, tableName, columnsInfoPath, [('c.dcm', 'c.dcm', 'US')])
+    finishLoad(dbHandler, loadTableName, tableName, columnsInfoPath)
+    assert getRecords(dbHandler, tableName) == [('c.dcm', 'c.dcm', 'US')]
+
+class LoadDbHandler(DatabaseHandler):
+    """A DatabaseHandler without a DB, keeps the tables that exist and the ones it creates."""
+    def __init__(self, tableNames):
+        self.tableNames = set(tableNames)
+        self.createdTables = []
+        self.droppedTables = []
+
+    def tableExists(self, tableName):
+        return tableName in self.tableNames
+
+    def dropTable(self, tableName):
+        self.tableNames.remove(tableName)
+        self.droppedTables.append(tableName)
+
+    def addTableToDb(self, tableName, columnsInfoPath, nonElementSectionName, elementSectionName,
+                     indexSectionName=None, fastLoad=False):
+        self.tableNames.add(tableName)
+        self.createdTables.append((tableName, fastLoad))
+
+def testLoadTableName():
+    dbHandler = LoadDbHandler([])
+    assert dbHandler.startFastLoad('metadata', 'columns_info.json', "nonElementColumns", "elements") == 'metadata'
+    assert dbHandler.startFastLoad('metadata', 'columns_info.json', "nonElementColumns", "elements") == 'metadata_load'
+    assert dbHandler.createdTables == [('metadata', True), ('metadata_load', True)]
+    # A load table left over from a load that didn't finish is created again, empty
+    assert dbHandler.startFastLoad('metadata', 'columns_info.json', "nonElementColumns", "elements") == 'metadata_load'
+    assert dbHandler.droppedTables == ['metadata_load']
+    assert dbHandler.createdTables[-1] == ('metadata_load', True)
+    assert dbHandler.tableNames == {'metadata', 'metadata_load'}
@@ -0,0 +1,66 @@
+import os
+import pytest
+import fileDiscovery
+from fileDiscovery import findFiles, isDicomFile
+
+def writeFile(filePath, content=b'x'):
+    os.makedirs(os.path.dirname(filePath), exist_ok=True)
+    with open(filePath, 'wb') as fileWriter:
+        fileWriter.write(content)
+    return filePath
+
+@pytest.fixture
+def folderTree(tmp_path):
+    """A tree of DCMs with and without the extension and files that aren't DCMs."""
+    root = str(tmp_path / 'unpack')
+    files = {
+        'dcm': writeFile(os.path.join(root, 'a', 'b', 'image.dcm')),
+        'upper': writeFile(os.path.join(root, 'a', 'IMAGE2.DCM')),
+        'nifti': writeFile(os.path.join(root, 'c', 'brain.nii.gz')),
+        'noExtension': writeFile(os.path.join(root, 'c', 'd', 'IMG0001'), bytes(128) + b'DICM' + bytes(10)),
+        'text': writeFile(os.path.join(root, 'notes.txt'), b'not a DCM' * 20),
+        'short': writeFile(os.path.join(root, 'c', 'EMPTY')),
+    }
+    return root, files
+
+@pytest.mark.parametrize("walkers", [1, 4])
+def testExtensions(folderTree, walkers):
+    root, files = folderTree
+    found = list(findFiles(root, ['.dcm', '.NII.GZ'], walkers=walkers))
+    assert sorted(found) == sorted([files['dcm'], files['upper'], files['nifti']])
+
+@pytest.mark.parametrize("walkers", [1, 4])
+def testDicomMagic(folderTree, walkers):
+    root, files = folderTree
+    found = list(findFiles(root, ['.dcm'], detectDicom=True, walkers=walkers))
+    assert sorted(found) == sorted([files['dcm'], files['upper'], files['noExtension']])
+    assert isDicomFile(files['noExtension'])
+    assert not isDicomFile(files['text'])
+    assert not isDicomFile(files['short'])
+    assert not isDicomFile(os.path.join(root, 'missing'))
+
+def testSymlinkedFolderIsNotFollowed(folderTree):
+    root, files = folderTree
+    os.symlink(os.path.join(root, 'a'), os.path.join(root, 'c', 'link'))
+    assert sorted(findFiles(root, ['.dcm'])) == sorted([files['dcm'], files['upper']])
+
+@pytest.mark.parametrize("walkers", [1, 4])
+def testFolderThatCannotBeListed(folderTree, monkeypatch, walkers):
+    root, files = folderTree
+    scandir = os.scandir
+    def failingScandir(folderPath):
+        if os.path.basename(folderPath) == 'a':
+            raise PermissionError(13, 'Permission denied', folderPath)
+        return scandir(folderPath)
+    monkeypatch.setattr(fileDiscovery.os, 'scandir', failingScandir)
+    # The folder is skipped and the rest of the tree is still walked
+    assert sorted(findFiles(root, ['.dcm', '.nii.gz'], walkers=walkers)) == [files['nifti']]
+    assert list(findFiles(os.path.join(root, 'missing'), ['.dcm'], walkers=walkers)) == []
+
+def testFilesAreYieldedDuringTheWalk(folderTree):
+    root, files = folderTree
+    walk = findFiles(root, ['.dcm', '.nii.gz'])
+    firstPath = next(walk)
+    # A file created in a folder that hasn't been listed yet is still found
+    lastPath = writeFile(os.path.join(root, 'a', 'b', 'late.dcm'))
+    assert sorted([firstPath] + list(walk)) == sorted([files['dcm'], files['upper'], files['nifti'], lastPath])
@@ -0,0 +1,86 @@
+import os
+from folderWatcher import ArrivalTracker
+
+def writeFile(filePath, content):
+    with open(filePath, 'ab') as fileWriter:
+        fileWriter.write(content)
+
+def testFileIsReadyOnceSettled(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    writeFile(filePath, b'x' * 100)
+    tracker = ArrivalTracker(settleTime=2.0, extensions=['.dcm'])
+    tracker.add(filePath, now=10.0)
+    assert tracker.getWaitTime(now=10.5) == 1.5
+
+    assert tracker.popReady(now=11.9) == []
+    readyFiles = tracker.popReady(now=12.0)
+    assert [readyPath for readyPath, _ in readyFiles] == [filePath]
+    assert readyFiles[0][1][0] == 100
+    assert len(tracker) == 0
+    assert tracker.getWaitTime() is None
+    assert tracker.popReady(now=20.0) == []
+
+def testGrowingFileSettlesAgain(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    writeFile(filePath, b'x' * 100)
+    tracker = ArrivalTracker(settleTime=2.0, extensions=['.dcm'])
+    tracker.add(filePath, now=10.0)
+
+    # Still being copied when its settle time is up
+    writeFile(filePath, b'x' * 100)
+    assert tracker.popReady(now=12.0) == []
+    assert tracker.getWaitTime(now=12.0) == 2.0
+    assert tracker.popReady(now=13.0) == []
+    readyFiles = tracker.popReady(now=14.0)
+    assert readyFiles[0][1][0] == 200
+
+def testTouchedFileSettlesAgain(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    writeFile(filePath, b'x' * 100)
+    tracker = ArrivalTracker(settleTime=1.0, extensions=['.dcm'])
+    tracker.add(filePath, now=0.0)
+    fileStat = os.stat(filePath)
+    os.utime(filePath, ns=(fileStat.st_atime_ns, fileStat.st_mtime_ns + 10 ** 9))
+    assert tracker.popReady(now=1.0) == []
+    assert len(tracker.popReady(now=2.0)) == 1
+
+def testReportedAgainRestartsTheSettleTime(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    writeFile(filePath, b'x')
+    tracker = ArrivalTracker(settleTime=1.0, extensions=['.dcm'])
+    tracker.add(filePath, now=0.0)
+    tracker.add(filePath, now=0.8)
+    assert tracker.popReady(now=1.0) == []
+    assert len(tracker.popReady(now=1.8)) == 1
+
+def testRemovedFileIsDropped(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    writeFile(filePath, b'x')
+    tracker = ArrivalTracker(settleTime=1.0, extensions=['.dcm'])
+    tracker.add(filePath, now=0.0)
+    os.remove(filePath)
+    assert tracker.popReady(now=1.0) == []
+    assert len(tracker) == 0
+    # Reported after it's gone, e.g. a temp file of the copy
+    tracker.add(filePath, now=2.0)
+    assert len(tracker) == 0
+
+def testOnlyStoredFilesAreTracked(tmp_path):
+    dicomPath = str(tmp_path / 'IMG0001')
+    writeFile(dicomPath, bytes(128) + b'DICM' + bytes(100))
+    textPath = str(tmp_path / 'notes.txt')
+    writeFile(textPath, b'not a DCM' * 20)
+    upperPath = str(tmp_path / 'IMAGE.DCM')
+    writeFile(upperPath, b'x')
+
+    tracker = ArrivalTracker(settleTime=1.0, extensions=['.dcm'])
+    for filePath in (dicomPath, textPath, upperPath):
+        tracker.add(filePath, now=0.0)
+    assert [readyPath for readyPath, _ in tracker.popReady(now=1.0)] == [upperPath]
+
+    # Files without the extension are checked for the DICM magic once they settled
+    tracker = ArrivalTracker(settleTime=1.0, extensions=['.dcm'], detectDicom=True)
+    for filePath in (dicomPath, textPath, upperPath):
+        tracker.add(filePath, now=0.0)
+    assert sorted(readyPath for readyPath, _ in tracker.popReady(now=1.0)) == sorted([dicomPath, upperPath])
+    assert len(tracker) == 0
@@ -0,0 +1,133 @@
+import json
+import pydicom as pdm
+import pydicom.filereader
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+from headerJson import headerToJson, headerToDict, convertValue
+
+def writeDcm(filePath, dcm, transferSyntax=ExplicitVRLittleEndian):
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.TransferSyntaxUID = transferSyntax
+    dcm.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'
+    dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dcm.save_as(filePath, enforce_file_format=True)
+
+@pytest.mark.parametrize("transferSyntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+def testDeferredBinaryValuesAreNotRead(tmp_path, monkeypatch, transferSyntax):
+    filePath = str(tmp_path / 'image.dcm')
+    dcm = Dataset()
+    dcm.PatientName = 'Doe^Jane'
+    dcm.Modality = 'CT'
+    # An overlay and a private blob well over the defer size
+    dcm.add_new(0x60003000, 'OW', bytes(2000000))
+    dcm.add_new(0x00090010, 'LO', 'VENDOR')
+    dcm.add_new(0x00091001, 'OB', bytes(500000))
+    dcm.add_new(0x00081030, 'LO', 'A' * 60)
+    writeDcm(filePath, dcm, transferSyntax)
+
+    deferredReads = []
+    readDeferredDataElement = pydicom.filereader.read_deferred_data_element
+    def countingRead(*args, **kwargs):
+        element = readDeferredDataElement(*args, **kwargs)
+        deferredReads.append(element.tag)
+        return element
+    monkeypatch.setattr(pydicom.filereader, 'read_deferred_data_element', countingRead)
+
+    header = headerToDict(pdm.dcmread(filePath, defer_size=1024, stop_before_pixels=True))
+    assert deferredReads == []
+    explicitVR = transferSyntax == ExplicitVRLittleEndian
+    # Implicit VR keeps the ambiguous VR of the dictionary, as non-deferred elements do
+    assert header['60003000'] == {'vr': 'OW' if explicitVR else 'OB or OW'}
+    assert header['00100010'] == {'vr': 'PN', 'Value': [{'Alphabetic': 'Doe^Jane'}]}
+    assert header['00080060'] == {'vr': 'CS', 'Value': ['CT']}
+    # A private element of an implicit VR file is UN, as it would be when read by pydicom
+    assert header['00091001'] == {'vr': 'OB' if explicitVR else 'UN'}
+    assert header['00090010'] == {'vr': 'LO', 'Value': ['VENDOR']}
+
+def testDeferredTextValuesAreRead(tmp_path):
+    filePath = str(tmp_path / 'report.dcm')
+    dcm = Dataset()
+    dcm.TextValue = 'finding ' * 500
+    writeDcm(filePath, dcm)
+    header = headerToDict(pdm.dcmread(filePath, defer_size=1024, stop_before_pixels=True))
+    assert header['0040A160'] == {'vr': 'UT', 'Value': [('finding ' * 500).rstrip()]}
+    json.loads(headerToJson(pdm.dcmread(filePath, defer_size=1024)))
+
+def createDataset(characterSet=None, patientName='Doe^Jane'):
+    dcm = Dataset()
+    if characterSet is not None:
+        dcm.SpecificCharacterSet = characterSet
+    dcm.PatientName = patientName
+    dcm.PatientID = 'ID 42 '
+    dcm.StudyDate = '20240131'
+    dcm.ImageType = ['ORIGINAL', 'PRIMARY', 'AXIAL']
+    dcm.PixelSpacing = ['0.5', '0.25']
+    dcm.InstanceNumber = '7'
+    dcm.Rows = 512
+    dcm.SliceThickness = None
+    dcm.FrameIncrementPointer = 0x00181063
+    dcm.add_new(0x00181063, 'DS', '33.3')
+    dcm.add_new(0x00280106, 'US', 0)
+    referencedImage = Dataset()
+    referencedImage.ReferencedSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    referencedImage.ReferencedSOPInstanceUID = '1.2.3.4'
+    dcm.ReferencedImageSequence = [referencedImage]
+    return dcm
+
+def readBothWays(filePath):
+    """Serialize a DCM from its raw elements and once pydicom converted every element."""
+    rawHeader = headerToDict(pdm.dcmread(filePath))
+    dataset = pdm.dcmread(filePath)
+    for element in dataset.iterall():
+        pass
+    return rawHeader, headerToDict(dataset)
+
+def testHeaderEntries(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    writeDcm(filePath, createDataset())
+    header, convertedHeader = readBothWays(filePath)
+    assert header == convertedHeader
+    assert header['00100010'] == {'vr': 'PN', 'Value': [{'Alphabetic': 'Doe^Jane'}]}
+    assert header['00100020'] == {'vr': 'LO', 'Value': ['ID 42']}
+    assert header['00080020'] == {'vr': 'DA', 'Value': ['20240131']}
+    assert header['00080008'] == {'vr': 'CS', 'Value': ['ORIGINAL', 'PRIMARY', 'AXIAL']}
+    assert header['00280030'] == {'vr': 'DS', 'Value': [0.5, 0.25]}
+    assert header['00200013'] == {'vr': 'IS', 'Value': [7]}
+    assert header['00280010'] == {'vr': 'US', 'Value': [512]}
+    assert header['00180050'] == {'vr': 'DS'}
+    assert header['00280009'] == {'vr': 'AT', 'Value': ['00181063']}
+    assert header['00081140'] == {'vr': 'SQ', 'Value': [{
+        '00081150': {'vr': 'UI', 'Value': ['1.2.840.10008.5.1.4.1.1.2']},
+        '00081155': {'vr': 'UI', 'Value': ['1.2.3.4']}}]}
+    assert json.loads(headerToJson(pdm.dcmread(filePath))) == header
+
+def testImplicitVRHeader(tmp_path):
+    explicitPath = str(tmp_path / 'explicit.dcm')
+    writeDcm(explicitPath, createDataset())
+    implicitPath = str(tmp_path / 'implicit.dcm')
+    writeDcm(implicitPath, createDataset(), ImplicitVRLittleEndian)
+    header, convertedHeader = readBothWays(implicitPath)
+    assert header == convertedHeader
+    explicitHeader = headerToDict(pdm.dcmread(explicitPath))
+    # The VR of an element that the dictionary gives more than one VR is left to pydicom
+    assert header['00280106'] == {'vr': 'US', 'Value': [0]}
+    assert header == explicitHeader
+
+def testNonLatin1Text(tmp_path):
+    filePath = str(tmp_path / 'image.dcm')
+    writeDcm(filePath, createDataset('ISO_IR 192', 'Müller^Zoë=山田^太郎'))
+    header, convertedHeader = readBothWays(filePath)
+    assert header == convertedHeader
+    assert header['00100010'] == {'vr': 'PN', 'Value': [{'Alphabetic': 'Müller^Zoë=山田^太郎'}]}
+
+def testValuesPostgresRejects():
+    dcm = Dataset()
+    dcm.add_new(0x00081030, 'LO', 'study\x00')
+    dcm.add_new(0x00189089, 'FD', [float('inf'), 1.5])
+    header = headerToDict(dcm)
+    assert header['00081030'] == {'vr': 'LO', 'Value': ['study']}
+    assert header['00189089'] == {'vr': 'FD', 'Value': ['inf', 1.5]}
+    json.loads(headerToJson(dcm))
+    assert convertValue('DS', 'NaN') == 'NaN'
+    assert convertValue('IS', '12a') == '12a'
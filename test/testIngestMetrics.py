@@ -0,0 +1,112 @@
+import json
+import time
+import inspect
+import pytest
+from ingestMetrics import IngestMetrics, NullMetrics, STAGES, formatDuration
+
+def createMetrics(tmp_path, elapsed=10.0):
+    metrics = IngestMetrics(progressInterval=3600, jsonPath=str(tmp_path / 'metrics.json'),
+                            prometheusPath=str(tmp_path / 'metrics.prom'))
+    # Pretend the run started elapsed seconds ago, so the throughput doesn't depend on the machine
+    metrics.startCounter = time.perf_counter() - elapsed
+    return metrics
+
+def runIngest(metrics, fileCount=8):
+    for path in metrics.timeDiscovery(['scan{0}.dcm'.format(index) for index in range(fileCount)]):
+        metrics.addStageTimes({'read': 0.5, 'extract': 0.25})
+        if path == 'scan3.dcm':
+            metrics.countError('read', 'InvalidDicomError')
+            metrics.countFile(failed=True)
+            continue
+        with metrics.timeStage('write'):
+            pass
+        metrics.countWritten(1)
+        metrics.countFile()
+
+def testCounters(tmp_path):
+    metrics = createMetrics(tmp_path)
+    walk = metrics.timeDiscovery(['a.dcm', 'b.dcm'])
+    next(walk)
+    metrics.countFile()
+    # The number of files isn't known before the walk is done
+    assert metrics.getEta() is None
+    list(walk)
+    assert metrics.discoveryDone and metrics.discoveredCount == 2
+    assert metrics.getEta() == pytest.approx(10.0, rel=0.01)
+    metrics.setTotalFiles(11)
+    assert metrics.getEta() == pytest.approx(100.0, rel=0.01)
+
+def testJsonSummary(tmp_path):
+    metrics = createMetrics(tmp_path)
+    runIngest(metrics)
+    metrics.addLags([2.0, 4.0])
+    metrics.setWaitingFiles(3)
+    metrics.finish()
+    with open(str(tmp_path / 'metrics.json')) as fileReader:
+        summary = json.load(fileReader)
+    assert summary['files_discovered'] == 8
+    assert summary['files_processed'] == 8
+    assert summary['files_failed'] == 1
+    assert summary['records_written'] == 7
+    assert summary['files_per_second'] == pytest.approx(0.8, rel=0.01)
+    assert summary['eta_seconds'] == 0
+    assert summary['lag_seconds'] == {'last': 4.0, 'max': 4.0, 'mean': 3.0}
+    assert summary['files_waiting'] == 3
+    assert list(summary['stages'].keys()) == list(STAGES)
+    assert summary['stages']['read'] == {'seconds': 4.0, 'calls': 8}
+    assert summary['stages']['write']['calls'] == 7
+    assert summary['errors'] == [{'stage': 'read', 'type': 'InvalidDicomError', 'count': 1}]
+
+def readPrometheus(filePath):
+    """Parse the samples of a Prometheus text file, checking every metric has its HELP and TYPE first."""
+    samples = {}
+    described = set()
+    with open(filePath) as fileReader:
+        for line in fileReader.read().splitlines():
+            if line.startswith('# '):
+                described.add(line.split(' ')[2])
+                continue
+            name, value = line.rsplit(' ', 1)
+            assert name.split('{')[0] in described or name.rsplit('_', 1)[0] in described
+            samples[name] = float(value)
+    return samples
+
+def testPrometheusFile(tmp_path):
+    metrics = createMetrics(tmp_path)
+    runIngest(metrics)
+    metrics.reportProgress()
+    samples = readPrometheus(str(tmp_path / 'metrics.prom'))
+    assert samples['dicom_ingest_stage_seconds_total{stage="read"}'] == 4.0
+    assert samples['dicom_ingest_stage_calls_total{stage="write"}'] == 7
+    assert samples['dicom_ingest_errors_total{stage="read",type="InvalidDicomError"}'] == 1
+    assert samples['dicom_ingest_files_processed_total'] == 8
+    assert samples['dicom_ingest_files_failed_total'] == 1
+    assert samples['dicom_ingest_records_written_total'] == 7
+    assert samples['dicom_ingest_eta_seconds'] == 0
+    # Unknown values are -1 rather than missing
+    assert samples['dicom_ingest_last_lag_seconds'] == -1
+    assert samples['dicom_ingest_lag_seconds_count'] == 0
+    assert not (tmp_path / 'metrics.prom.tmp').exists()
+
+def testProgressIsReportedWhenDue(tmp_path):
+    metrics = createMetrics(tmp_path)
+    metrics.countFile()
+    assert not (tmp_path / 'metrics.prom').exists()
+    metrics.lastReport -= 3600
+    metrics.countFile()
+    assert readPrometheus(str(tmp_path / 'metrics.prom'))['dicom_ingest_files_processed_total'] == 2
+
+def testNullMetrics(tmp_path):
+    # Every method the ingest calls on the metrics is there when they are disabled, with the same arguments
+    for name in ['addStageTime', 'addStageTimes', 'timeStage', 'timeDiscovery', 'setTotalFiles', 'countError',
+                 'countFile', 'countWritten', 'addLags', 'setWaitingFiles', 'reportIfDue', 'finish']:
+        assert inspect.signature(getattr(NullMetrics, name)) == inspect.signature(getattr(IngestMetrics, name)), name
+    metrics = NullMetrics()
+    runIngest(metrics)
+    metrics.finish()
+    assert not metrics.enabled
+    assert list(tmp_path.iterdir()) == []
+
+def testFormatDuration():
+    assert formatDuration(0) == '0:00:00'
+    assert formatDuration(3725.9) == '1:02:05'
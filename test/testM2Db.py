@@ -27,6 +27,6 @@ m2db = DicomToDatabase(configHandler, dbHandler)
 metaTableName = configHandler.getTableName("metadata")
 
 if not dbHandler.tableExists(metaTableName):
-    dbHandler.addTableToDb(metaTableName, columnsInfoFullPath, "nonElementColumns", "elements")
+    dbHandler.addTableToDb(metaTableName, columnsInfoFullPath, "nonElementColumns", "elements", "indexes")
 
 m2db.dicomToDb(dbHandler.dbInfo['database'], metaTableName, columnsInfoFullPath)
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""Runs the incremental mode's manifest against a real DB.
+
+Set M2DB_TEST_CONFIG to a config.ini whose postgresql section points to a server the tests can
+create tables on, the DB tests are skipped otherwise. Every test uses a manifest table of its own
+and drops it at the end.
+"""
+import os
+import uuid
+import shutil
+import pytest
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler
+from dicomToDb import DicomToDatabase
+
+TEST_CONFIG = os.environ.get('M2DB_TEST_CONFIG')
+
+needsDb = pytest.mark.skipif(not TEST_CONFIG, reason='no test DB configured, set M2DB_TEST_CONFIG')
+
+@pytest.fixture
+def dbHandler(tmp_path):
+    configFilePath = str(tmp_path / 'config.ini')
+    shutil.copyfile(TEST_CONFIG, configFilePath)
+    dbHandler = DatabaseHandler(MetaToDbConfigHandler(configFilePath))
+    yield dbHandler
+    dbHandler.closeAllConnections()
+
+@pytest.fixture
+def manifestTableName(dbHandler):
+    manifestTableName = 'test_manifest_' + uuid.uuid4().hex[:12]
+    dbHandler.addManifestTableToDb(manifestTableName)
+    yield manifestTableName
+    dbHandler.executeQuery(dbHandler.connection, 'DROP TABLE IF EXISTS \"' + manifestTableName + '\";')
+
+def setStatus(dbHandler, manifestTableName, fileStatuses):
+    connection = dbHandler.getPooledConnection()
+    try:
+        dbHandler.setManifestStatus(connection, manifestTableName, fileStatuses)
+        connection.commit()
+    finally:
+        dbHandler.releasePooledConnection(connection)
+
+def getManifest(dbHandler, manifestTableName):
+    sqlQuery = 'SELECT file_path, file_size, file_mtime_ns, status FROM \"' + manifestTableName + '\" ORDER BY file_path;'
+    return dbHandler.executeQuery(dbHandler.connection, sqlQuery).fetchall()
+
+@needsDb
+def testStoredFilesAreSkipped(dbHandler, manifestTableName):
+    fileStats = [('a.dcm', 100, 1000), ('b.dcm', 200, 2000), ('c.dcm', 300, 3000)]
+    assert sorted(dbHandler.findChangedFiles(manifestTableName, fileStats)) == ['a.dcm', 'b.dcm', 'c.dcm']
+    assert [status for _, _, _, status in getManifest(dbHandler, manifestTableName)] == ['pending'] * 3
+    setStatus(dbHandler, manifestTableName, [('a.dcm', 'done'), ('b.dcm', 'done'), ('c.dcm', 'done')])
+    assert dbHandler.findChangedFiles(manifestTableName, fileStats) == []
+
+@needsDb
+def testInterruptedRunIsResumed(dbHandler, manifestTableName):
+    fileStats = [('a.dcm', 100, 1000), ('b.dcm', 200, 2000), ('c.dcm', 300, 3000), ('d.dcm', 400, 4000)]
+    dbHandler.findChangedFiles(manifestTableName, fileStats)
+    # The run stopped after storing a.dcm, c.dcm couldn't be read
+    setStatus(dbHandler, manifestTableName, [('a.dcm', 'done'), ('c.dcm', 'failed')])
+    assert sorted(dbHandler.findChangedFiles(manifestTableName, fileStats)) == ['b.dcm', 'c.dcm', 'd.dcm']
+    assert getManifest(dbHandler, manifestTableName) == [('a.dcm', 100, 1000, 'done'), ('b.dcm', 200, 2000, 'pending'),
+                                                         ('c.dcm', 300, 3000, 'pending'), ('d.dcm', 400, 4000, 'pending')]
+
+@needsDb
+def testChangedFilesAreStoredAgain(dbHandler, manifestTableName):
+    dbHandler.findChangedFiles(manifestTableName, [('a.dcm', 100, 1000), ('b.dcm', 200, 2000), ('c.dcm', 300, 3000)])
+    setStatus(dbHandler, manifestTableName, [('a.dcm', 'done'), ('b.dcm', 'done'), ('c.dcm', 'done')])
+    fileStats = [('a.dcm', 101, 1000), ('b.dcm', 200, 2500), ('c.dcm', 300, 3000), ('e.dcm', 500, 5000)]
+    assert sorted(dbHandler.findChangedFiles(manifestTableName, fileStats)) == ['a.dcm', 'b.dcm', 'e.dcm']
+    assert getManifest(dbHandler, manifestTableName)[:2] == [('a.dcm', 101, 1000, 'pending'), ('b.dcm', 200, 2500, 'pending')]
+
+class FakeConfigHandler:
+    def __init__(self, parentFolder):
+        self.parentFolder = parentFolder
+
+    def getParentFolder(self):
+        return self.parentFolder
+
+class ManifestDbHandler:
+    """Stands in for DatabaseHandler, finds the files whose stats aren't in the manifest yet."""
+    def __init__(self):
+        self.manifest = {}
+
+    def addManifestTableToDb(self, tableName):
+        pass
+
+    def findChangedFiles(self, manifestTableName, fileStats):
+        changedFiles = [fileRelPath for fileRelPath, fileSize, fileMtimeNs in fileStats
+                        if self.manifest.get(fileRelPath) != (fileSize, fileMtimeNs)]
+        self.manifest.update((fileRelPath, (fileSize, fileMtimeNs)) for fileRelPath, fileSize, fileMtimeNs in fileStats)
+        return changedFiles
+
+def testFilesToStore(tmp_path):
+    parentFolder = str(tmp_path)
+    filePaths = []
+    for fileName in ['a.dcm', 'b.dcm', 'scans.zip']:
+        filePaths.append(os.path.join(parentFolder, fileName))
+        with open(filePaths[-1], 'wb') as fileWriter:
+            fileWriter.write(b'x' * 10)
+    dbHandler = ManifestDbHandler()
+    dicomToDatabase = DicomToDatabase(FakeConfigHandler(parentFolder), dbHandler)
+    pathlist = filePaths[:2] + [os.path.join(parentFolder, 'scans.zip!study/c.dcm')]
+    assert dicomToDatabase.findFilesToStore(pathlist, 'manifest') == pathlist
+    # The manifest holds the relative paths, and archive members get the stats of their archive
+    assert dbHandler.manifest == {'a.dcm': (10, os.stat(filePaths[0]).st_mtime_ns),
+                                  'b.dcm': (10, os.stat(filePaths[1]).st_mtime_ns),
+                                  'scans.zip!study/c.dcm': (10, os.stat(filePaths[2]).st_mtime_ns)}
+
+    with open(filePaths[1], 'ab') as fileWriter:
+        fileWriter.write(b'x')
+    assert dicomToDatabase.findFilesToStore(pathlist, 'manifest') == [filePaths[1]]
@@ -0,0 +1,188 @@
+"""Tests of migrating a table to a column spec with new columns.
+
+The test of updateRecords needs M2DB_TEST_CONFIG set to a config.ini whose postgresql section
+points to a server the tests can create tables on, it is skipped otherwise.
+"""
+import os
+import json
+import uuid
+import shutil
+import pytest
+import pydicom as pdm
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from ingestMetrics import NullMetrics
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler
+from dicomToDb import DicomToDatabase
+
+TEST_CONFIG = os.environ.get('M2DB_TEST_CONFIG')
+
+COLUMNS_INFO = {
+    "nonElementColumns": {
+        "file_name": {"db_datatype": "VARCHAR(255)", "constraints": ""},
+        "file_path": {"db_datatype": "VARCHAR(255)", "constraints": "PRIMARY KEY"},
+    },
+    "elements": {
+        "modality": {"tag": "0x0008, 0x0060", "db_datatype": "VARCHAR(16)", "calculation_only": False},
+        "patient_birth_date": {"tag": "0x0010, 0x0030", "db_datatype": "VARCHAR(8)", "calculation_only": True},
+        "study_date": {"tag": "0x0008, 0x0020", "db_datatype": "VARCHAR(8)", "calculation_only": False},
+        "patient_age": {"tag": "0x0010, 0x1010", "db_datatype": "INTEGER", "calculation_only": False},
+        "window_center": {"tag": "0x0028, 0x1050", "db_datatype": "INTEGER", "calculation_only": False},
+    },
+}
+
+class FakeConfigHandler:
+    def __init__(self, parentFolder):
+        self.parentFolder = parentFolder
+
+    def getParentFolder(self):
+        return self.parentFolder
+
+    def getDeferSize(self):
+        return '1 KB'
+
+    def getParallel(self):
+        return False
+
+    def getBatchSize(self):
+        return 2
+
+    def getColumnStatsTableName(self):
+        return None
+
+    def getMetricsEnabled(self):
+        return False
+
+    def getDicomExtensions(self):
+        return ['.dcm']
+
+    def getDetectDicomMagic(self):
+        return False
+
+class FakeConnection:
+    closed = 0
+
+    def commit(self):
+        pass
+
+class MigrateDbHandler:
+    """Stands in for DatabaseHandler, keeps the rows of one table in memory."""
+    def __init__(self, columnNames, rows):
+        self.metrics = NullMetrics()
+        self.columnNames = list(columnNames)
+        self.rows = {row['file_path']: row for row in rows}
+        self.updates = []
+
+    def tableExists(self, tableName):
+        return True
+
+    def getTablePrimaryKey(self, tableName):
+        return tableName + '_pkey', ['file_path']
+
+    def getTableColumns(self, tableName):
+        return list(self.columnNames)
+
+    def addColumns(self, tableName, columns):
+        for columnName, _ in columns:
+            self.columnNames.append(columnName)
+            for row in self.rows.values():
+                row[columnName] = None
+
+    def getColumnValues(self, tableName, columnName):
+        return [row[columnName] for row in self.rows.values()]
+
+    def getPooledConnection(self):
+        return FakeConnection()
+
+    def returnPooledConnection(self, connection, close=False):
+        pass
+
+    def updateRecords(self, connection, tableName, columnNames, records, keyColumns):
+        self.updates.append(columnNames)
+        for record in records:
+            values = dict(zip(columnNames, record))
+            row = self.rows.get(tuple(values[keyColumn] for keyColumn in keyColumns)[0])
+            if row is not None:
+                row.update((columnName, value) for columnName, value in values.items() if columnName in self.columnNames)
+
+def writeDcm(filePath, **values):
+    dcm = Dataset()
+    for keyword, value in values.items():
+        setattr(dcm, keyword, value)
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'
+    dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dcm.save_as(filePath, enforce_file_format=True)
+
+@pytest.fixture
+def columnsInfoPath(tmp_path):
+    columnsInfoPath = str(tmp_path / 'columns_info.json')
+    with open(columnsInfoPath, 'w') as fileWriter:
+        json.dump(COLUMNS_INFO, fileWriter)
+    return columnsInfoPath
+
+def testNewColumnsAreBackfilled(tmp_path, columnsInfoPath, monkeypatch):
+    os.makedirs(str(tmp_path / 'x'))
+    writeDcm(str(tmp_path / 'a.dcm'), Modality='CT', PatientBirthDate='19800229', StudyDate='20240228', WindowCenter='40')
+    writeDcm(str(tmp_path / 'x' / 'b.dcm'), Modality='MR', StudyDate='20240101', PatientAge='045Y')
+    writeDcm(str(tmp_path / 'c.dcm'), Modality='US')
+    rows = [{'file_name': 'a.dcm', 'file_path': 'a.dcm', 'modality': 'CT', 'study_date': '20240228'},
+            {'file_name': 'b.dcm', 'file_path': os.path.join('x', 'b.dcm'), 'modality': 'MR', 'study_date': '20240101'},
+            {'file_name': 'c.dcm', 'file_path': 'c.dcm', 'modality': 'US', 'study_date': None},
+            # The DCM of a record that was removed since it was stored
+            {'file_name': 'd.dcm', 'file_path': 'd.dcm', 'modality': 'CT', 'study_date': None}]
+    dbHandler = MigrateDbHandler(['file_name', 'file_path', 'modality', 'study_date'], rows)
+
+    readTags = []
+    dcmread = pdm.dcmread
+    def recordingRead(source, **readOptions):
+        readTags.append(sorted(readOptions['specific_tags']))
+        return dcmread(source, **readOptions)
+    monkeypatch.setattr(pdm, 'dcmread', recordingRead)
+
+    dicomToDatabase = DicomToDatabase(FakeConfigHandler(str(tmp_path)), dbHandler)
+    assert dicomToDatabase.migrateTable('metadata', columnsInfoPath) == ['patient_age', 'window_center']
+    # Only the tags of the new columns and the ones they are calculated from are read
+    newTags = sorted([pdm.tag.Tag(0x0010, 0x0030), pdm.tag.Tag(0x0008, 0x0020), pdm.tag.Tag(0x0010, 0x1010), pdm.tag.Tag(0x0028, 0x1050)])
+    assert readTags == [newTags] * 4
+    assert dbHandler.updates == [['file_name', 'file_path', 'patient_age', 'window_center']] * 2
+    assert [(row['patient_age'], row['window_center']) for row in dbHandler.rows.values()] == \
+        [(43, 40), ('045Y', None), (None, None), (None, None)]
+    assert dbHandler.rows['c.dcm']['modality'] == 'US'
+
+    # Migrated once, the table already has every column
+    readTags = []
+    assert dicomToDatabase.migrateTable('metadata', columnsInfoPath) == []
+    assert readTags == []
+
+@pytest.fixture
+def dbHandler(tmp_path):
+    configFilePath = str(tmp_path / 'config.ini')
+    shutil.copyfile(TEST_CONFIG, configFilePath)
+    dbHandler = DatabaseHandler(MetaToDbConfigHandler(configFilePath))
+    yield dbHandler
+    dbHandler.closeAllConnections()
+
+@pytest.mark.skipif(not TEST_CONFIG, reason='no test DB configured, set M2DB_TEST_CONFIG')
+def testUpdateRecords(dbHandler):
+    tableName = 'test_migrate_' + uuid.uuid4().hex[:12]
+    dbHandler.executeQuery(dbHandler.connection, 'CREATE TABLE \"' + tableName + '\" (file_path TEXT PRIMARY KEY, '
+                           + 'modality VARCHAR(16), patient_age INTEGER, window_center INTEGER);')
+    try:
+        connection = dbHandler.getPooledConnection()
+        try:
+            dbHandler.insertRecords(connection, tableName, ['file_path', 'modality'], [('a.dcm', 'CT'), ('b.dcm', 'MR'), ('c.dcm', 'US')])
+            columnNames = ['file_path', 'patient_age', 'window_center']
+            # Two batches in one transaction reuse the staging table
+            dbHandler.updateRecords(connection, tableName, columnNames, [('a.dcm', 43, 40), ('missing.dcm', 1, 1)], ['file_path'])
+            dbHandler.updateRecords(connection, tableName, columnNames, [('b.dcm', 45, None)], ['file_path'])
+            connection.commit()
+        finally:
+            dbHandler.releasePooledConnection(connection)
+        sqlQuery = 'SELECT file_path, modality, patient_age, window_center FROM \"' + tableName + '\" ORDER BY file_path;'
+        assert dbHandler.executeQuery(dbHandler.connection, sqlQuery).fetchall() == \
+            [('a.dcm', 'CT', 43, 40), ('b.dcm', 'MR', 45, None), ('c.dcm', 'US', None, None)]
+    finally:
+        dbHandler.executeQuery(dbHandler.connection, 'DROP TABLE IF EXISTS \"' + tableName + '\";')
@@ -0,0 +1,75 @@
+import io
+import gzip
+import numpy as np
+import nibabel as nib
+import pytest
+from niftiHeader import parseNiftiHeader, readNiftiHeader
+
+FIELDS = ['sizeof_hdr', 'dim', 'datatype', 'bitpix', 'pixdim', 'vox_offset', 'scl_slope', 'scl_inter',
+          'qform_code', 'sform_code', 'srow_x', 'srow_y', 'srow_z', 'descrip', 'xyzt_units', 'magic']
+
+def createImage(imageClass, endianness):
+    header = imageClass.header_class(endianness=endianness)
+    header.set_data_dtype(np.int16)
+    affine = np.diag([0.8, 0.8, 2.5, 1.0])
+    affine[:3, 3] = [-100.0, -120.0, 40.0]
+    image = imageClass(np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6), affine, header)
+    image.header['descrip'] = b'synthetic T1'
+    image.header.set_xyzt_units('mm', 'sec')
+    image.header.set_slope_inter(2.0, -1.0)
+    return image
+
+def readExpectedHeader(filePath, imageClass):
+    # The header of a loaded image has its offset and scaling reset, so read the one in the file
+    with (gzip.open if filePath.endswith('.gz') else open)(filePath, 'rb') as fileReader:
+        return imageClass.header_class.from_fileobj(fileReader)
+
+def checkHeader(header, expectedHeader):
+    for field in FIELDS:
+        assert np.array_equal(np.asarray(header[field]), np.asarray(expectedHeader[field])), field
+
+@pytest.mark.parametrize("imageClass", [nib.Nifti1Image, nib.Nifti2Image])
+@pytest.mark.parametrize("endianness", ['<', '>'])
+def testParseNiftiHeader(tmp_path, imageClass, endianness):
+    filePath = str(tmp_path / 'image.nii')
+    nib.save(createImage(imageClass, endianness), filePath)
+    expectedHeader = readExpectedHeader(filePath, imageClass)
+    assert expectedHeader.endianness == endianness
+
+    with open(filePath, 'rb') as fileReader:
+        headerBytes = fileReader.read()
+    checkHeader(parseNiftiHeader(headerBytes), expectedHeader)
+    checkHeader(readNiftiHeader(filePath), expectedHeader)
+
+@pytest.mark.parametrize("imageClass", [nib.Nifti1Image, nib.Nifti2Image])
+def testReadGzipHeader(tmp_path, imageClass):
+    filePath = str(tmp_path / 'image.nii.gz')
+    nib.save(createImage(imageClass, '<'), filePath)
+    expectedHeader = readExpectedHeader(filePath, imageClass)
+    checkHeader(readNiftiHeader(filePath), expectedHeader)
+    with open(filePath, 'rb') as fileReader:
+        checkHeader(readNiftiHeader(filePath, io.BytesIO(fileReader.read())), expectedHeader)
+
+def testGzipHeaderIsDecompressedOnly(tmp_path):
+    # A large image whose header is in the first block, the rest of the file is never read
+    filePath = str(tmp_path / 'image.nii.gz')
+    volume = np.random.default_rng(0).integers(0, 1000, (64, 64, 64)).astype(np.int16)
+    nib.save(nib.Nifti1Image(volume, np.eye(4)), filePath)
+    with open(filePath, 'rb') as fileReader:
+        content = fileReader.read()
+    fileReader = io.BytesIO(content)
+    assert readNiftiHeader(filePath, fileReader)['dim'][1:4].tolist() == [64, 64, 64]
+    assert fileReader.tell() < len(content) // 10
+
+def testParseOtherBytes():
+    assert parseNiftiHeader(b'') is None
+    assert parseNiftiHeader(b'\x00\x01') is None
+    assert parseNiftiHeader(b'DICM' + bytes(600)) is None
+    # A NIfTI-1 sizeof_hdr without the rest of the header
+    assert parseNiftiHeader(np.int32(348).tobytes() + bytes(100)) is None
+
+def testFileReaderWithoutHeader(tmp_path):
+    with pytest.raises(ValueError):
+        readNiftiHeader('image.nii', io.BytesIO(b'not a NIfTI file' * 40))
+    with pytest.raises(ValueError):
+        readNiftiHeader('image.nii.gz', io.BytesIO(gzip.compress(b'not a NIfTI file' * 40)))
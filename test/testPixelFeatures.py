@@ -0,0 +1,175 @@
+import io
+import os
+import builtins
+import numpy as np
+import nibabel as nib
+import pydicom as pdm
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+import pixelFeatures
+from pixelFeatures import computeDicomFeatures, computeNiftiFeatures, getDerivedColumns
+
+DERIVED = {
+    "pixel_min": {"feature": "min"},
+    "pixel_max": {"feature": "max"},
+    "pixel_mean": {"feature": "mean"},
+    "pixel_std": {"feature": "std"},
+    "pixel_p90": {"feature": "percentile", "q": 90},
+    "zero_fraction": {"feature": "zero_fraction"},
+    "thumbnail": {"feature": "thumbnail", "size": 4},
+}
+
+class CountingReader:
+    """Wraps a file and counts the bytes read from it, including those read again after a seek back."""
+    def __init__(self, fileReader):
+        self.fileReader = fileReader
+        self.bytesRead = 0
+
+    def read(self, size=-1):
+        data = self.fileReader.read(size)
+        self.bytesRead += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.fileReader.seek(offset, whence)
+
+    def tell(self):
+        return self.fileReader.tell()
+
+    def __getattr__(self, name):
+        return getattr(self.fileReader, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.fileReader.close()
+
+def writeNifti(filePath, volume, slope=None, imageClass=nib.Nifti1Image):
+    image = imageClass(volume, np.eye(4))
+    if slope is not None:
+        image.header.set_slope_inter(slope, 3.0)
+    nib.save(image, filePath)
+    return np.asarray(nib.load(filePath).dataobj, dtype=np.float64)
+
+def writeDcm(filePath, frames, withPixelData=True):
+    dcm = Dataset()
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'
+    dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dcm.SOPClassUID = dcm.file_meta.MediaStorageSOPClassUID
+    dcm.SOPInstanceUID = dcm.file_meta.MediaStorageSOPInstanceUID
+    if withPixelData:
+        dcm.SamplesPerPixel = 1
+        dcm.PhotometricInterpretation = 'MONOCHROME2'
+        dcm.Rows, dcm.Columns = frames.shape[1:]
+        dcm.NumberOfFrames = str(frames.shape[0])
+        dcm.BitsAllocated = 16
+        dcm.BitsStored = 16
+        dcm.HighBit = 15
+        dcm.PixelRepresentation = 0
+        dcm.RescaleSlope = '2'
+        dcm.RescaleIntercept = '-10'
+        dcm.PixelData = frames.astype('<u2').tobytes()
+    dcm.save_as(filePath, enforce_file_format=True)
+    return pdm.dcmread(filePath, stop_before_pixels=True)
+
+def checkFeatures(values, volume, middleSlice):
+    assert values[0] == pytest.approx(volume.min())
+    assert values[1] == pytest.approx(volume.max())
+    assert values[2] == pytest.approx(volume.mean())
+    assert values[3] == pytest.approx(volume.std())
+    assert values[4] == pytest.approx(np.percentile(volume, 90))
+    assert values[5] == pytest.approx(np.mean(volume == 0))
+    assert np.allclose(values[6], pixelFeatures.downsample(middleSlice, 4), atol=1e-3)
+
+@pytest.mark.parametrize("fileName, shape, dtype, slope", [
+    ("volume.nii.gz", (20, 30, 7), np.int16, 2.0),
+    ("volume.nii", (12, 10, 5, 3), np.float32, None),
+    ("image.nii.gz", (9, 4), np.uint8, None),
+])
+def testNiftiFeaturesMatchWholeArray(tmp_path, fileName, shape, dtype, slope):
+    volume = (np.random.default_rng(0).random(shape) * 100).astype(dtype)
+    filePath = str(tmp_path / fileName)
+    data = writeNifti(filePath, volume, slope)
+
+    values = computeNiftiFeatures(DERIVED, filePath)
+    # The middle slice in the order the slices are stored in
+    slices = data.reshape(data.shape[:2] + (-1,), order='F') if data.ndim > 2 else data[:, :, np.newaxis]
+    checkFeatures(values, data, slices[:, :, slices.shape[2] // 2])
+    with open(filePath, 'rb') as fileReader:
+        assert computeNiftiFeatures(DERIVED, filePath, io.BytesIO(fileReader.read())) == values
+
+def testNifti2Features(tmp_path):
+    volume = np.random.default_rng(1).random((8, 6, 5)).astype(np.float32)
+    filePath = str(tmp_path / "volume.nii.gz")
+    data = writeNifti(filePath, volume, imageClass=nib.Nifti2Image)
+    checkFeatures(computeNiftiFeatures(DERIVED, filePath, sizeofHdr=540), data, data[:, :, 2])
+
+@pytest.mark.parametrize("sliceCount", [10, 40, 160])
+def testNiftiFeaturesReadGzipOnce(tmp_path, monkeypatch, sliceCount):
+    # Every compressed byte is read once, however many slices there are, so the cost is linear in them
+    volume = (np.random.default_rng(2).random((64, 64, sliceCount)) * 1000).astype(np.int16)
+    filePath = str(tmp_path / "volume.nii.gz")
+    writeNifti(filePath, volume)
+    fileSize = os.path.getsize(filePath)
+
+    readers = []
+    builtinOpen = builtins.open
+    def countingOpen(file, mode='r', *args, **kwargs):
+        fileReader = builtinOpen(file, mode, *args, **kwargs)
+        if file != filePath:
+            return fileReader
+        readers.append(CountingReader(fileReader))
+        return readers[-1]
+    monkeypatch.setattr(builtins, 'open', countingOpen)
+    computeNiftiFeatures(DERIVED, filePath)
+    monkeypatch.undo()
+    assert sum(reader.bytesRead for reader in readers) <= fileSize
+
+    with open(filePath, 'rb') as fileReader:
+        countingReader = CountingReader(fileReader)
+        computeNiftiFeatures(DERIVED, filePath, countingReader)
+    assert countingReader.bytesRead <= fileSize
+
+def testNiftiFeaturesOfTruncatedFile(tmp_path):
+    filePath = str(tmp_path / "volume.nii")
+    writeNifti(filePath, np.ones((8, 8, 4), dtype=np.int16))
+    with open(filePath, 'rb') as fileReader:
+        content = fileReader.read()
+    with pytest.raises(ValueError):
+        computeNiftiFeatures(DERIVED, filePath, io.BytesIO(content[:-10]))
+
+def testDicomFeatures(tmp_path):
+    frames = np.random.default_rng(3).integers(0, 4096, (3, 16, 12)).astype(np.uint16)
+    filePath = str(tmp_path / "image.dcm")
+    dcm = writeDcm(filePath, frames)
+    volume = frames * 2.0 - 10
+
+    checkFeatures(computeDicomFeatures(DERIVED, dcm, filePath), volume, volume[1])
+    with open(filePath, 'rb') as fileReader:
+        checkFeatures(computeDicomFeatures(DERIVED, dcm, fileReader), volume, volume[1])
+
+def testDicomWithoutPixelDataGetsNulls(tmp_path):
+    filePath = str(tmp_path / "report.dcm")
+    dcm = writeDcm(filePath, None, withPixelData=False)
+    assert computeDicomFeatures(DERIVED, dcm, filePath) == (None,) * len(DERIVED)
+
+def testDicomFeatureErrorsAreRaised(tmp_path, monkeypatch):
+    filePath = str(tmp_path / "image.dcm")
+    dcm = writeDcm(filePath, np.ones((2, 4, 4), dtype=np.uint16))
+    def addFrame(self, frame, index):
+        raise AttributeError('bug in the feature code')
+    monkeypatch.setattr(pixelFeatures.PixelFeatures, 'addFrame', addFrame)
+    with pytest.raises(AttributeError):
+        computeDicomFeatures(DERIVED, dcm, filePath)
+
+def testDerivedColumns():
+    assert getDerivedColumns({"p": {"feature": "percentile", "q": 50}, "t": {"feature": "thumbnail"}}) \
+        == [("p", "DOUBLE PRECISION"), ("t", "REAL[][]")]
+    with pytest.raises(Exception):
+        getDerivedColumns({"p": {"feature": "percentile", "q": 101}})
+    with pytest.raises(Exception):
+        getDerivedColumns({"x": {"feature": "median"}})
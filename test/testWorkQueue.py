@@ -0,0 +1,215 @@
+"""Runs workers of the distributed mode against one work queue in a real DB.
+
+Set M2DB_TEST_CONFIG to a config.ini whose postgresql section points to a server the tests can
+create tables on, the tests are skipped otherwise. Every test uses a work queue table of its own
+and drops it at the end.
+"""
+import os
+import time
+import uuid
+import shutil
+import threading
+import pytest
+from metaToDbConfigHandler import MetaToDbConfigHandler
+from databaseHandler import DatabaseHandler
+from dicomToDb import DicomToDatabase, ChunkHeartbeat
+
+TEST_CONFIG = os.environ.get('M2DB_TEST_CONFIG')
+
+pytestmark = pytest.mark.skipif(not TEST_CONFIG, reason='no test DB configured, set M2DB_TEST_CONFIG')
+
+class WorkerDied(Exception):
+    pass
+
+class RecordingDicomToDatabase(DicomToDatabase):
+    """Keeps the paths of the chunks it claims instead of reading them as DCMs.
+
+    A worker with dieAfter set stops in the middle of that many-th chunk, leaving it claimed,
+    and one with chunkTime set takes longer than stale_after over every chunk.
+    """
+    def __init__(self, configHandler, dbHandler, workerId, dieAfter=None, chunkTime=0.01):
+        DicomToDatabase.__init__(self, configHandler, dbHandler)
+        self.workerId = workerId
+        self.dieAfter = dieAfter
+        self.chunkTime = chunkTime
+        self.storedPaths = []
+        self.chunkCount = 0
+
+    def storeSerially(self, pathlist, plan, readOptions, batchWriter):
+        self.chunkCount += 1
+        if self.chunkCount == self.dieAfter:
+            raise WorkerDied(self.workerId)
+        # Long enough for the other workers to claim chunks in the meantime
+        time.sleep(self.chunkTime)
+        self.storedPaths.extend(pathlist)
+
+    def run(self, pathlist, errors):
+        try:
+            self.storeDistributed(pathlist, None, None, NullBatchWriter(), workerId=self.workerId)
+        except Exception as error:
+            errors.append(error)
+
+class NullBatchWriter:
+    def flush(self):
+        pass
+
+@pytest.fixture
+def configHandler(tmp_path):
+    configFilePath = str(tmp_path / 'config.ini')
+    shutil.copyfile(TEST_CONFIG, configFilePath)
+    configHandler = MetaToDbConfigHandler(configFilePath)
+    configHandler.setSetting('tableNames', 'work_queue', 'test_queue_' + uuid.uuid4().hex[:12])
+    configHandler.setSetting('distributed', 'chunk_size', '4')
+    configHandler.setSetting('distributed', 'heartbeat_interval', '0.2')
+    configHandler.setSetting('distributed', 'stale_after', '1')
+    configHandler.setSetting('distributed', 'max_attempts', '3')
+    configHandler.setSetting('distributed', 'poll_interval', '0.05')
+    configHandler.setSetting('ingest', 'parallel', 'false')
+    return configHandler
+
+@pytest.fixture
+def openDbHandler(configHandler):
+    """Opens a DatabaseHandler per worker, each with connections of its own."""
+    dbHandlers = []
+    def openDbHandler():
+        dbHandlers.append(DatabaseHandler(configHandler))
+        return dbHandlers[-1]
+    yield openDbHandler
+    if dbHandlers:
+        dbHandlers[0].executeQuery(dbHandlers[0].connection,
+                                   'DROP TABLE IF EXISTS \"' + configHandler.getTableName('work_queue') + '\";')
+    for dbHandler in dbHandlers:
+        dbHandler.closeAllConnections()
+
+def getChunks(dbHandler, queueTableName):
+    sqlQuery = 'SELECT chunk_id, status, attempts, worker_id FROM \"' + queueTableName + '\" ORDER BY chunk_id;'
+    return dbHandler.executeQuery(dbHandler.connection, sqlQuery).fetchall()
+
+def createQueue(dbHandler, queueTableName, chunkCount):
+    dbHandler.addWorkQueueTableToDb(queueTableName)
+    dbHandler.enqueueChunks(queueTableName, [['chunk_{0}.dcm'.format(index)] for index in range(chunkCount)])
+    return [chunkId for chunkId, _, _, _ in getChunks(dbHandler, queueTableName)]
+
+def runWorkers(workers, pathlist):
+    """Runs the workers as threads, each claiming under its own worker ID, returns the errors they raised."""
+    errors = []
+    threads = [threading.Thread(target=worker.run, args=(pathlist, errors)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+    return errors
+
+def checkChunkOwners(configHandler, workers):
+    """Checks that every chunk was finished under the ID of the worker that stored its files."""
+    dbHandler = workers[0].dbHandler
+    sqlQuery = 'SELECT worker_id, file_paths FROM \"' + configHandler.getTableName('work_queue') + '\";'
+    storedPaths = {worker.workerId: set(worker.storedPaths) for worker in workers}
+    for workerId, fileRelPaths in dbHandler.executeQuery(dbHandler.connection, sqlQuery).fetchall():
+        assert {os.path.join(configHandler.getParentFolder(), fileRelPath) for fileRelPath in fileRelPaths} <= storedPaths[workerId]
+
+def createPathlist(configHandler, fileCount):
+    parentFolder = configHandler.getParentFolder()
+    return [os.path.join(parentFolder, 'scan_{0:03d}.dcm'.format(index)) for index in range(fileCount)]
+
+@pytest.mark.parametrize("workerCount", [2, 6])
+def testEveryChunkIsStoredOnce(configHandler, openDbHandler, workerCount):
+    pathlist = createPathlist(configHandler, 101)
+    workers = [RecordingDicomToDatabase(configHandler, openDbHandler(), 'worker{0}'.format(index)) for index in range(workerCount)]
+    assert runWorkers(workers, pathlist) == []
+
+    storedPaths = [path for worker in workers for path in worker.storedPaths]
+    assert sorted(storedPaths) == pathlist
+    chunks = getChunks(workers[0].dbHandler, configHandler.getTableName('work_queue'))
+    assert len(chunks) == 26
+    assert all(status == 'done' and attempts == 1 for _, status, attempts, _ in chunks)
+    checkChunkOwners(configHandler, workers)
+
+def testChunkOfDeadWorkerIsStoredByAnother(configHandler, openDbHandler):
+    pathlist = createPathlist(configHandler, 40)
+    # Dies in the first chunk it claims
+    deadWorker = RecordingDicomToDatabase(configHandler, openDbHandler(), 'dead', dieAfter=1)
+    # Slower than stale_after over every chunk, its heartbeats keep its chunks from being claimed again
+    slowWorker = RecordingDicomToDatabase(configHandler, openDbHandler(), 'slow', chunkTime=1.5)
+    workers = [deadWorker, slowWorker] + [RecordingDicomToDatabase(configHandler, openDbHandler(), 'live{0}'.format(index))
+                                          for index in range(2)]
+    errors = runWorkers(workers, pathlist)
+    assert [type(error) for error in errors] == [WorkerDied]
+
+    storedPaths = [path for worker in workers for path in worker.storedPaths]
+    assert sorted(storedPaths) == pathlist
+    chunks = getChunks(deadWorker.dbHandler, configHandler.getTableName('work_queue'))
+    assert all(status == 'done' for _, status, _, _ in chunks)
+    # Only the chunk the dead worker left claimed was claimed twice, by another worker
+    reclaimed = [(attempts, workerId) for _, _, attempts, workerId in chunks if attempts > 1]
+    assert len(reclaimed) == 1
+    assert reclaimed[0][0] == 2 and reclaimed[0][1] != 'dead'
+    assert slowWorker.storedPaths
+    assert all(attempts == 1 for _, _, attempts, workerId in chunks if workerId == 'slow')
+    checkChunkOwners(configHandler, workers)
+
+def testStaleChunkIsClaimedAgain(configHandler, openDbHandler):
+    queueTableName = configHandler.getTableName('work_queue')
+    dbHandler = openDbHandler()
+    firstChunkId, secondChunkId = createQueue(dbHandler, queueTableName, 2)
+
+    # The first worker dies after claiming a chunk, so it never sends a heartbeat for it
+    assert dbHandler.claimChunk(queueTableName, 'dead', 1, 3)[0] == firstChunkId
+    assert dbHandler.claimChunk(queueTableName, 'live', 1, 3)[0] == secondChunkId
+    assert dbHandler.finishChunk(queueTableName, secondChunkId, 'live')
+    assert dbHandler.claimChunk(queueTableName, 'live', 1, 3) is None
+
+    time.sleep(1.5)
+    assert dbHandler.claimChunk(queueTableName, 'live', 1, 3)[0] == firstChunkId
+    # The dead worker coming back can't finish the chunk it lost
+    assert not dbHandler.finishChunk(queueTableName, firstChunkId, 'dead')
+    assert dbHandler.finishChunk(queueTableName, firstChunkId, 'live')
+    assert getChunks(dbHandler, queueTableName) == [(firstChunkId, 'done', 2, 'live'), (secondChunkId, 'done', 1, 'live')]
+
+def testHeartbeatKeepsTheChunk(configHandler, openDbHandler):
+    queueTableName = configHandler.getTableName('work_queue')
+    dbHandler = openDbHandler()
+    chunkId, = createQueue(dbHandler, queueTableName, 1)
+
+    assert dbHandler.claimChunk(queueTableName, 'slow', 1, 3)[0] == chunkId
+    heartbeat = ChunkHeartbeat(dbHandler, queueTableName, 'slow', 0.2)
+    heartbeat.start()
+    try:
+        time.sleep(1.5)
+        assert openDbHandler().claimChunk(queueTableName, 'other', 1, 3) is None
+    finally:
+        heartbeat.stop()
+    assert dbHandler.finishChunk(queueTableName, chunkId, 'slow')
+
+def testChunkFailsAfterMaxAttempts(configHandler, openDbHandler):
+    queueTableName = configHandler.getTableName('work_queue')
+    dbHandler = openDbHandler()
+    chunkId, = createQueue(dbHandler, queueTableName, 1)
+
+    assert dbHandler.claimChunk(queueTableName, 'first', 0.5, 2)[0] == chunkId
+    time.sleep(0.8)
+    assert dbHandler.claimChunk(queueTableName, 'second', 0.5, 2)[0] == chunkId
+    time.sleep(0.8)
+    assert dbHandler.claimChunk(queueTableName, 'third', 0.5, 2) is None
+    assert getChunks(dbHandler, queueTableName) == [(chunkId, 'failed', 2, 'second')]
+    assert dbHandler.countUnfinishedChunks(queueTableName) == 0
+
+def testConcurrentClaimsNeverShareAChunk(configHandler, openDbHandler):
+    queueTableName = configHandler.getTableName('work_queue')
+    chunkIds = createQueue(openDbHandler(), queueTableName, 200)
+    dbHandlers = [openDbHandler() for _ in range(8)]
+    claimedChunkIds = []
+    def claimAll(dbHandler, workerId):
+        while True:
+            claimed = dbHandler.claimChunk(queueTableName, workerId, 60, 3)
+            if claimed is None:
+                return
+            claimedChunkIds.append(claimed[0])
+            dbHandler.finishChunk(queueTableName, claimed[0], workerId)
+    threads = [threading.Thread(target=claimAll, args=(dbHandler, 'worker{0}'.format(index)))
+               for index, dbHandler in enumerate(dbHandlers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+    assert sorted(claimedChunkIds) == chunkIds